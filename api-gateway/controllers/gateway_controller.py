@@ -1,3 +1,6 @@
+import asyncio
+import random
+import time
 from datetime import datetime, timezone
 from typing import Any, Dict, Iterable
 
@@ -11,6 +14,23 @@ from utils.logger import log
 from utils.utils import get_envvar
 
 DEFAULT_COOKIE_MAX_AGE = get_envvar("DEFAULT_COOKIE_MAX_AGE")
+SHADOW_MIRROR_METHODS = {
+    m.strip().upper()
+    for m in get_envvar("SHADOW_MIRROR_METHODS", "GET,HEAD").split(",")
+    if m.strip()
+}
+SHADOW_TIMEOUT = float(get_envvar("SHADOW_TIMEOUT", "30"))
+# Seconds the shadow instances of a service are cached for, so requests to
+# services without shadows do not look them up in Redis every time
+SHADOW_CACHE_TTL = float(get_envvar("SHADOW_CACHE_TTL", "5"))
+
+# Shadow instances of each service along with when they were looked up,
+# shared across requests as the controller only lives for one request
+_shadow_cache: dict[str, tuple[float, list[dict]]] = {}
+
+# Keeps fire-and-forget mirror tasks referenced until they complete, as the
+# controller itself only lives for the duration of a request
+_mirror_tasks: set[asyncio.Task] = set()
 
 
 class GatewayController:
@@ -154,6 +174,8 @@ class GatewayController:
         instance_id: str,
         address: str,
         routes: Iterable[RoutePayload],
+        shadow: bool = False,
+        mirror_percent: float = 0,
     ) -> None:
         """Register a service instance and its routes in the service registry."""
         await self.registry.register_service(
@@ -161,8 +183,122 @@ class GatewayController:
             instance_id=instance_id,
             address=address,
             routes=routes,
+            shadow=shadow,
+            mirror_percent=mirror_percent,
         )
 
+    async def _start_mirroring(
+        self,
+        service_name: str,
+        method: str,
+        internal_path: str,
+        headers: Dict[str, str],
+        params: Dict[str, Any] | None,
+        data: Any,
+    ) -> asyncio.Future | None:
+        """Mirrors the request to the service's shadow instances, each with
+        its configured probability.
+
+        Returns a future that the caller must resolve with the primary's
+        ``(status_code, latency_ms)`` so mirrors can compare against it, or
+        ``None`` if the request is not mirrored.
+        """
+        if method not in SHADOW_MIRROR_METHODS:
+            return None
+
+        shadows = [
+            shadow
+            for shadow in await self._get_shadow_instances(service_name)
+            if random.uniform(0, 100) < float(shadow.get("mirror_percent", 0))
+        ]
+        if not shadows:
+            return None
+
+        primary_outcome = asyncio.get_running_loop().create_future()
+        for shadow in shadows:
+            task = asyncio.create_task(
+                self._mirror_request(
+                    service_name,
+                    shadow,
+                    method,
+                    internal_path,
+                    dict(headers),
+                    params,
+                    data,
+                    primary_outcome,
+                )
+            )
+            _mirror_tasks.add(task)
+            task.add_done_callback(_mirror_tasks.discard)
+        return primary_outcome
+
+    async def _get_shadow_instances(self, service_name: str) -> list[dict]:
+        """Returns the alive shadow instances of the service, looking them
+        up in the registry at most once every SHADOW_CACHE_TTL seconds."""
+        cached = _shadow_cache.get(service_name)
+        if cached is not None and time.monotonic() - cached[0] < SHADOW_CACHE_TTL:
+            return cached[1]
+
+        shadows = await self.registry.list_shadow_instances(service_name)
+        _shadow_cache[service_name] = (time.monotonic(), shadows)
+        return shadows
+
+    async def _mirror_request(
+        self,
+        service_name: str,
+        shadow: Dict[str, Any],
+        method: str,
+        internal_path: str,
+        headers: Dict[str, str],
+        params: Dict[str, Any] | None,
+        data: Any,
+        primary_outcome: asyncio.Future,
+    ) -> None:
+        """Sends a copy of the request to a shadow instance, discards the
+        response and records how it compares to the primary."""
+        url = f"{shadow['address']}{internal_path}"
+        start = time.perf_counter()
+        try:
+            async with httpx.AsyncClient(timeout=SHADOW_TIMEOUT) as client:
+                r = await client.request(
+                    method,
+                    url,
+                    headers=headers,
+                    params=params or {},
+                    data=data,
+                    follow_redirects=False,
+                )
+                shadow_status = r.status_code
+        except httpx.TimeoutException:
+            shadow_status = 504
+        except httpx.RequestError as e:
+            log.warning(f"Mirroring to shadow {shadow['instance_id']} failed: {e}")
+            shadow_status = 502
+        shadow_latency_ms = (time.perf_counter() - start) * 1000
+
+        try:
+            primary_status, primary_latency_ms = await asyncio.wait_for(
+                asyncio.shield(primary_outcome), timeout=SHADOW_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            return
+
+        if primary_status != shadow_status:
+            log.info(
+                f"Shadow {shadow['instance_id']} of {service_name} returned {shadow_status} "
+                f"for {method} {internal_path}, primary returned {primary_status}"
+            )
+        try:
+            await self.registry.record_shadow_result(
+                service_name,
+                primary_status,
+                shadow_status,
+                primary_latency_ms,
+                shadow_latency_ms,
+            )
+        except Exception as e:
+            log.warning(f"Could not record shadow result for {service_name}: {e}")
+
     async def forward(
         self,
         method: str,
@@ -249,6 +385,17 @@ class GatewayController:
         if role:
             headers["X-User-Role"] = str(role)
 
+        try:
+            primary_outcome = await self._start_mirroring(
+                service_name, method, internal_path, headers, params, data
+            )
+        except Exception as e:
+            # Mirroring is best effort and must never affect live traffic
+            log.warning(f"Could not start mirroring for {service_name}: {e}")
+            primary_outcome = None
+
+        status_code = 502
+        start = time.perf_counter()
         try:
             async with httpx.AsyncClient(timeout=190.0) as client:
                 r = await client.request(
@@ -267,9 +414,16 @@ class GatewayController:
                 except Exception:
                     body = r.text
                     log.error(f"Forwarding error [httpx int Exception]: {body}")
+                status_code = r.status_code
                 return r.status_code, body
         except httpx.TimeoutException:
+            status_code = 504
             return 504, {"detail": "Gateway timeout"}
         except httpx.RequestError as e:
             log.error(f"Forwarding error [RequestError]: {e}")
             return 502, {"detail": "Bad gateway"}
+        finally:
+            if primary_outcome is not None:
+                primary_outcome.set_result(
+                    (status_code, (time.perf_counter() - start) * 1000)
+                )
@@ -2,20 +2,24 @@ from typing import Any, Optional
 
 import redis.asyncio as aioredis
 import requests
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 from routes.auth_router import router as auth_router
+from routes.dynamic_router import auth_user
 from routes.dynamic_router import router as dynamic_router
 from routes.registry_router import router as registry_router
 from routes.websocket_router import router as websocket_router
-from service.redis_settings import get_redis, lifespan
+from service.redis_batcher import AutoBatchingRedis
+from service.redis_settings import get_batched_redis, get_redis, lifespan
 from utils.logger import log
 from utils.utils import get_envvar
 
 FRONT_END_URL = get_envvar("FRONT_END_URL")
 
+ADMIN_ROLE = "admin"
+
 app = FastAPI(title="API Gateway", lifespan=lifespan)
 
 app.include_router(auth_router)
@@ -29,6 +33,20 @@ async def root():
     return {"status": "Gateway working"}
 
 
+async def require_admin(user_data: dict = Depends(auth_user)) -> dict:
+    """Allows only admins through, as the services do for routes whose
+    ``x-roles`` only list the admin role."""
+    if user_data.get("role") != ADMIN_ROLE:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return user_data
+
+
+@app.get("/stats/redis_batching", dependencies=[Depends(require_admin)])
+async def redis_batching_stats(r: AutoBatchingRedis = Depends(get_batched_redis)):
+    """Reports how many Redis commands were coalesced into shared round trips."""
+    return r.metrics.snapshot()
+
+
 if get_envvar("ENVIRONMENT") == "DEV":
     # --- Redis Debugging Endpoints
     @app.get("/print-all")
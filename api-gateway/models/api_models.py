@@ -25,12 +25,19 @@ class RegisterServicePayload(BaseModel):
         instance_id (str): Identifier for this instance (e.g. host:port).
         address (str): Host:port the gateway should forward to.
         routes (list[RoutePayload]): Routes exposed by this service.
+        shadow (bool): Whether this instance is a shadow (canary) instance that
+            only receives mirrored traffic.
+        mirror_percent (float): Percentage of the service's requests mirrored to
+            this instance when it is a shadow.
     """
     service_name: Annotated[str, Field(description="Unique name of the service", examples=["qs"])]
     instance_id: Annotated[str, Field(description="Identifier for this instance",
                                       examples=["b4a937a3-992d-46b8-946b-6d900c1e8134"])]
     address: Annotated[str, Field(description="Host:port the gateway should forward to", examples=["localhost:8001"])]
     routes: Annotated[list[RoutePayload], Field(description="Routes exposed by this service")]
+    shadow: Annotated[bool, Field(description="Whether this instance only receives mirrored traffic")] = False
+    mirror_percent: Annotated[float, Field(ge=0, le=100,
+                                           description="Percentage of requests mirrored to this shadow instance")] = 0
 
 
 class RegisterOpenApiPayload(BaseModel):
@@ -46,6 +53,10 @@ class RegisterOpenApiPayload(BaseModel):
         instance_id (str): Identifier for this instance (e.g. host:port).
         address (str): Host:port the gateway should forward to.
         openapi (dict): The OpenAPI specification as a JSON object.
+        shadow (bool): Whether this instance is a shadow (canary) instance that
+            only receives mirrored traffic.
+        mirror_percent (float): Percentage of the service's requests mirrored to
+            this instance when it is a shadow.
     """
     service_name: Annotated[str, Field(description="Unique name of the service", examples=["qs"])]
     instance_id: Annotated[str, Field(description="Identifier for this instance",
@@ -54,6 +65,9 @@ class RegisterOpenApiPayload(BaseModel):
     openapi: Annotated[
         dict, Field(description="The OpenAPI specification as a JSON object")
     ]
+    shadow: Annotated[bool, Field(description="Whether this instance only receives mirrored traffic")] = False
+    mirror_percent: Annotated[float, Field(ge=0, le=100,
+                                           description="Percentage of requests mirrored to this shadow instance")] = 0
 
     @field_validator("openapi")
     @classmethod
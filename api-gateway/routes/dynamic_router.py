@@ -7,18 +7,57 @@ This router must be included after all other routers so that specific
 routes defined elsewhere take precedence.
 """
 
+import asyncio
+import time
+from collections.abc import Awaitable
+from typing import Any
 from uuid import uuid4
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 from controllers.gateway_controller import GatewayController
 from service.cookie_management import extend_access_token_cookie
 from service.redis_settings import get_gateway
+from service.traffic_capture import traffic_recorder
 from utils.logger import log
 
 router = APIRouter(include_in_schema=False)
 
+# Seconds between checks of whether the client of a forwarded request is still there
+DISCONNECT_POLL_INTERVAL = 1.0
+# Status recorded for requests whose client left before the response, as nginx does
+CLIENT_CLOSED_REQUEST = 499
+
+
+async def forward_while_connected(
+    request: Request, forwarding: Awaitable[tuple[int, Any]]
+) -> tuple[int, Any] | None:
+    """Runs the forwarding coroutine until it completes or the client
+    disconnects. On a disconnect the upstream request is cancelled, which
+    closes its connection so the service sees the client leave as well.
+
+    Returns:
+        The status code and body of the response, or None if the client
+        disconnected first.
+    """
+    task = asyncio.ensure_future(forwarding)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return None
+    finally:
+        # The handler itself was cancelled, such as when the gateway shuts down
+        if not task.done():
+            task.cancel()
 
 
 async def auth_user(
@@ -61,6 +100,8 @@ async def dynamic_forward(
     cannot resolve the path to a service, a 404 error is returned.
     """
     request_id = uuid4()
+    started_at = time.time()
+    start = time.perf_counter()
     method = request.method
     log.info(
         f"{request_id} [DYNAMIC_FORWARD]  HOST: {request.client.host} Incoming request: {method} /{path}"
@@ -73,10 +114,24 @@ async def dynamic_forward(
 
     body = await request.body()
 
+    # Recorded for requests that end without a response, such as when the handler is
+    # cancelled
+    code = 500
     try:
-        code, data = await gateway.forward(
-            method, "/" + path, data=body, user_data=user_data,params=params
+        result = await forward_while_connected(
+            request,
+            gateway.forward(
+                method, "/" + path, data=body, user_data=user_data, params=params
+            ),
         )
+        if result is None:
+            log.info(
+                f"{request_id} [DYNAMIC_FORWARD] Client disconnected, "
+                "cancelled the upstream request"
+            )
+            code = CLIENT_CLOSED_REQUEST
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+        code, data = result
 
     except Exception as e:
         log.error(
@@ -84,6 +139,19 @@ async def dynamic_forward(
             exc_info=True,
         )
         raise
+    finally:
+        traffic_recorder.record(
+            request_id=str(request_id),
+            method=method,
+            path="/" + path,
+            params=params,
+            headers=headers,
+            body=body,
+            user_data=user_data,
+            status_code=code,
+            latency_ms=(time.perf_counter() - start) * 1000,
+            started_at=started_at,
+        )
 
     if not (200 <= code < 300):
         log.warning(f"{request_id} [DYNAMIC_FORWARD] Non-success status code: {code}")
@@ -29,6 +29,8 @@ async def register_service(
             instance_id=payload.instance_id,
             address=payload.address,
             routes=payload.routes,
+            shadow=payload.shadow,
+            mirror_percent=payload.mirror_percent,
         )
         return {"detail": "Service registered"}
     except Exception as e:
@@ -72,6 +74,8 @@ async def register_openapi(
             instance_id=payload.instance_id,
             address=payload.address,
             routes=route_defs,
+            shadow=payload.shadow,
+            mirror_percent=payload.mirror_percent,
         )
         return {"detail": "Service registered from OpenAPI"}
     except Exception as e:
@@ -108,3 +112,35 @@ async def deregister(
         return {"detail": "Service deregistered"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/shadow/{service_name}")
+async def shadow_stats(
+    service_name: str,
+    gateway: GatewayController = Depends(get_gateway),
+):
+    """Compare the shadow instances of a service against its primaries.
+
+    Returns the number of mirrored requests, how many returned a different
+    status code than the primary, and the average latency of both sides.
+    """
+    try:
+        shadows = await gateway.registry.list_shadow_instances(service_name)
+        stats = await gateway.registry.get_shadow_stats(service_name)
+        return {"shadow_instances": shadows, "stats": stats}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.delete("/shadow/{service_name}")
+async def reset_shadow_stats(
+    service_name: str,
+    gateway: GatewayController = Depends(get_gateway),
+):
+    """Reset the mirrored traffic comparison of a service, e.g. before
+    evaluating a newly deployed shadow build."""
+    try:
+        await gateway.registry.reset_shadow_stats(service_name)
+        return {"detail": "Shadow stats reset"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -78,6 +78,57 @@ async def collab_websocket_endpoint(
         log.info("Collab service disconnected")
 
 
+@router.websocket("/ws/ms")
+async def matching_websocket_endpoint(
+    websocket: WebSocket,
+    instance_id: str = Query(""),
+    redis: aioredis.Redis = Depends(get_redis),
+):
+    """WebSocket endpoint for Matching service instances to push match events to FE"""
+    connection_id = f"ms:{instance_id}"
+    client_url = f"{websocket.client.host}:{websocket.client.port}"
+    log.info(f"Attempting to connect Matching service {instance_id} from: {client_url}")
+
+    await redis.hset(
+        f"websocket:{connection_id}",
+        mapping={
+            "url": client_url,
+            "type": "ms",
+        },
+    )
+
+    await manager.connect(websocket, connection_id)
+    log.info(f"Matching service {instance_id} connected from: {client_url}")
+
+    try:
+        while True:
+            data = await websocket.receive_text()
+            log.info(f"Received from Matching service {instance_id}: {data}")
+
+            try:
+                message_data = json.loads(data)
+            except json.JSONDecodeError:
+                log.error(f"Invalid JSON received from Matching service: {data}")
+                continue
+
+            user_id = message_data.get("user_id")
+            if not user_id:
+                log.error(f"Match event without a target user: {data}")
+                continue
+
+            # Match events carry extra fields (ticket, partner name), so forward them as is
+            try:
+                await manager.send_to_fe(user_id, json.dumps(message_data))
+            except Exception:
+                # The user can still pick the event up from the matching status endpoint
+                continue
+
+    except WebSocketDisconnect:
+        manager.disconnect(connection_id)
+        await redis.delete(f"websocket:{connection_id}")
+        log.info(f"Matching service {instance_id} disconnected")
+
+
 @router.websocket("/ws/fe")
 async def fe_websocket_endpoint(
     websocket: WebSocket,
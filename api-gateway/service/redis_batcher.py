@@ -0,0 +1,125 @@
+import asyncio
+from typing import Any
+
+from redis.asyncio import Redis
+
+from utils.logger import log
+
+# api-gateway, matching-svc and collaboration-svc share no package, so each has a copy of this module.
+# Keep the three copies identical.
+
+# Cheap, non-blocking commands that are safe to coalesce into one pipeline
+BATCHED_COMMANDS = frozenset({
+    "get",
+    "hget",
+    "hmget",
+    "hgetall",
+    "hexists",
+    "exists",
+    "ttl",
+    "llen",
+    "lpos",
+    "zscore",
+    "zcard",
+})
+
+
+class BatchMetrics:
+    """
+    Counts how well the commands are being coalesced.
+    """
+
+    def __init__(self) -> None:
+        self.commands = 0
+        self.round_trips = 0
+        self.max_batch_size = 0
+        self.errors = 0
+
+    def record_batch(self, size: int) -> None:
+        self.commands += size
+        self.round_trips += 1
+        self.max_batch_size = max(self.max_batch_size, size)
+
+    def snapshot(self) -> dict:
+        return {
+            "commands": self.commands,
+            "round_trips": self.round_trips,
+            "round_trips_saved": self.commands - self.round_trips,
+            "avg_batch_size": (
+                self.commands / self.round_trips if self.round_trips else 0.0
+            ),
+            "max_batch_size": self.max_batch_size,
+            "errors": self.errors,
+        }
+
+
+class AutoBatchingRedis:
+    """
+    Wraps a redis client, coalescing the small reads issued in the same event loop tick into one pipeline.\n
+    Sent one by one, each read of many concurrent requests costs a full round trip. Only the commands in
+    BATCHED_COMMANDS are queued, every other attribute such as pipelines, locks, scripts and blocking commands
+    is delegated to the wrapped client, so the wrapper is a drop-in replacement for it.\n
+    Queued commands are flushed at the end of the tick, or once max_batch_size of them are queued.
+    """
+
+    def __init__(self, redis: Redis, max_batch_size: int = 512) -> None:
+        self.redis = redis
+        self.max_batch_size = max_batch_size
+        self.metrics = BatchMetrics()
+        self._pending: list[tuple[str, tuple, dict, asyncio.Future]] = []
+        self._flush_handle: asyncio.Handle | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+    def __getattr__(self, name: str) -> Any:
+        if name in BATCHED_COMMANDS:
+            return lambda *args, **kwargs: self._enqueue(name, args, kwargs)
+        return getattr(self.redis, name)
+
+    def _enqueue(self, command: str, args: tuple, kwargs: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((command, args, kwargs, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            # Runs after every callback already queued for this tick
+            self._flush_handle = loop.call_soon(self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._execute(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, batch: list[tuple[str, tuple, dict, asyncio.Future]]):
+        self.metrics.record_batch(len(batch))
+        try:
+            if len(batch) == 1:
+                command, args, kwargs, _ = batch[0]
+                results = [await getattr(self.redis, command)(*args, **kwargs)]
+            else:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for command, args, kwargs, _ in batch:
+                        getattr(pipe, command)(*args, **kwargs)
+                    results = await pipe.execute(raise_on_error=False)
+        except Exception as e:  # noqa: BLE001
+            self.metrics.errors += 1
+            log.warning(f"Batched Redis round trip of {len(batch)} commands failed: {e}")
+            results = [e] * len(batch)
+
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -4,6 +4,8 @@ import redis.asyncio as aioredis
 from fastapi import Depends, FastAPI
 
 from controllers.gateway_controller import GatewayController
+from service.redis_batcher import AutoBatchingRedis
+from service.traffic_capture import traffic_recorder
 from utils.logger import log
 from utils.utils import get_envvar
 
@@ -16,12 +18,13 @@ RR_TTL = int(get_envvar("RR_TTL"))
 
 # Singletons bound during app lifespan
 _redis: aioredis.Redis
+_batched_redis: AutoBatchingRedis
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # On Startup
-    global _redis
+    global _redis, _batched_redis
     _redis = await aioredis.from_url(
         f"{REDIS_URL}",
         decode_responses=True,
@@ -29,9 +32,12 @@ async def lifespan(app: FastAPI):
         health_check_interval=5,
     )
     await _redis.ping()
+    _batched_redis = AutoBatchingRedis(_redis)
     log.info("Connected to Redis")
+    traffic_recorder.start()
     yield
     # On Shutdown
+    traffic_recorder.stop()
     if _redis:
         await _redis.close()
         log.info("Redis connection closed")
@@ -42,8 +48,15 @@ async def get_redis() -> aioredis.Redis:
     return _redis
 
 
+async def get_batched_redis() -> AutoBatchingRedis:
+    """Returns the shared client that coalesces small commands issued by
+    concurrent requests into single round trips."""
+    assert _batched_redis is not None, "Redis not initialized"
+    return _batched_redis
+
+
 async def get_gateway(
-    redis: aioredis.Redis = Depends(get_redis),
+    redis: AutoBatchingRedis = Depends(get_batched_redis),
 ) -> GatewayController:
     return GatewayController(
         redis=redis,
@@ -28,15 +28,23 @@ used:
 * ``gw:service:<service_name>:instances`` – a hash of live instances
   for the service.  The field name is an instance identifier, and the
   value is a JSON string containing any metadata about the instance.
+  Instances registered with ``shadow`` set are never chosen for live
+  traffic; they only receive mirrored requests, and their routes are
+  not written to the route hashes so a canary build cannot change how
+  live traffic is routed.
 * ``gw:service:<service_name>:instance:<instance_id>:heartbeat`` – a
   simple key (string) with a TTL.  The presence of this key indicates
   that the corresponding instance is healthy; services should renew
   this key on a periodic basis.  When the TTL expires, the registry
   considers the instance dead.
+* ``gw:shadow:<service_name>:stats`` – a hash of counters comparing
+  mirrored requests against the primary responses (request count,
+  status mismatches and summed latencies of both sides).
 """
 
 from __future__ import annotations
 
+import asyncio
 import json
 import random
 import re
@@ -57,6 +65,7 @@ class ServiceRegistry:
     SERVICE_ROUTES_KEY = "gw:service:{service_name}:routes"
     SERVICE_INSTANCES_KEY = "gw:service:{service_name}:instances"
     HEARTBEAT_KEY = "gw:service:{service_name}:instance:{instance_id}:heartbeat"
+    SHADOW_STATS_KEY = "gw:shadow:{service_name}:stats"
 
     def __init__(
         self, redis: aioredis.Redis, heartbeat_ttl: int = 30, rr_ttl: int = 3600
@@ -80,12 +89,16 @@ class ServiceRegistry:
         instance_id: str,
         address: str,
         routes: Iterable[RoutePayload],
+        shadow: bool = False,
+        mirror_percent: float = 0,
     ) -> None:
         """Register a service instance and its routes in Redis.
 
         This stores the instance information, route definitions, and
         updates the global route map. If a route already exists for
         the service, it will be overwritten with the new definition.
+        Shadow instances only store their instance information, as they
+        receive requests on the routes of the live instances.
 
         Args:
             service_name: Unique name of the microservice.
@@ -94,10 +107,16 @@ class ServiceRegistry:
                 when forwarding requests.
             routes: An iterable of RouteDefinition objects describing
                 each exposed route.
+            shadow: Whether the instance only receives mirrored traffic.
+            mirror_percent: Percentage of requests mirrored to a shadow
+                instance.
         """
         # Store instance metadata
         inst_key = self.SERVICE_INSTANCES_KEY.format(service_name=service_name)
-        await self.redis.hset(inst_key, instance_id, json.dumps({"address": address}))
+        meta = {"address": address}
+        if shadow:
+            meta.update({"shadow": True, "mirror_percent": mirror_percent})
+        await self.redis.hset(inst_key, instance_id, json.dumps(meta))
 
         # Write or refresh heartbeat key
         hb_key = self.HEARTBEAT_KEY.format(
@@ -105,6 +124,9 @@ class ServiceRegistry:
         )
         await self.redis.set(hb_key, "1", ex=self.heartbeat_ttl)
 
+        if shadow:
+            return
+
         # Store each route in the service routes hash and global map
         svc_routes_key = self.SERVICE_ROUTES_KEY.format(service_name=service_name)
         async with self.redis.pipeline(transaction=True) as pipe:
@@ -185,24 +207,99 @@ class ServiceRegistry:
             return None
         return RouteDefinition.from_json(data)
 
-    async def list_instances(self, service_name: str) -> List[str]:
-        """Return a list of alive instance addresses for a service."""
+    async def _list_alive_instances(self, service_name: str) -> List[dict]:
+        """Return the metadata of every alive instance of a service,
+        including shadow instances. Each entry carries its ``instance_id``."""
         inst_key = self.SERVICE_INSTANCES_KEY.format(service_name=service_name)
         instances = await self.redis.hgetall(inst_key)
-        alive: List[str] = []
-        for instance_id, meta_json in instances.items():
-            hb_key = self.HEARTBEAT_KEY.format(
-                service_name=service_name, instance_id=instance_id
+        # Check heartbeat existence concurrently so the checks can share a
+        # single round trip when the client batches commands
+        heartbeats = await asyncio.gather(*(
+            self.redis.exists(
+                self.HEARTBEAT_KEY.format(
+                    service_name=service_name, instance_id=instance_id
+                )
             )
-            # Check heartbeat existence
-            if await self.redis.exists(hb_key):
+            for instance_id in instances
+        ))
+        alive: List[dict] = []
+        for (instance_id, meta_json), is_alive in zip(instances.items(), heartbeats):
+            if is_alive:
                 try:
                     meta = json.loads(meta_json)
-                    alive.append(meta.get("address"))
+                    meta["instance_id"] = instance_id
+                    alive.append(meta)
                 except Exception:
                     continue
         return alive
 
+    async def list_instances(self, service_name: str) -> List[str]:
+        """Return a list of alive instance addresses for a service.
+
+        Shadow instances are excluded so they never receive live traffic.
+        """
+        instances = await self._list_alive_instances(service_name)
+        return [meta.get("address") for meta in instances if not meta.get("shadow")]
+
+    async def list_shadow_instances(self, service_name: str) -> List[dict]:
+        """Return the metadata of alive shadow instances for a service."""
+        instances = await self._list_alive_instances(service_name)
+        return [meta for meta in instances if meta.get("shadow")]
+
+    async def record_shadow_result(
+        self,
+        service_name: str,
+        primary_status: int,
+        shadow_status: int,
+        primary_latency_ms: float,
+        shadow_latency_ms: float,
+    ) -> None:
+        """Accumulate the comparison of a mirrored request against its primary.
+
+        Args:
+            service_name: Name of the service the request was addressed to.
+            primary_status: Status code returned by the primary instance.
+            shadow_status: Status code returned by the shadow instance.
+            primary_latency_ms: Latency of the primary request.
+            shadow_latency_ms: Latency of the mirrored request.
+        """
+        stats_key = self.SHADOW_STATS_KEY.format(service_name=service_name)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await pipe.hincrby(stats_key, "requests", 1)
+            await pipe.hincrby(
+                stats_key, "status_mismatch", int(primary_status != shadow_status)
+            )
+            await pipe.hincrby(stats_key, "shadow_errors", int(shadow_status >= 500))
+            await pipe.hincrbyfloat(stats_key, "primary_latency_ms", primary_latency_ms)
+            await pipe.hincrbyfloat(stats_key, "shadow_latency_ms", shadow_latency_ms)
+            await pipe.execute()
+
+    async def get_shadow_stats(self, service_name: str) -> dict:
+        """Return the mirrored traffic comparison for a service, including
+        the average latency of the primary and shadow instances."""
+        stats_key = self.SHADOW_STATS_KEY.format(service_name=service_name)
+        raw = await self.redis.hgetall(stats_key)
+        requests = int(raw.get("requests", 0))
+        stats = {
+            "requests": requests,
+            "status_mismatch": int(raw.get("status_mismatch", 0)),
+            "shadow_errors": int(raw.get("shadow_errors", 0)),
+            "avg_primary_latency_ms": 0.0,
+            "avg_shadow_latency_ms": 0.0,
+        }
+        if requests:
+            stats["avg_primary_latency_ms"] = (
+                float(raw.get("primary_latency_ms", 0)) / requests
+            )
+            stats["avg_shadow_latency_ms"] = (
+                float(raw.get("shadow_latency_ms", 0)) / requests
+            )
+        return stats
+
+    async def reset_shadow_stats(self, service_name: str) -> None:
+        """Clear the mirrored traffic comparison for a service."""
+        await self.redis.delete(self.SHADOW_STATS_KEY.format(service_name=service_name))
+
     async def choose_instance(self, service_name: str) -> Optional[str]:
         """Choose one alive instance to handle a request using Redis‑based round-robin.
 
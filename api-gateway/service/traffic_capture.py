@@ -0,0 +1,240 @@
+"""Opt-in traffic capture for the API gateway.
+
+When ``TRAFFIC_CAPTURE_ENABLED`` is ``true``, every request handled by the
+dynamic router is appended as one JSON line to a capture file. The capture
+is meant to be replayed later with ``tools/replay_traffic.py`` so that load
+tests can reproduce real arrival patterns (e.g. bursts of matching requests
+followed by collaboration traffic) instead of synthetic ones.
+
+Records are sanitised before they are written:
+
+* Only an allow-list of request headers is kept, so cookies and
+  authorization headers never reach the capture.
+* Secret body fields (passwords, tokens) are masked and identifying
+  fields (user ids, emails, usernames) are replaced by pseudonyms.
+* The authenticated user is stored as a keyed HMAC pseudonym. Using the
+  same ``TRAFFIC_CAPTURE_SALT`` keeps pseudonyms stable across restarts;
+  without it a random salt is generated per process.
+
+File writes happen on a background thread through a ``QueueListener`` so
+the event loop never blocks on disk I/O. The active file rotates once it
+reaches ``TRAFFIC_CAPTURE_MAX_BYTES`` and rotated segments are gzipped.
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import secrets
+import shutil
+from typing import Any, Optional
+
+from utils.logger import log
+from utils.utils import get_envvar
+
+TRAFFIC_CAPTURE_ENABLED = (
+    get_envvar("TRAFFIC_CAPTURE_ENABLED", "false").lower() == "true"
+)
+TRAFFIC_CAPTURE_DIR = get_envvar("TRAFFIC_CAPTURE_DIR", "./captures")
+TRAFFIC_CAPTURE_MAX_BYTES = int(get_envvar("TRAFFIC_CAPTURE_MAX_BYTES", "52428800"))
+TRAFFIC_CAPTURE_BACKUP_COUNT = int(get_envvar("TRAFFIC_CAPTURE_BACKUP_COUNT", "20"))
+TRAFFIC_CAPTURE_MAX_BODY_BYTES = int(
+    get_envvar("TRAFFIC_CAPTURE_MAX_BODY_BYTES", "65536")
+)
+TRAFFIC_CAPTURE_SALT = get_envvar("TRAFFIC_CAPTURE_SALT", "")
+
+# Headers that are safe to keep and useful when replaying a request
+CAPTURED_HEADERS = {"accept", "content-type", "user-agent"}
+
+# Body fields whose values are masked entirely
+MASKED_FIELDS = {
+    "password",
+    "new_password",
+    "old_password",
+    "confirm_password",
+    "token",
+    "access_token",
+    "refresh_token",
+    "secret",
+    "otp",
+}
+
+# Body fields whose values are replaced with a stable pseudonym
+PSEUDONYMISED_FIELDS = {"user_id", "email", "username", "users"}
+
+MASK = "***"
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    """Compresses a rotated capture segment and removes the original."""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _gzip_namer(name: str) -> str:
+    return f"{name}.gz"
+
+
+class TrafficRecorder:
+    """Writes sanitised request records to a rotating, compressed capture file."""
+
+    def __init__(
+        self,
+        enabled: bool,
+        capture_dir: str,
+        max_bytes: int,
+        backup_count: int,
+        max_body_bytes: int,
+        salt: str = "",
+    ) -> None:
+        self.enabled = enabled
+        self.capture_dir = capture_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_body_bytes = max_body_bytes
+        self._salt = (salt or secrets.token_hex(16)).encode()
+        self._logger: Optional[logging.Logger] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        """Opens the capture file and starts the background writer."""
+        if not self.enabled or self._listener is not None:
+            return
+
+        os.makedirs(self.capture_dir, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(self.capture_dir, "traffic.jsonl"),
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count,
+            encoding="utf-8",
+        )
+        file_handler.rotator = _gzip_rotator
+        file_handler.namer = _gzip_namer
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        record_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._logger = logging.getLogger("traffic-capture")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(logging.handlers.QueueHandler(record_queue))
+
+        self._listener = logging.handlers.QueueListener(record_queue, file_handler)
+        self._listener.start()
+        log.info(f"Traffic capture enabled, writing to {self.capture_dir}")
+
+    def stop(self) -> None:
+        """Flushes pending records and closes the capture file."""
+        if self._listener is None:
+            return
+
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._logger.handlers.clear()
+        self._listener = None
+        log.info("Traffic capture stopped")
+
+    def pseudonymise(self, value: Any) -> str:
+        """Returns a stable, non-reversible pseudonym for the given value."""
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256)
+        return digest.hexdigest()[:16]
+
+    def _sanitise_value(self, key: str, value: Any) -> Any:
+        if key in MASKED_FIELDS:
+            return MASK
+        if key in PSEUDONYMISED_FIELDS:
+            if isinstance(value, list):
+                return [self.pseudonymise(v) for v in value]
+            return self.pseudonymise(value) if value is not None else None
+        return self._sanitise_json(value)
+
+    def _sanitise_json(self, data: Any) -> Any:
+        if isinstance(data, dict):
+            return {k: self._sanitise_value(k.lower(), v) for k, v in data.items()}
+        if isinstance(data, list):
+            return [self._sanitise_json(item) for item in data]
+        return data
+
+    def _sanitise_body(self, body: bytes) -> dict:
+        """Parses and sanitises a request body.
+
+        Non-JSON and oversized bodies are not stored; only their size is kept
+        so the replay can still account for them.
+        """
+        if not body:
+            return {"body": None, "body_bytes": 0}
+        if len(body) > self.max_body_bytes:
+            return {"body": None, "body_bytes": len(body), "body_omitted": True}
+        try:
+            parsed = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return {"body": None, "body_bytes": len(body), "body_omitted": True}
+        return {"body": self._sanitise_json(parsed), "body_bytes": len(body)}
+
+    def record(
+        self,
+        *,
+        request_id: str,
+        method: str,
+        path: str,
+        params: dict[str, Any],
+        headers: dict[str, str],
+        body: bytes,
+        user_data: dict[str, Any],
+        status_code: int,
+        latency_ms: float,
+        started_at: float,
+    ) -> None:
+        """Sanitises a handled request and queues it for writing.
+
+        Args:
+            request_id: Identifier assigned to the request by the gateway.
+            method: HTTP method of the request.
+            path: Request path as received by the gateway.
+            params: Query parameters of the request.
+            headers: Raw request headers, filtered before writing.
+            body: Raw request body.
+            user_data: Data of the authenticated user, if any.
+            status_code: Status code returned to the client.
+            latency_ms: Time taken by the gateway to handle the request.
+            started_at: Wall-clock epoch seconds at which the request arrived.
+        """
+        if not self.enabled or self._logger is None:
+            return
+
+        try:
+            user_id = user_data.get("user_id")
+            entry = {
+                "request_id": request_id,
+                "ts": started_at,
+                "method": method,
+                "path": path,
+                "params": self._sanitise_json(params),
+                "headers": {
+                    k: v for k, v in headers.items() if k.lower() in CAPTURED_HEADERS
+                },
+                **self._sanitise_body(body),
+                "user": self.pseudonymise(user_id) if user_id else None,
+                "role": user_data.get("role"),
+                "status": status_code,
+                "latency_ms": round(latency_ms, 3),
+            }
+            self._logger.info(json.dumps(entry, separators=(",", ":")))
+        except Exception as e:
+            # Capturing must never affect the request being served
+            log.warning(f"Traffic capture failed for request {request_id}: {e}")
+
+
+traffic_recorder = TrafficRecorder(
+    enabled=TRAFFIC_CAPTURE_ENABLED,
+    capture_dir=TRAFFIC_CAPTURE_DIR,
+    max_bytes=TRAFFIC_CAPTURE_MAX_BYTES,
+    backup_count=TRAFFIC_CAPTURE_BACKUP_COUNT,
+    max_body_bytes=TRAFFIC_CAPTURE_MAX_BODY_BYTES,
+    salt=TRAFFIC_CAPTURE_SALT,
+)
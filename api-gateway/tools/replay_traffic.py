@@ -0,0 +1,219 @@
+"""Replays a gateway traffic capture and reports latency distributions.
+
+The capture is produced by ``service/traffic_capture.py``. Requests are sent
+open-loop: each one is fired at its original offset from the start of the
+capture (divided by ``--speed``), regardless of whether earlier requests have
+completed, so bursts in the capture stay bursts in the replay.
+
+Captured requests only carry user pseudonyms. To replay authenticated traffic,
+pass ``--tokens`` with a JSON object mapping pseudonyms to access tokens of
+test accounts; requests from unmapped users are sent without a cookie.
+
+Usage:
+    uv run python tools/replay_traffic.py captures/traffic.jsonl* \\
+        --target http://localhost:8000 --speed 2
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import time
+from collections import Counter, defaultdict
+from typing import Iterable
+
+import httpx
+
+
+def load_capture(paths: Iterable[str]) -> list[dict]:
+    """Loads capture records from plain or gzipped JSON-lines files,
+    ordered by their original arrival time."""
+    records = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarise(latencies: list[float]) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50": percentile(ordered, 50),
+        "p90": percentile(ordered, 90),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1] if ordered else 0.0,
+    }
+
+
+class Replayer:
+    """Sends captured requests to a gateway and collects the results."""
+
+    def __init__(
+        self,
+        target: str,
+        speed: float,
+        tokens: dict[str, str],
+        timeout: float,
+        skip_unauthenticated: bool,
+    ) -> None:
+        self.target = target.rstrip("/")
+        self.speed = speed
+        self.tokens = tokens
+        self.timeout = timeout
+        self.skip_unauthenticated = skip_unauthenticated
+        self.results: list[dict] = []
+
+    async def _send(self, client: httpx.AsyncClient, record: dict) -> None:
+        cookies = {}
+        user = record.get("user")
+        if user and user in self.tokens:
+            cookies["access_token"] = self.tokens[user]
+
+        content = None
+        if record.get("body") is not None:
+            content = json.dumps(record["body"])
+
+        start = time.perf_counter()
+        try:
+            response = await client.request(
+                record["method"],
+                f"{self.target}{record['path']}",
+                params=record.get("params") or None,
+                headers=record.get("headers") or None,
+                cookies=cookies or None,
+                content=content,
+            )
+            status = response.status_code
+        except httpx.TimeoutException:
+            status = "timeout"
+        except httpx.RequestError as e:
+            status = type(e).__name__
+
+        self.results.append({
+            "route": f"{record['method']} {record['path']}",
+            "status": status,
+            "latency_ms": (time.perf_counter() - start) * 1000,
+            "captured_status": record.get("status"),
+            "captured_latency_ms": record.get("latency_ms"),
+        })
+
+    async def run(self, records: list[dict]) -> None:
+        if self.skip_unauthenticated:
+            records = [
+                r for r in records if not r.get("user") or r["user"] in self.tokens
+            ]
+        if not records:
+            return
+
+        origin = records[0]["ts"]
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=200)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            start = time.perf_counter()
+            tasks = []
+            for record in records:
+                due = (record["ts"] - origin) / self.speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self._send(client, record)))
+            await asyncio.gather(*tasks)
+
+
+def print_report(results: list[dict], elapsed: float) -> None:
+    print(f"Replayed {len(results)} requests in {elapsed:.1f}s")
+
+    statuses = Counter(str(r["status"]) for r in results)
+    print("Status codes: " + ", ".join(f"{k}={v}" for k, v in sorted(statuses.items())))
+    mismatched = sum(
+        1 for r in results if r["captured_status"] not in (None, r["status"])
+    )
+    print(f"Status differs from capture: {mismatched}")
+
+    header = f"{'route':<50} {'count':>6} {'p50':>9} {'p90':>9} {'p95':>9} {'p99':>9} {'max':>9} {'cap p50':>9}"
+    print()
+    print(header)
+    print("-" * len(header))
+
+    by_route = defaultdict(list)
+    for r in results:
+        by_route[r["route"]].append(r)
+
+    rows = [("ALL", results)] + sorted(by_route.items(), key=lambda kv: -len(kv[1]))
+    for route, entries in rows:
+        stats = summarise([e["latency_ms"] for e in entries])
+        captured = summarise([
+            e["captured_latency_ms"]
+            for e in entries
+            if e["captured_latency_ms"] is not None
+        ])
+        print(
+            f"{route[:50]:<50} {stats['count']:>6} {stats['p50']:>9.1f} {stats['p90']:>9.1f} "
+            f"{stats['p95']:>9.1f} {stats['p99']:>9.1f} {stats['max']:>9.1f} {captured['p50']:>9.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "captures", nargs="+", help="Capture files (.jsonl or .jsonl.gz)"
+    )
+    parser.add_argument(
+        "--target", default="http://localhost:8000", help="Gateway base URL"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay speed multiplier, e.g. 2 replays twice as fast",
+    )
+    parser.add_argument(
+        "--tokens", help="JSON file mapping user pseudonyms to access tokens"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=190.0, help="Per-request timeout in seconds"
+    )
+    parser.add_argument("--limit", type=int, help="Only replay the first N requests")
+    parser.add_argument(
+        "--skip-unauthenticated",
+        action="store_true",
+        help="Skip requests from users without a token in --tokens",
+    )
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    tokens = {}
+    if args.tokens:
+        with open(args.tokens, encoding="utf-8") as f:
+            tokens = json.load(f)
+
+    records = load_capture(args.captures)
+    if args.limit:
+        records = records[: args.limit]
+
+    replayer = Replayer(
+        args.target, args.speed, tokens, args.timeout, args.skip_unauthenticated
+    )
+    start = time.perf_counter()
+    asyncio.run(replayer.run(records))
+    print_report(replayer.results, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,9 @@ import re
 from dotenv import load_dotenv
 
 
-def get_envvar(var_name: str) -> str:
+def get_envvar(var_name: str, default: str | None = None) -> str:
     load_dotenv()
-    value = os.getenv(var_name)
+    value = os.getenv(var_name, default)
     if value is None:
         raise ValueError(f"Environment variable {var_name} is not set.")
     return value
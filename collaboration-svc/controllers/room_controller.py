@@ -1,4 +1,5 @@
 import asyncio
+import time
 from asyncio.exceptions import TimeoutError
 from asyncio import Event
 from controllers.websocket_controller import WebSocketManager
@@ -6,13 +7,15 @@ from fastapi import HTTPException
 from models.api_models import MatchData
 from redis.asyncio import Redis
 from services.redis_event_queue import (
-    get_match_confirmation_event,
-    get_match_confirmation_event_data,
-    remove_match_confirmation_event,
+    ROOM_EVENT_GROUP,
+    ROOM_EVENT_STREAM_KEY,
+    CLAIM_IDLE_MS,
     create_group,
     retrieve_stream_data,
+    claim_stuck_events,
     acknowlwedge_event,
 )
+from services.room_hold_scheduler import ROOM_HOLD_SECONDS, room_hold_scheduler
 
 from services.redis_room_service import (
     create_room,
@@ -22,13 +25,12 @@ from services.redis_room_service import (
     cleanup,
     add_room_cleanup,
     get_room_id,
-    check_room_cleanup,
     delete_user_ttl,
     send_room_for_review,
     remove_room_cleanup,
     update_user_ttl,
     get_room_question,
-    get_partner_name,
+    format_room_question,
 )
 from utils.logger import log
 from utils.utils import (
@@ -36,45 +38,98 @@ from utils.utils import (
     release_lock,
     get_envvar,
     format_user_room_key,
-    extract_information_from_event,
+    extract_expired_user,
+    extract_stream_events,
     format_heartbeat_key,
     format_cleanup_key,
     does_key_exist,
     format_lock_key,
 )
 
-LOCK_KEY = "event_manager_lock"
+# Room events read at once, and how long a read waits for new events before checking for stuck ones again
+ROOM_EVENT_BATCH = 10
+ROOM_EVENT_BLOCK_MS = 5000
+
+# Expired heartbeats read at once, how long a read waits for them, and how many rooms are checked at the same time
+EXPIRED_HEARTBEAT_BATCH = 100
+EXPIRED_HEARTBEAT_BLOCK_MS = 5000
+EXPIRED_HEARTBEAT_CONCURRENCY = 20
 
 ENV_REDIS_STREAM_KEY = "REDIS_STREAM_KEY"
 ENV_REDIS_GROUP_KEY = "REDIS_GROUP"
 
 
 async def create_room_listener(
-    event_queue_connection: Redis, room_connection: Redis, stop_event: Event
+    service_id: str, event_queue_connection: Redis, room_connection: Redis, stop_event: Event
 ):
     """
-    Spawns a worker to periodically check if there are any new match confirm events.\n
-    Uses a distributed lock to ensure only one service handles each event.
+    Spawns a worker that creates the rooms of the confirmed matches.\n
+    The instances read the stream as one consumer group, so each event is delivered to a single instance without
+    a lock, and a read blocks until there are events instead of polling.\n
+    An event is only acknowledged once its room has been created. The events of an instance that stopped before
+    acknowledging them are taken over by the other instances once they have been idle for long enough.
     """
-    while True:
-        if stop_event.is_set():
-            break
+    # Events published before the group existed still need their rooms
+    await create_group(event_queue_connection, ROOM_EVENT_STREAM_KEY, ROOM_EVENT_GROUP, start_id="0")
+    last_claimed = 0.0
 
-        lock = await acquire_lock(LOCK_KEY, event_queue_connection)
+    while not stop_event.is_set():
+        try:
+            if time.monotonic() - last_claimed >= CLAIM_IDLE_MS / 1000:
+                last_claimed = time.monotonic()
+                events = await claim_stuck_events(
+                    event_queue_connection, ROOM_EVENT_STREAM_KEY, ROOM_EVENT_GROUP, service_id
+                )
+                if events:
+                    log.info(f"Collaboration service, {service_id} has taken over {len(events)} room events")
+                    await handle_room_events(events, event_queue_connection, room_connection)
+
+            message = await retrieve_stream_data(
+                event_queue_connection,
+                ROOM_EVENT_STREAM_KEY,
+                ROOM_EVENT_GROUP,
+                service_id,
+                count=ROOM_EVENT_BATCH,
+                block=ROOM_EVENT_BLOCK_MS,
+            )
+            await handle_room_events(extract_stream_events(message), event_queue_connection, room_connection)
+        except Exception as e:  # noqa: BLE001
+            log.error(f"ERROR: Failed to read room events, {e}")
+            await asyncio.sleep(1)
 
-        room_id = await get_match_confirmation_event(event_queue_connection)
+    log.info("Listener stopping as stop event is set.")
 
-        await release_lock(lock)
 
-        if room_id:
-            match_details = await get_match_confirmation_event_data(
-                room_id, event_queue_connection
+async def handle_room_events(
+    events: list[tuple[str, dict]], event_queue_connection: Redis, room_connection: Redis
+) -> None:
+    """
+    Creates the rooms of the events and acknowledges the events whose room was created.\n
+    An event whose room could not be created is left unacknowledged, so it is delivered again later.
+    Events that were trimmed from the stream or lack the match details can never create a room, so they are
+    acknowledged and dropped.
+    """
+    for event_id, match_details in events:
+        if not match_details or not {"match_id", "user_one", "user_two"} <= match_details.keys():
+            log.error(f"ERROR: Dropping room event {event_id} without match details, {match_details}")
+            await acknowlwedge_event(
+                event_queue_connection, ROOM_EVENT_STREAM_KEY, ROOM_EVENT_GROUP, event_id
             )
-            log.info(f"INFO: Room ID : {room_id}, match details : {match_details}")
-            await create_room(match_details, room_connection)
-            await remove_match_confirmation_event(room_id, event_queue_connection)
-    
-    log.info("Listener stopping as stop event is set.")
+            continue
+
+        try:
+            log.info(f"INFO: Room ID : {match_details['match_id']}, match details : {match_details}")
+            # An event delivered again after its room was created does not recreate the room
+            room_key = format_user_room_key(match_details["user_one"])
+            if await get_room_id(room_key, room_connection) != match_details["match_id"]:
+                await create_room(match_details, room_connection)
+        except Exception as e:  # noqa: BLE001
+            log.error(f"ERROR: Failed to create the room for event {event_id}, {e}")
+            continue
+
+        await acknowlwedge_event(
+            event_queue_connection, ROOM_EVENT_STREAM_KEY, ROOM_EVENT_GROUP, event_id
+        )
 
 
 async def create_ttl_expire_listener(
@@ -85,35 +140,87 @@ async def create_ttl_expire_listener(
     stop_event: Event,
 ):
     """
-    Spawns a worker to periodically check if any of the users TTL has expired.
+    Spawns a worker that checks the rooms of the users whose heartbeat has expired.\n
+    The events are read in batches with a blocking read, and the rooms of a batch are checked concurrently,
+    so a burst of expiries such as after a network blip drains in a few round trips.\n
+    The events of an instance that stopped before acknowledging them are taken over by the other instances
+    once they have been idle for long enough.
     """
     stream_key = get_envvar(ENV_REDIS_STREAM_KEY)
     group_key = get_envvar(ENV_REDIS_GROUP_KEY)
 
     await create_group(event_queue_connection, stream_key, group_key)
+    last_claimed = 0.0
 
-    while True:
-        if stop_event.is_set():
-            break
-
-        message = await retrieve_stream_data(
-            event_queue_connection, stream_key, group_key, service_id
-        )
-        if message:
-            # Process the message to get the user id and the match id
-            event_id, user_id = extract_information_from_event(message)
-            log.info(
-                f"Collaboration service, {service_id} is handling event {event_id}"
+    while not stop_event.is_set():
+        try:
+            if time.monotonic() - last_claimed >= CLAIM_IDLE_MS / 1000:
+                last_claimed = time.monotonic()
+                events = await claim_stuck_events(event_queue_connection, stream_key, group_key, service_id)
+                if events:
+                    log.info(f"Collaboration service, {service_id} has taken over {len(events)} expired heartbeats")
+                    await handle_expired_heartbeats(
+                        events, stream_key, group_key, event_queue_connection, room_connection, websocket_manager
+                    )
+
+            message = await retrieve_stream_data(
+                event_queue_connection,
+                stream_key,
+                group_key,
+                service_id,
+                count=EXPIRED_HEARTBEAT_BATCH,
+                block=EXPIRED_HEARTBEAT_BLOCK_MS,
+            )
+            await handle_expired_heartbeats(
+                extract_stream_events(message),
+                stream_key,
+                group_key,
+                event_queue_connection,
+                room_connection,
+                websocket_manager,
             )
+        except Exception as e:  # noqa: BLE001
+            log.error(f"ERROR: Failed to read expired heartbeats, {e}")
+            await asyncio.sleep(1)
 
-            await check_empty_room(user_id, room_connection, websocket_manager)
+    log.info("Expired heartbeat listener stopping as stop event is set.")
 
-            await acknowlwedge_event(
-                event_queue_connection, stream_key, group_key, event_id
-            )
-            log.info(
-                f"Collaboration service, {service_id} has completed handling event {event_id}"
-            )
+
+async def handle_expired_heartbeats(
+    events: list[tuple[str, dict]],
+    stream_key: str,
+    group_key: str,
+    event_queue_connection: Redis,
+    room_connection: Redis,
+    websocket_manager: WebSocketManager,
+) -> None:
+    """
+    Checks the rooms of the users whose heartbeat expired, at most EXPIRED_HEARTBEAT_CONCURRENCY at a time,
+    and acknowledges the handled events together.\n
+    An event whose room could not be checked is left unacknowledged, so it is delivered again later.
+    """
+    if not events:
+        return
+
+    semaphore = asyncio.Semaphore(EXPIRED_HEARTBEAT_CONCURRENCY)
+
+    async def handle(event_id: str, event: dict) -> str | None:
+        user_id = extract_expired_user(event)
+        if user_id is None:
+            return event_id
+
+        async with semaphore:
+            try:
+                await check_empty_room(user_id, room_connection, websocket_manager)
+            except Exception as e:  # noqa: BLE001
+                log.error(f"ERROR: Failed to check the room of {user_id}, {e}")
+                return None
+        return event_id
+
+    handled = [event_id for event_id in await asyncio.gather(*(handle(*event) for event in events)) if event_id]
+    if handled:
+        await acknowlwedge_event(event_queue_connection, stream_key, group_key, *handled)
+    log.info(f"Handled {len(handled)} of {len(events)} expired heartbeats")
 
 
 async def alert_partner_left(
@@ -164,36 +271,30 @@ async def check_empty_room(
     room_key = format_user_room_key(user_id)
 
     room_id = await get_room_id(room_key, room_connection)
+    # The room was already cleaned up, such as when the heartbeats of both users expire together
+    if room_id is None:
+        return
+
     partner = await get_partner(user_id, room_key, room_connection)
     partner_heartbeat_key = format_heartbeat_key(partner)
 
     if await is_user_alive(partner_heartbeat_key, room_connection):
         await alert_partner_left(partner, room_id, websocket_manager)
     else:
-        # Fire and foeget this task to check again in 5 minutes if any user joins back
-        asyncio.create_task(start_room_hold_timer(room_id, user_id, room_connection))
+        await start_room_hold_timer(room_id, user_id, room_connection)
 
 
 async def start_room_hold_timer(
     room_id: str, user_id: str, room_connection: Redis
 ) -> None:
     """
-    Initates a 2 minute timer to check if anyone has retunred before cleaning up.
+    Holds the room for 5 minutes for anyone to return before it is cleaned up.\n
+    The hold is kept by the room hold scheduler, so any instance cleans the room up once the hold runs out.
     """
     clean_up_key = format_cleanup_key(room_id)
     await add_room_cleanup(clean_up_key, user_id, room_connection)
+    await room_hold_scheduler.hold(room_id, ROOM_HOLD_SECONDS)
     log.info(f"Holding room, {room_id} for 5 minutes due to both players leaving")
-    retries = 0
-
-    while retries < 300:
-        await asyncio.sleep(1)
-        if not await check_room_cleanup(clean_up_key, room_connection):
-            log.info(f"Clean up for {room_id} has been terminated")
-            return
-        retries += 1
-
-    await cleanup(clean_up_key, room_connection)
-    log.info(f"Data for {room_id} is cleared due to inactivity")
 
 
 async def create_heartbeat_listener(
@@ -235,14 +336,15 @@ async def reconnect_user(
     """
     room_key = format_user_room_key(user_id)
 
-    if not await does_key_exist(room_key):
+    if not await does_key_exist(room_key, room_connection):
         raise HTTPException(
             status_code=400,
             detail="User is not assiged a room or the room has expired",
         )
 
     # Removes the cleanup countdown if there is
-    room_id = get_room_id(room_key)
+    room_id = await get_room_id(room_key, room_connection)
+    await room_hold_scheduler.release(room_id)
     cleanup_key = format_cleanup_key(room_id)
     await remove_room_cleanup(cleanup_key, room_connection)
 
@@ -251,9 +353,9 @@ async def reconnect_user(
 
     log.info(f"User, {user_id} has reconnected to room, {room_id}")
 
-    partner = get_partner(user_id, room_key, room_connection)
+    partner = await get_partner(user_id, room_key, room_connection)
     partner_heartbeat_key = format_heartbeat_key(partner)
-    is_partner_in_room = await does_key_exist(partner_heartbeat_key)
+    is_partner_in_room = await does_key_exist(partner_heartbeat_key, room_connection)
 
     if is_partner_in_room:
         await alert_partner_rejoined(partner, room_id, websocket_manager)
@@ -290,6 +392,7 @@ async def terminate_match(
         cleanup_key = format_cleanup_key(room_id)
         await add_room_cleanup(cleanup_key, user_id, room_connection)
         await cleanup(cleanup_key, room_connection)
+        await room_hold_scheduler.release(room_id)
         partner_heartbeat_key = format_heartbeat_key(partner)
 
         await delete_user_ttl(user_heartbeat_key, room_connection)
@@ -306,24 +409,29 @@ async def terminate_match(
 
 async def connect_user(user_id: str, room_id: str, room_connection: Redis) -> dict:
     """
-    Connects the user to the room and returns the question assigned to them.
+    Connects the user to the room and returns the question assigned to them.\n
+    The question is stored when the room is created, so the room is only read once.
     """
     room_key = format_user_room_key(user_id)
 
-    if (
-        not await does_key_exist(room_key, room_connection)
-        or await get_room_id(room_key, room_connection) != room_id
-    ):
+    room_information = await get_room_information(room_key, room_connection)
+    if room_information.get("match_id") != room_id:
         raise HTTPException(
             status_code=400,
             detail="User is not assigned to a room or the room does not exist",
         )
 
-    lock_key = format_lock_key(room_id)
-    lock = await acquire_lock(lock_key, room_connection)
+    # Rooms created without a question, as the matching service could not select one, pick it on the first connection
+    if "id" not in room_information:
+        lock_key = format_lock_key(room_id)
+        lock = await acquire_lock(lock_key, room_connection)
+        await get_room_question(room_key, user_id, room_connection)
+        await release_lock(lock)
+        room_information = await get_room_information(room_key, room_connection)
 
-    question = await get_room_question(room_key, user_id, room_connection)
-    await release_lock(lock)
-    partner_name = await get_partner_name(room_key, user_id, room_connection)
+    if room_information["user_one"] == user_id:
+        partner_name = room_information["user_two_name"]
+    else:
+        partner_name = room_information["user_one_name"]
 
-    return {"question": question, "partner_name": partner_name}
+    return {"question": format_room_question(room_information), "partner_name": partner_name}
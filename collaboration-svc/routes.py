@@ -18,8 +18,15 @@ from controllers.room_controller import (
 from controllers.websocket_controller import WebSocketManager
 from fastapi import FastAPI, Header
 from models.api_models import MatchData
-from services.redis_event_queue import connect_to_redis_event_queue
+from services.redis_batcher import AutoBatchingRedis
+from services.redis_event_queue import (
+    ROOM_EVENT_GROUP,
+    ROOM_EVENT_STREAM_KEY,
+    connect_to_redis_event_queue,
+    get_group_backlog,
+)
 from services.redis_room_service import connect_to_redis_room_service
+from services.room_hold_scheduler import room_hold_scheduler
 from typing import Annotated
 from utils.logger import log
 from utils.utils import sever_connection, get_envvar
@@ -39,15 +46,19 @@ async def lifespan(app: FastAPI):
     Set up variables for the collaboration service.
     """
     app.state.event_queue_connection = connect_to_redis_event_queue()
-    app.state.room_connection = await connect_to_redis_room_service()
+    # Small reads from concurrent requests are coalesced into shared round trips
+    app.state.room_connection = AutoBatchingRedis(await connect_to_redis_room_service())
 
     app.state.websocket_manager = WebSocketManager()
 
     await app.state.websocket_manager.connect()
 
+    room_hold_scheduler.start(app.state.room_connection)
+
     stop_event = asyncio.Event()
     room_listener = asyncio.create_task(
         create_room_listener(
+            INSTANCE_ID,
             app.state.event_queue_connection, app.state.room_connection, stop_event
         )
     )
@@ -85,6 +96,8 @@ async def lifespan(app: FastAPI):
         await websocket_listner
     log.info("Websocket listner worker is done.")
 
+    await room_hold_scheduler.stop()
+
     await app.state.websocket_manager.disconnect()
 
     await sever_connection(app.state.event_queue_connection)
@@ -102,6 +115,16 @@ async def root() -> dict:
     return {"status": "Collab Working"}
 
 
+@app.get("/stats/redis_batching", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def redis_batching_stats() -> dict:
+    return app.state.room_connection.metrics.snapshot()
+
+
+@app.get("/stats/room_events", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def room_event_stats() -> dict:
+    return await get_group_backlog(app.state.event_queue_connection, ROOM_EVENT_STREAM_KEY, ROOM_EVENT_GROUP)
+
+
 @app.get("/connect/{room_id}", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]})
 async def connect(room_id: str, x_user_id: Annotated[str, Header()]):
     data = await connect_user(
@@ -192,3 +215,15 @@ if get_envvar("ENVIRONMENT") == "DEV":
             return {"message": "All Redis databases have been flushed successfully"}
         except Exception as e:
             return {"error": f"Failed to flush Redis: {str(e)}"}
+
+
+@app.get("/stats/room_holds", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def room_hold_stats() -> dict:
+    return await room_hold_scheduler.snapshot()
+
+
+@app.get("/stats/expired_heartbeats", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def expired_heartbeat_stats() -> dict:
+    return await get_group_backlog(
+        app.state.event_queue_connection, get_envvar(ENV_REDIS_STREAM_KEY), get_envvar(ENV_REDIS_GROUP_KEY)
+    )
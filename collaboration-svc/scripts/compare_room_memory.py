@@ -0,0 +1,155 @@
+"""
+Compares the memory redis uses to hold the rooms of concurrent matches in each storage layout.
+
+The per-user layout is how rooms used to be stored: a hash per user holding the whole match and its question.
+The room layout stores each room once, with a key per user holding the id of the room, and is measured both
+with and without the large question fields compressed. Memory is the sum of MEMORY USAGE over the keys of the
+rooms, so the numbers are the same whether redis is a single server or a cluster.
+
+Use a redis server that nothing else is using, the rooms are written under their own namespace and removed
+once they are measured. Run from the collaboration-svc directory:
+    python -m scripts.compare_room_memory --rooms 10000
+"""
+import argparse
+import asyncio
+import random
+from datetime import datetime
+from uuid import uuid4
+
+from redis.asyncio import Redis
+
+from services import redis_room_service
+from services.redis_room_service import TTL, connect_to_redis_room_service, create_room
+from utils import utils
+from utils.utils import format_heartbeat_key, format_key, hash_tag
+
+PER_USER_LAYOUT = "per_user"
+ROOM_LAYOUT = "room"
+COMPRESSED_ROOM_LAYOUT = "room_compressed"
+
+# Words the questions are made of, so their text compresses about as well as real questions do
+QUESTION_WORDS = (
+    "given an array of integers nums and target return the indices two numbers such that they add up to you may "
+    "assume each input would have exactly one solution not use same element twice can answer in any order string "
+    "linked list node tree binary search sorted matrix graph edge vertex path minimum maximum length substring "
+    "characters window dynamic programming memo stack queue heap interval merge overlapping constraints example "
+    "output explanation because def class self int str list dict for while if else range len append pop"
+)
+VOCABULARY = QUESTION_WORDS.split()
+
+PIPELINE_SIZE = 500
+# Rooms written at the same time, each with its own pipeline
+WRITE_CONCURRENCY = 50
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def make_match(rng: random.Random, args: argparse.Namespace) -> dict:
+    """
+    Returns the details of a confirmed match along with its question, as the room event carries them.
+    """
+    return {
+        "match_id": str(uuid4()),
+        "user_one": str(uuid4()),
+        "user_two": str(uuid4()),
+        "user_one_name": "Ada Lovelace",
+        "user_two_name": "Alan Turing",
+        "difficulty": "Medium",
+        "category": "Arrays",
+        "id": str(rng.randint(1, 5000)),
+        "title": make_text(rng, 4),
+        "description": make_text(rng, args.description_words),
+        "code_template": make_text(rng, args.template_words),
+        "solution_sample": make_text(rng, args.solution_words),
+    }
+
+
+async def write_per_user_room(match: dict, room_connection: Redis) -> None:
+    # The layout create_room used to write, with the whole room copied into the hash of each user
+    match = {**match, "start_time": str(datetime.now())}
+    async with room_connection.pipeline(transaction=False) as pipe:
+        for user_id in (match["user_one"], match["user_two"]):
+            pipe.set(format_heartbeat_key(user_id), str(datetime.now()), TTL)
+            pipe.hset(format_key("room", hash_tag(user_id)), mapping=match)
+        await pipe.execute()
+
+
+async def write_rooms(layout: str, matches: list[dict], room_connection: Redis) -> None:
+    redis_room_service.COMPRESS_ROOMS = layout == COMPRESSED_ROOM_LAYOUT
+    for start in range(0, len(matches), WRITE_CONCURRENCY):
+        batch = [dict(match) for match in matches[start:start + WRITE_CONCURRENCY]]
+        if layout == PER_USER_LAYOUT:
+            await asyncio.gather(*(write_per_user_room(match, room_connection) for match in batch))
+        else:
+            await asyncio.gather(*(create_room(match, room_connection) for match in batch))
+
+
+async def measure(room_connection: Redis) -> tuple[int, int]:
+    """
+    Returns the number of keys under the namespace and the bytes they use.
+    """
+    keys = [key async for key in room_connection.scan_iter(format_key("*"), count=1000)]
+    used = 0
+    for start in range(0, len(keys), PIPELINE_SIZE):
+        async with room_connection.pipeline(transaction=False) as pipe:
+            for key in keys[start:start + PIPELINE_SIZE]:
+                pipe.memory_usage(key, samples=0)
+            used += sum(usage or 0 for usage in await pipe.execute())
+    return len(keys), used
+
+
+async def remove_rooms(room_connection: Redis) -> None:
+    keys = [key async for key in room_connection.scan_iter(format_key("*"), count=1000)]
+    for start in range(0, len(keys), PIPELINE_SIZE):
+        await room_connection.delete(*keys[start:start + PIPELINE_SIZE])
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # Every key is written under the namespace of this comparison, away from the rooms of real matches
+    utils.KEY_NAMESPACE = args.namespace
+    rng = random.Random(args.seed)
+    matches = [make_match(rng, args) for _ in range(args.rooms)]
+    room_connection = await connect_to_redis_room_service()
+
+    report = {}
+    try:
+        await remove_rooms(room_connection)
+        for layout in (PER_USER_LAYOUT, ROOM_LAYOUT, COMPRESSED_ROOM_LAYOUT):
+            await write_rooms(layout, matches, room_connection)
+            keys, used = await measure(room_connection)
+            await remove_rooms(room_connection)
+            report[layout] = {"keys": keys, "bytes": used, "bytes_per_room": round(used / args.rooms)}
+    finally:
+        await room_connection.aclose()
+
+    baseline = report[PER_USER_LAYOUT]["bytes"]
+    for stats in report.values():
+        stats["saved"] = round(1 - stats["bytes"] / baseline, 3) if baseline else None
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=10000, help="number of concurrent rooms")
+    parser.add_argument("--description-words", type=int, default=250, help="words in each question description")
+    parser.add_argument("--template-words", type=int, default=40, help="words in each code template")
+    parser.add_argument("--solution-words", type=int, default=200, help="words in each sample solution")
+    parser.add_argument("--namespace", default="peerprep_room_memory", help="prefix of the keys written")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+
+    print(f"{args.rooms} rooms")
+    print(f"{'layout':<18}{'keys':>10}{'MiB':>10}{'bytes/room':>12}{'saved':>8}")
+    for layout, stats in report.items():
+        print(
+            f"{layout:<18}{stats['keys']:>10}{stats['bytes'] / 2**20:>10.1f}"
+            f"{stats['bytes_per_room']:>12}{stats['saved']:>8.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
 from redis.asyncio import Redis
-from utils.utils import get_envvar
+from utils.logger import log
+from utils.utils import ENV_REDIS_CLUSTER_NODES_KEY, connect_to_redis, get_envvar, format_room_event_stream_key
 
 ENV_REDIS_HOST_KEY = "REDIS_HOST"
 ENV_REDIS_PORT_KEY = "REDIS_PORT"
 
-MATCH_CONFIRMATION_EVENT_KEY = "create_room"
+# Stream of the confirmed matches published by the matching service, read by the instances as one group
+ROOM_EVENT_STREAM_KEY = format_room_event_stream_key()
+ROOM_EVENT_GROUP = "room_creators"
+
+# Events read by an instance that are not acknowledged within this many milliseconds are taken over by another,
+# and events delivered more than MAX_DELIVERIES times are given up on, so one bad event cannot block the rest
+CLAIM_IDLE_MS = 30000
+MAX_DELIVERIES = 5
 
 def connect_to_redis_event_queue() -> Redis:
     """
@@ -12,47 +20,69 @@ def connect_to_redis_event_queue() -> Redis:
     """
     redis_port = get_envvar(ENV_REDIS_PORT_KEY)
     host = get_envvar(ENV_REDIS_HOST_KEY)
-    # decode_responses = True is to allow redis to automatically decode responses
-    return Redis(host=host, port=redis_port, decode_responses=True, db=1)
-
-async def get_match_confirmation_event(event_queue_connection: Redis) -> str:
-    """
-    Retrieves a match confirmation event from the event queue.
-    """
-    return await event_queue_connection.lpop(MATCH_CONFIRMATION_EVENT_KEY)
-
-async def get_match_confirmation_event_data(room_id: str, event_queue_connection: Redis) -> dict:
-    """
-    Removes the match confirmation event log from the event queue.
-    """
-    return await event_queue_connection.hgetall(room_id)
-
-async def remove_match_confirmation_event(room_id: str, event_queue_connection: Redis) -> None:
-    """
-    Removes the match confirmation event log from the event queue.
-    """
-    await event_queue_connection.delete(room_id)
+    return connect_to_redis(host, redis_port, 1, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
 
-async def create_group(event_queue_connection: Redis, stream_key: str, group_key: str) -> None:
+async def create_group(event_queue_connection: Redis, stream_key: str, group_key: str, start_id: str = "$") -> None:
     """
     Creates a group within redis streams given the stream key.
+
+    The group reads the events added after start_id, which is "$" to skip the events already in the stream.
     """
     try:
     # Subscribe to this stream
-        await event_queue_connection.xgroup_create(stream_key, group_key, id="$", mkstream=True)
+        await event_queue_connection.xgroup_create(stream_key, group_key, id=start_id, mkstream=True)
     except Exception as e:
         # If any other error occur happens just raise an exception
         if "BUSYGROUP" not in str(e):
             raise e
 
-async def retrieve_stream_data(event_queue_connection: Redis, stream_key: str, group_key: str, service_id: str) -> list:
+async def retrieve_stream_data(
+    event_queue_connection: Redis, stream_key: str, group_key: str, service_id: str, count: int = 1, block: int | None = None
+) -> list:
+    """
+    Returns up to count new events from the stream given the stream key. If there is no message it will return a empty list.\n
+    If block is given, waits up to that many milliseconds for an event instead of returning straight away.
+    """
+    return await event_queue_connection.xreadgroup(group_key, service_id, {stream_key: ">"}, count=count, block=block)
+
+async def claim_stuck_events(
+    event_queue_connection: Redis, stream_key: str, group_key: str, service_id: str, count: int = 100
+) -> list[tuple[str, dict]]:
+    """
+    Takes over the events that other consumers read but did not acknowledge within CLAIM_IDLE_MS, such as
+    the events of an instance that stopped midway, and returns them as (event id, fields).\n
+    Events that have already been delivered MAX_DELIVERIES times are acknowledged and dropped instead.
+    """
+    stuck = await event_queue_connection.xpending_range(
+        stream_key, group_key, min="-", max="+", count=count, idle=CLAIM_IDLE_MS
+    )
+    dropped = [entry["message_id"] for entry in stuck if entry["times_delivered"] >= MAX_DELIVERIES]
+    if dropped:
+        log.error(f"Dropping events {dropped} of {stream_key} after {MAX_DELIVERIES} failed deliveries")
+        await event_queue_connection.xack(stream_key, group_key, *dropped)
+
+    claimed = []
+    start_id = "0-0"
+    while True:
+        start_id, events, *_ = await event_queue_connection.xautoclaim(
+            stream_key, group_key, service_id, CLAIM_IDLE_MS, start_id=start_id, count=count
+        )
+        claimed.extend(events)
+        if start_id == "0-0" or len(claimed) >= count:
+            return claimed
+
+async def get_group_backlog(event_queue_connection: Redis, stream_key: str, group_key: str) -> dict:
     """
-    Returns a event from the stream given the stream key. If there is no message it will return a empty list.
+    Returns how many events the group has read but not acknowledged, and how many it has not read yet.
     """
-    return await event_queue_connection.xreadgroup(group_key, service_id, {stream_key: ">"}, count=1)
+    if not await event_queue_connection.exists(stream_key):
+        return {"pending": 0, "lag": 0}
+    groups = await event_queue_connection.xinfo_groups(stream_key)
+    group = next((group for group in groups if group["name"] == group_key), {})
+    return {"pending": group.get("pending"), "lag": group.get("lag")}
 
-async def acknowlwedge_event(event_queue_connection: Redis, stream_key: str, group_key: str, event_key: str) -> None:
+async def acknowlwedge_event(event_queue_connection: Redis, stream_key: str, group_key: str, *event_keys: str) -> None:
     """
-    Acknowledges that the event has been handled.
+    Acknowledges that the events have been handled.
     """
-    await event_queue_connection.xack(stream_key, group_key, event_key)
+    await event_queue_connection.xack(stream_key, group_key, *event_keys)
@@ -1,8 +1,20 @@
+import base64
+import json
+import zlib
 from datetime import datetime
 from redis.asyncio import Redis
 import requests
 from utils.logger import log
-from utils.utils import get_envvar, format_user_room_key, format_heartbeat_key
+from utils.utils import (
+    CLUSTER_MODE,
+    ENV_REDIS_CLUSTER_NODES_KEY,
+    connect_to_redis,
+    get_envvar,
+    format_room_key,
+    format_user_room_key,
+    format_heartbeat_key,
+    parse_hash_tag,
+)
 
 ENV_REDIS_HOST_KEY = "REDIS_HOST"
 ENV_REDIS_PORT_KEY = "REDIS_PORT"
@@ -12,6 +24,18 @@ ENV_QN_SVC_HISTORY_ENDPOINT = "QUESTION_SERVICE_HISTORY_URL"
 
 TTL = 120  # We give them 2 minutes to respond
 
+# Fields of the room that make up its question
+QUESTION_FIELDS = ["title", "description", "code_template", "solution_sample", "difficulty", "category"]
+
+# The large fields of the question can be stored compressed, trading a little CPU on every read for memory
+ENV_ROOM_COMPRESSION_KEY = "ROOM_COMPRESSION"
+COMPRESS_ROOMS = get_envvar(ENV_ROOM_COMPRESSION_KEY, "false").lower() == "true"
+COMPRESSIBLE_FIELDS = ["description", "code_template", "solution_sample"]
+# Shorter values barely shrink once the compressed bytes are encoded as text
+COMPRESS_MIN_LENGTH = 256
+# Field of the room listing the fields that are stored compressed
+COMPRESSED_FIELD = "compressed"
+
 
 async def connect_to_redis_room_service() -> Redis:
     """
@@ -19,9 +43,7 @@ async def connect_to_redis_room_service() -> Redis:
     """
     redis_port = get_envvar(ENV_REDIS_PORT_KEY)
     host = get_envvar(ENV_REDIS_HOST_KEY)
-    # decode_responses = True is to allow redis to automatically decode responses
-
-    redis = Redis(host=host, port=redis_port, decode_responses=True, db=0)
+    redis = connect_to_redis(host, redis_port, 0, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
     # Configure redis so that expired keys will be sent as a event within redis
     # await redis.config_set('notify-keyspace-events', 'Ex')
     return redis
@@ -29,7 +51,8 @@ async def connect_to_redis_room_service() -> Redis:
 
 async def create_room(match_data: dict, room_connection: Redis) -> None:
     """
-    Creates a room given the match data received.
+    Creates a room given the match data received.\n
+    The question selected by the matching service is stored along with the room, if the event carries one.
     """
     # url = f"{get_envvar(ENV_QN_SVC_POOL_ENDPOINT)}/{match_data['category']}/{match_data['difficulty']}"
 
@@ -64,6 +87,11 @@ async def create_room(match_data: dict, room_connection: Redis) -> None:
     # for key, value in match_data.items():
     #     data[key] = value
     log.info("FUNCTION CALL")
+    question = match_data.pop("question", None)
+    if question:
+        data = json.loads(question)
+        del data["categories"]
+        match_data.update(data)
     match_data["start_time"] = str(datetime.now())
     # del(data["categories"])
     log.info("Step 1")
@@ -79,41 +107,55 @@ async def create_room(match_data: dict, room_connection: Redis) -> None:
     log.info(f"User one key: {user_one_key}, User two key: {user_two_key}")
     log.info(f"match data: {match_data}")
 
-    async with room_connection.pipeline(transaction=True) as pipe:
+    # The room is stored once, and each user only holds the id of the room
+    room_key = format_room_key(match_data["match_id"])
+
+    # The keys of the room and the users are in different cluster slots, which a transaction cannot span
+    async with room_connection.pipeline(transaction=not CLUSTER_MODE) as pipe:
         # Set up heartbeat for user 1 and 2
         await pipe.set(user_one_heartbeat_key, str(datetime.now()), TTL)
         await pipe.set(user_two_heartbeat_key, str(datetime.now()), TTL)
 
-        await pipe.hset(user_one_key, mapping=match_data)
-        await pipe.hset(user_two_key, mapping=match_data)
-        a, b, c, d = await pipe.execute()
-    log.info(f"Redis room creation results: {a}, {b}, {c}, {d}")
+        await pipe.hset(room_key, mapping=compress_room_fields(match_data))
+        await pipe.set(user_one_key, match_data["match_id"])
+        await pipe.set(user_two_key, match_data["match_id"])
+        results = await pipe.execute()
+    log.info(f"Redis room creation results: {results}")
 
     log.info(f"Room has been created for match ID, {match_data["match_id"]}")
 
 
-async def get_partner(user_id: str, room_key: str, room_connection: Redis) -> str:
+async def get_partner(user_id: str, room_key: str, room_connection: Redis) -> str | None:
     """
     Retrieves the user's partner user id for that room.
     """
-    if await room_connection.hget(room_key, "user_one") == user_id:
-        return await room_connection.hget(room_key, "user_two")
+    room_id = await get_room_id(room_key, room_connection)
+    if room_id is None:
+        return None
+
+    user_one, user_two = await room_connection.hmget(format_room_key(room_id), "user_one", "user_two")
+    if user_one == user_id:
+        return user_two
     else:
-        return await room_connection.hget(room_key, "user_one")
+        return user_one
 
 
 async def get_room_information(room_key: str, room_connection: Redis) -> dict:
     """
-    Retrieves the room information.
+    Retrieves the information of the room the user is assigned to, or an empty dict if there is none.
     """
-    return await room_connection.hgetall(room_key)
+    room_id = await get_room_id(room_key, room_connection)
+    if room_id is None:
+        return {}
+
+    return decompress_room_fields(await room_connection.hgetall(format_room_key(room_id)))
 
 
-async def get_room_id(room_key: str, room_connection: Redis) -> str:
+async def get_room_id(room_key: str, room_connection: Redis) -> str | None:
     """
-    Retrieves the user's partner user id for that room.
+    Retrieves the id of the room the user is assigned to.
     """
-    return await room_connection.hget(room_key, "match_id")
+    return await room_connection.get(room_key)
 
 
 async def is_user_alive(heartbeat_key: str, room_connection: Redis) -> bool:
@@ -171,17 +213,20 @@ async def check_room_cleanup(cleanup_key: str, room_connection: Redis) -> bool:
 
 async def cleanup(clean_up_key: str, room_connection: Redis) -> None:
     """
-    Cleans up redis of all the room data based on the room id.
+    Cleans up redis of all the room data based on the room id.\n
+    The keys of users who have since been assigned to another room are left alone.
     """
-    user_id = await room_connection.get(clean_up_key)
-    user_room_key = format_user_room_key(user_id)
-
-    partner_id = await get_partner(user_id, user_room_key, room_connection)
-    partner_room_key = format_user_room_key(partner_id)
-
-    pipe = room_connection.pipeline()
-    pipe.delete(user_room_key)
-    pipe.delete(partner_room_key)
+    room_id = parse_hash_tag(clean_up_key)
+    room_key = format_room_key(room_id)
+    user_ids = [user_id for user_id in await room_connection.hmget(room_key, "user_one", "user_two") if user_id]
+    user_room_keys = [format_user_room_key(user_id) for user_id in user_ids]
+    assigned_rooms = [await room_connection.get(user_room_key) for user_room_key in user_room_keys]
+
+    pipe = room_connection.pipeline(transaction=not CLUSTER_MODE)
+    for user_room_key, assigned_room in zip(user_room_keys, assigned_rooms):
+        if assigned_room == room_id:
+            pipe.delete(user_room_key)
+    pipe.delete(room_key)
     pipe.delete(clean_up_key)
     await pipe.execute()
 
@@ -215,13 +260,14 @@ def send_room_for_review(
 
 async def get_partner_name(room_key: str, user_id: str, room_connection: Redis) -> str:
     """
-    Retrieves the question assigned to this room.
+    Retrieves the name of the user's partner in this room.
     """
+    room_information = await get_room_information(room_key, room_connection)
 
-    if await room_connection.hget(room_key, "user_one") == user_id:
-        return await room_connection.hget(room_key, "user_two_name")
+    if room_information.get("user_one") == user_id:
+        return room_information.get("user_two_name")
     else:
-        return await room_connection.hget(room_key, "user_one_name")
+        return room_information.get("user_one_name")
 
 
 async def get_room_question(
@@ -230,11 +276,12 @@ async def get_room_question(
     """
     Retrieves the question assigned to this room.
     """
+    room_id = await get_room_id(room_key, room_connection)
+    room_key = format_room_key(room_id)
 
     # The question has not been assigned yet
     if not await room_connection.hexists(room_key, "id"):
-        difficulty = await room_connection.hget(room_key, "difficulty")
-        category = await room_connection.hget(room_key, "category")
+        difficulty, category = await room_connection.hmget(room_key, "difficulty", "category")
 
         url = f"{get_envvar(ENV_QN_SVC_POOL_ENDPOINT)}/{category}/{difficulty}"
         log.info(f"INFO: Sending request to {url}")
@@ -246,20 +293,51 @@ async def get_room_question(
         data = response.json()
         log.info(f"INFO: Data received from question service, {data}")
         del data["categories"]
-        await room_connection.hset(room_key, mapping=data)
-
-        # Set the question for the partner also
-        partner = await get_partner(user_id, room_key, room_connection)
-        partner_room_key = format_user_room_key(partner)
-        await room_connection.hset(partner_room_key, mapping=data)
-
-    question_data = {
-        "title": await room_connection.hget(room_key, "title"),
-        "description": await room_connection.hget(room_key, "description"),
-        "code_template": await room_connection.hget(room_key, "code_template"),
-        "solution_sample": await room_connection.hget(room_key, "solution_sample"),
-        "difficulty": await room_connection.hget(room_key, "difficulty"),
-        "category": await room_connection.hget(room_key, "category"),
-    }
+        # Both users share the room, so the question is only stored once
+        await room_connection.hset(room_key, mapping=compress_room_fields(data))
+
+    return format_room_question(decompress_room_fields(await room_connection.hgetall(room_key)))
+
+
+def format_room_question(room_information: dict) -> dict:
+    """
+    Extracts the question from the room information.
+    """
+    return {field: room_information.get(field) for field in QUESTION_FIELDS}
+
+
+def compress_room_fields(room_information: dict) -> dict:
+    """
+    Compresses the large fields of the room if compression is enabled, listing them in the compressed field.
+    """
+    if not COMPRESS_ROOMS:
+        return room_information
+
+    room_information = dict(room_information)
+    compressed = []
+    for field in COMPRESSIBLE_FIELDS:
+        value = room_information.get(field)
+        if not isinstance(value, str) or len(value) < COMPRESS_MIN_LENGTH:
+            continue
+
+        packed = base64.b64encode(zlib.compress(value.encode())).decode()
+        if len(packed) < len(value):
+            room_information[field] = packed
+            compressed.append(field)
+
+    if compressed:
+        room_information[COMPRESSED_FIELD] = ",".join(compressed)
+    return room_information
+
+
+def decompress_room_fields(room_information: dict) -> dict:
+    """
+    Restores the fields of the room that were stored compressed.
+    """
+    compressed = room_information.pop(COMPRESSED_FIELD, None)
+    if not compressed:
+        return room_information
 
-    return question_data
+    for field in compressed.split(","):
+        room_information[field] = zlib.decompress(base64.b64decode(room_information[field])).decode()
+    return room_information
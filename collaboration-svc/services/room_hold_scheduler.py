@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+from redis.asyncio import Redis
+
+from services.redis_room_service import check_room_cleanup, cleanup
+from utils.logger import log
+from utils.utils import format_cleanup_key, format_key
+
+# Seconds an abandoned room is held for its users to come back before it is cleaned up
+ROOM_HOLD_SECONDS = 300
+
+HOLDS_KEY = format_key("room_holds")
+
+# Claims the holds that ran out by pushing them back by the lease instead of removing them,
+# so a hold claimed by an instance that dies before cleaning up its room is claimed again once the lease runs out.
+# KEYS[1]: holds key
+# ARGV[1]: current time, ARGV[2]: maximum number of holds to claim, ARGV[3]: lease in seconds
+CLAIM_HOLDS_SCRIPT = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+local lease_until = tonumber(ARGV[1]) + tonumber(ARGV[3])
+for _, room_id in ipairs(due) do
+    redis.call("ZADD", KEYS[1], lease_until, room_id)
+end
+return due
+"""
+
+
+class RoomHoldScheduler:
+    """
+    Cleans up the abandoned rooms once their hold runs out, from a redis sorted set shared by every instance.\n
+    Each room is scored by the time its hold runs out. Instances poll for the holds that ran out and claim them in
+    batches, so a held room costs a sorted set entry instead of a task polling redis every second, and a user who
+    reconnects cancels the hold by removing the room from the set.
+    """
+
+    def __init__(self, batch_size: int = 100, poll_interval: float = 1, lease: int = 30):
+        self.redis_conn: Redis | None = None
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.worker: asyncio.Task | None = None
+        self.cleaned = 0
+        self.failed = 0
+
+    def start(self, redis_conn: Redis) -> None:
+        """
+        Starts cleaning up the rooms whose hold ran out on the given connection.
+        """
+        self.redis_conn = redis_conn
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops cleaning up rooms, the holds that run out later are picked up by another instance.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def hold(self, room_id: str, delay: float = ROOM_HOLD_SECONDS) -> None:
+        """
+        Holds the room for the delay in seconds before it is cleaned up.
+        """
+        await self.redis_conn.zadd(HOLDS_KEY, {room_id: time.time() + delay})
+
+    async def release(self, room_id: str) -> None:
+        """
+        Cancels the hold of the room, as one of its users came back.
+        """
+        await self.redis_conn.zrem(HOLDS_KEY, room_id)
+
+    async def _run(self) -> None:
+        script = self.redis_conn.register_script(CLAIM_HOLDS_SCRIPT)
+
+        while True:
+            try:
+                room_ids = await script(
+                    keys=[HOLDS_KEY],
+                    args=[time.time(), self.batch_size, self.lease],
+                    client=self.redis_conn,
+                )
+                if room_ids:
+                    await asyncio.gather(*(self._clean_up(room_id) for room_id in room_ids))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                log.error(f"ERROR: Failed to claim room holds, {e}")
+                room_ids = []
+
+            # A full batch means more holds may already have run out
+            if len(room_ids) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _clean_up(self, room_id: str) -> None:
+        clean_up_key = format_cleanup_key(room_id)
+        try:
+            # The room was already cleaned up or a user came back after the hold was claimed
+            if await check_room_cleanup(clean_up_key, self.redis_conn):
+                await cleanup(clean_up_key, self.redis_conn)
+                log.info(f"Data for {room_id} is cleared due to inactivity")
+        except Exception as e:  # noqa: BLE001
+            # Left in the set, so the room is cleaned up again once the lease runs out
+            self.failed += 1
+            log.error(f"ERROR: Failed to clean up room, {room_id}, {e}")
+            return
+
+        await self.redis_conn.zrem(HOLDS_KEY, room_id)
+        self.cleaned += 1
+
+    async def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            "held": await self.redis_conn.zcard(HOLDS_KEY),
+            "overdue": await self.redis_conn.zcount(HOLDS_KEY, "-inf", now),
+            "cleaned": self.cleaned,
+            "failed": self.failed,
+        }
+
+
+# One scheduler per process, started along with the listeners
+room_hold_scheduler = RoomHoldScheduler()
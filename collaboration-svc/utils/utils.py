@@ -1,15 +1,53 @@
 from dotenv import load_dotenv
 import os
 from redis.asyncio import Redis
+from redis.asyncio.cluster import ClusterNode, RedisCluster
 from redis.asyncio.lock import Lock
 
-def get_envvar(var_name: str) -> str:
+def get_envvar(var_name: str, default: str | None = None) -> str:
     load_dotenv()
-    value = os.getenv(var_name)
+    value = os.getenv(var_name, default)
     if value is None:
         raise ValueError(f"Environment variable {var_name} is not set.")
     return value
 
+# Comma separated host:port pairs of the redis cluster nodes, left empty to use a single redis server
+ENV_REDIS_CLUSTER_NODES_KEY = "REDIS_CLUSTER_NODES"
+CLUSTER_MODE = get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, "") != ""
+
+# Every key starts with the namespace so the services can share a redis cluster, where there are no logical
+# databases to keep them apart. The part of a key in braces is its hash tag, which decides the cluster slot
+# it is stored in, so the keys of one user are stored together and different users are spread out.
+KEY_NAMESPACE = get_envvar("REDIS_KEY_NAMESPACE", "peerprep")
+
+def connect_to_redis(host: str, port: str, db: int, cluster_nodes: str = "") -> Redis:
+    """
+    Connects to the redis cluster if its nodes are given, otherwise to the database of a single redis server.
+    """
+    if cluster_nodes:
+        nodes = [ClusterNode(node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1])) for node in cluster_nodes.split(",")]
+        # decode_responses = True is to allow redis to automatically decode responses
+        return RedisCluster(startup_nodes=nodes, decode_responses=True)
+    return Redis(host=host, port=port, decode_responses=True, db=db)
+
+def hash_tag(value: str) -> str:
+    """
+    Wraps the value in braces, so keys with the same tag are stored in the same cluster slot.
+    """
+    return f"{{{value}}}"
+
+def parse_hash_tag(key: str) -> str:
+    """
+    Returns the value in the hash tag of the key, such as the id a key was formatted with.
+    """
+    return key.partition("{")[2].partition("}")[0]
+
+def format_key(*parts: str) -> str:
+    """
+    Joins the parts into a key under the namespace of the service.
+    """
+    return ":".join((KEY_NAMESPACE, *parts))
+
 async def sever_connection(redis_connection: Redis):
     """
     Closes the connection with redis.
@@ -26,7 +64,7 @@ def format_lock_key(key: str) -> str:
     """
     Formats the given key into a key to be used as a lock.
     """
-    key = f"lock:{key}"
+    key = format_key("lock", key)
     return key
 
 async def acquire_lock(key: str, redis_connection: Redis) -> Lock:
@@ -44,39 +82,61 @@ async def release_lock(lock: Lock) -> None:
     """
     await lock.release()
 
+def format_room_key(room_id: str) -> str:
+    """
+    Formats the key of the room given the room_id.
+    """
+    key = format_key("room", hash_tag(room_id))
+    return key
+
 def format_user_room_key(user_id: str) -> str:
     """
-    Formats the room key for the particular user.
+    Formats the key of the particular user, which holds the id of the room the user is assigned to.
     """
-    key = f"room:{user_id}"
+    key = format_key("user_room", hash_tag(user_id))
     return key
 
 def format_heartbeat_key(user_id: str) -> str:
     """
     Formats the heartbeat key given the user_id.
     """
-    key = f"heartbeat:{user_id}"
+    key = format_key("heartbeat", hash_tag(user_id))
     return key
 
 def format_cleanup_key(room_id: str) -> str:
     """
     Formats the cleanup key given the room_id.
     """
-    key = f"cleanup:{room_id}"
+    key = format_key("cleanup", hash_tag(room_id))
+    return key
+
+def format_room_event_stream_key() -> str:
+    """
+    Formats the key of the stream of confirmed matches the matching service publishes for rooms to be created.
+    """
+    key = format_key(hash_tag("room_events"))
     return key
 
-def extract_information_from_event(message: list) -> tuple:
+def extract_expired_user(event: dict | None) -> str | None:
     """
-    Parses the event and extracts the relevant information.
+    Parses the expired key event and extracts the user id of the heartbeat that expired.\n
+    The user id is None if the expired key is not a heartbeat, as other keys in a shared redis expire too,
+    or if the event was trimmed from the stream or has no key.
     """
-    event = message[0][1][0] # This is where the event recides in
-    event_id = event[0]
-    key =  event[1]["key"]
+    key = (event or {}).get("key")
 
-    string_list = key.split(":")
-    user_id = string_list[1]
+    if not key or not key.startswith(format_key("heartbeat", "")):
+        return None
 
-    return event_id, user_id
+    return parse_hash_tag(key)
+
+def extract_stream_events(message: list) -> list[tuple[str, dict]]:
+    """
+    Parses the events read from a single stream and returns the id and the fields of each.
+    """
+    if not message:
+        return []
+    return message[0][1]
 
 async def does_key_exist(key: str, redis_connection: Redis) -> bool:
     """
@@ -1,54 +1,113 @@
 import asyncio
+import json
+import time
+from collections.abc import Awaitable, Callable
+from controllers.websocket_controller import WebSocketManager
 from fastapi import HTTPException
 from models.api_models import MatchRequest
 from redis.asyncio import Redis
-import requests
 from service.redis_confirmation_service import (
+    MATCH_ALREADY_CONFIRMED,
+    MATCH_CONFIRMED,
+    MATCH_NOT_FOUND,
+    USER_NOT_IN_MATCH,
     setup_match_confirmation,
-    check_match_exist,
-    check_match_user,
-    is_match_confirmed,
-    update_user_confirmation,
-    get_match_partner,
+    confirm_user_match,
+    expire_match,
     get_match_details,
     delete_match_record,
 )
+from service.batch_matching_engine import BATCH_ENGINE, MATCHING_ENGINE, batch_matching_engine
+from service.deadline_scheduler import deadline_scheduler
+from service.profile_resolver import profile_resolver
+from service.question_selector import question_selector
+from service.rating_service import (
+    RATING_WINDOW_MAX,
+    RATING_WINDOW_STEP,
+    get_rating_window,
+    get_user_rating,
+    is_rated_queue,
+)
 from service.redis_event_queue import send_match_confirmed_event
+from service.redis_telemetry_service import (
+    CONFIRMED,
+    DECLINED,
+    ENQUEUED,
+    MATCHED,
+    REMATCH_WAIT_HISTOGRAM,
+    REMATCHED,
+    REQUEUED,
+    TIMED_OUT,
+    record_event,
+)
 from service.redis_message_service import (
+    REQUEUED_MESSAGE,
     send_match_found_message,
     send_match_finalised_message,
+    send_match_requeued_message,
     send_match_terminated_message,
     wait_for_message,
     send_new_request_message,
+    save_match_status,
+    get_match_status,
+    clear_match_status,
 )
 from service.redis_matchmaking_service import (
-    add_user_queue_details,
-    find_partner,
+    ASYNC_MODE,
+    SYNC_MODE,
+    USER_MATCH_FOUND,
+    USER_NOT_IN_QUEUE,
+    USER_NOT_QUEUED,
+    USER_REMOVED,
+    LEASE_TTL,
+    WIDENING_STEPS,
+    find_partner_or_enqueue,
     enqueue_user,
+    get_widened_criteria,
+    get_widening_level,
+    widen_search,
+    requeue_user,
+    remove_waiting_user,
     remove_user_queue_details,
-    dequeue_user,
     check_user_in_any_queue,
-    find_user_in_queue,
     get_user_queue_details,
     check_user_found_match,
-    update_user_match_found_status,
+    renew_lease,
 )
 from utils.logger import log
 from utils.utils import (
-    format_lock_key,
     format_queue_key,
     format_in_queue_key,
     ping_redis_server,
     format_match_found_key,
     format_match_accepted_key,
     format_match_key,
-    acquire_lock,
-    release_lock,
-    get_envvar
+    format_match_status_key,
+    parse_hash_tag,
 )
-from uuid import uuid5, NAMESPACE_DNS
+from uuid import uuid4
+
+# How long a request waits in the queue for a partner
+MATCH_WAIT_TIMEOUT = 40
+
+# How often the lease of a waiting request is renewed, a few times within each lease
+LEASE_RENEW_INTERVAL = LEASE_TTL / 3
+
+# How long both users have to accept a match
+CONFIRMATION_TIMEOUT = 12
+
+# Kinds of deadlines handled by the deadline scheduler
+CONFIRMATION_DEADLINE = "match_confirmation"
+QUEUE_DEADLINE = "queue_timeout"
+WIDEN_DEADLINE = "widen_criteria"
 
-ENV_USER_SVC_USER_DETAILS_ENDPOINT = "USER_SERVICE_GET_USER_DETAILS_URL"
+# Events pushed to users matchmaking asynchronously
+MATCH_FOUND_EVENT = "match_found"
+MATCH_CONFIRMED_EVENT = "match_confirmed"
+MATCH_FAILED_EVENT = "match_failed"
+MATCH_REQUEUED_EVENT = "match_requeued"
+MATCH_TERMINATED_EVENT = "match_terminated"
+MATCH_TIMEOUT_EVENT = "match_timeout"
 
 def check_redis_connection(reds_connection: Redis):
     """
@@ -61,106 +120,287 @@ def check_redis_connection(reds_connection: Redis):
         return {"status": "success", "redis": "not responding"}
 
 
+async def notify_user(
+    user_id: str,
+    event: str,
+    message_conn: Redis,
+    websocket_manager: WebSocketManager,
+    **details: str,
+) -> None:
+    """
+    Records the event as the latest matchmaking status of the user and pushes it to their frontend.
+    """
+    status_key = format_match_status_key(user_id)
+    await save_match_status(status_key, {"status": event, **details}, message_conn)
+    await websocket_manager.send_message(user_id, details.get("match_id", ""), event, details)
+
+
 async def find_match(
     user_id: str,
     match_request: MatchRequest,
     matchmaking_conn: Redis,
     message_conn: Redis,
     confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+    mode: str = SYNC_MODE,
+    is_disconnected: Callable[[], Awaitable[bool]] | None = None,
 ) -> dict:
     """
     Finds a match based on the user topic and difficulty.\n
-    If no match is made then add the user into the queue
+    If no match is made then add the user into the queue.\n
+    In async mode the request returns immediately with a ticket and the match is pushed to the user's websocket,
+    and the client keeps its place in the queue by calling keep_alive.
+    In sync mode the lease is renewed while the client is still connected.
     """
     difficulty = match_request.difficulty
     category = match_request.category
 
     in_queue_key = format_in_queue_key(user_id)
     queue_key = format_queue_key(difficulty, category)
-    lock_key = format_lock_key(queue_key)
 
     # Check if the user is already in the queue, if they are means we need to cancel the old queue request
     if await check_user_in_any_queue(in_queue_key, matchmaking_conn):
         # We only cancle the old request if they have not found a match yet
         if not await terminate_previous_match_request(
-            user_id, matchmaking_conn, message_conn
+            user_id, matchmaking_conn, message_conn, websocket_manager
         ):
             raise HTTPException(
                 status_code=400,
                 detail="User has found a match, a new request cannot be made currently",
             )
 
-    # Ensure that at any time only 1 request is updating the redis queue
-    lock = await acquire_lock(lock_key, matchmaking_conn)
-    log.info(f"User id, {user_id} has acquired the lock with key: {lock_key}.")
-
-    try:
-        await add_user_queue_details(
-            in_queue_key, difficulty, category, matchmaking_conn
+    ticket = str(uuid4())
+    status_key = format_match_status_key(user_id)
+    await clear_match_status(status_key, message_conn)
+    await record_event(difficulty, category, ENQUEUED, matchmaking_conn)
+
+    queue_details = {
+        "difficulty": difficulty,
+        "category": category,
+        "difficulties": json.dumps(match_request.accepted_difficulties),
+        "categories": json.dumps(match_request.accepted_categories),
+    }
+
+    # The history service is only asked for the rating when the request can end up in a rated queue
+    rating = 0
+    if any(is_rated_queue(d, c) for d, c in get_widened_criteria(queue_details, len(WIDENING_STEPS))):
+        rating = await get_user_rating(user_id, matchmaking_conn)
+
+    if MATCHING_ENGINE == BATCH_ENGINE:
+        # The batch matching engine pairs the user on its next tick, widening their criteria as they wait
+        await enqueue_user(user_id, queue_key, match_request, mode, ticket, rating, matchmaking_conn)
+        partner = None
+    else:
+        # Pairing and enqueuing happen in a single script on redis, so no lock is needed
+        partner = await find_partner_or_enqueue(
+            user_id, queue_key, match_request, mode, ticket, rating, matchmaking_conn
         )
 
-        partner = await find_partner(queue_key, matchmaking_conn)
+    if partner is None:
+        log.info(f"Could not find a partner for {user_id}. Adding user to the queue")
 
-        if partner == "":  # No partner found then add the user to the queue
-            await enqueue_user(user_id, queue_key, matchmaking_conn)
-            log.info(
-                f"Could not find a partner for {user_id}. Adding user to the queue"
-            )
-        else:
-            
-            response = requests.get(
-                get_envvar(ENV_USER_SVC_USER_DETAILS_ENDPOINT),
-                headers= {"X-User-ID" : user_id}
+        delay = get_next_widening_delay(queue_details, 0)
+        if delay is not None and MATCHING_ENGINE != BATCH_ENGINE:
+            await deadline_scheduler.schedule(WIDEN_DEADLINE, delay, user_id, ticket, "1")
+
+        if mode == ASYNC_MODE:
+            await deadline_scheduler.schedule(
+                QUEUE_DEADLINE, MATCH_WAIT_TIMEOUT, user_id, ticket, queue_key
             )
+            return {"ticket": ticket, "message": "searching for a match"}
 
-            user_data = response.json()
-            user_name = f"{user_data["first_name"]} {user_data["last_name"]}"
+        # Then we will constantly poll until a match has been found
+        return await wait_for_match_with_lease(
+            user_id, ticket, match_request, matchmaking_conn, message_conn, is_disconnected
+        )
 
-            response = requests.get(
-                get_envvar(ENV_USER_SVC_USER_DETAILS_ENDPOINT),
-                headers= {"X-User-ID" : partner}
-            )
+    match_id, _, partner_name = await create_match(
+        user_id, partner, difficulty, category, matchmaking_conn, message_conn, confirmation_conn, websocket_manager
+    )
 
-            partner_data = response.json()
-            partner_name = f"{partner_data["first_name"]} {partner_data["last_name"]}"
+    if mode == ASYNC_MODE:
+        status = {
+            "status": MATCH_FOUND_EVENT,
+            "match_id": match_id,
+            "partner_name": partner_name,
+            "ticket": ticket,
+        }
+        await save_match_status(status_key, status, message_conn)
 
-            # Create a unique match ID
-            match_id = str(uuid5(NAMESPACE_DNS, user_id + partner))
+    return {"match_id": match_id, "partner_name": partner_name, "ticket": ticket, "message": "match has been found"}
 
-            # Create a table to store information on who has comfirm the match and who has not.
-            match_key = format_match_key(match_id)
-            await setup_match_confirmation(
-                match_key, partner, partner_name, user_id, user_name, difficulty, category, confirmation_conn
-            )
 
-            # Alert the other user through the message queue
-            message_key = format_match_found_key(partner)
-            await send_match_found_message(message_key, f"{match_id}_{user_name})", message_conn)
-            log.info(f"Notified {partner} that a match has been found.")
+async def create_match(
+    user_id: str,
+    partner: str,
+    difficulty: str,
+    category: str,
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+) -> tuple[str, str, str]:
+    """
+    Sets up the confirmation of a match between the two paired users on the given difficulty and category,
+    and alerts the partner that a match has been found.\n
+    Returns the match id, the user's name and the partner's name.
+    """
+    # Both names are looked up at once, after the pair has already been committed, so they fall back to the user ids
+    user_name, partner_name = await profile_resolver.get_names(user_id, partner)
 
-            partner_in_queue_key = format_in_queue_key(partner)
-            await update_user_match_found_status(in_queue_key, matchmaking_conn)
-            await update_user_match_found_status(partner_in_queue_key, matchmaking_conn)
+    joined_at = await asyncio.gather(
+        matchmaking_conn.hmget(format_in_queue_key(user_id), ["joined_at", "requeued_at"]),
+        matchmaking_conn.hmget(format_in_queue_key(partner), ["joined_at", "requeued_at"]),
+    )
+    now = time.time()
+    # Users put back into the queue after an unconfirmed match are timed from when they were put back
+    waits = [now - float(joined) for joined, requeued in joined_at if joined is not None and requeued is None]
+    rematch_waits = [now - float(requeued) for _, requeued in joined_at if requeued is not None]
+    await record_event(difficulty, category, MATCHED, matchmaking_conn, waits, count=2)
+    if rematch_waits:
+        await record_event(
+            difficulty, category, REMATCHED, matchmaking_conn, rematch_waits, len(rematch_waits), REMATCH_WAIT_HISTOGRAM
+        )
 
-            asyncio.create_task(
-                confirmation_lookout(
-                    match_key, matchmaking_conn, message_conn, confirmation_conn
-                )
+    # Create a unique match ID, the same two users may be matched again later
+    match_id = str(uuid4())
+
+    # Create a table to store information on who has comfirm the match and who has not.
+    match_key = format_match_key(match_id)
+    await setup_match_confirmation(
+        match_key, partner, partner_name, user_id, user_name, difficulty, category, confirmation_conn
+    )
+
+    # The question is picked while the users confirm, so it is ready once the match is confirmed
+    question_selector.prefetch(match_key, difficulty, category, confirmation_conn)
+
+    await notify_match_found(partner, match_id, user_name, matchmaking_conn, message_conn, websocket_manager)
+
+    await deadline_scheduler.schedule(CONFIRMATION_DEADLINE, CONFIRMATION_TIMEOUT, match_key)
+
+    log.info(f"A match has been made between {user_id} and {partner}.")
+    return match_id, user_name, partner_name
+
+
+async def notify_match_found(
+    user_id: str,
+    match_id: str,
+    partner_name: str,
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    websocket_manager: WebSocketManager,
+) -> None:
+    """
+    Alerts a waiting user through their websocket or the message queue they are waiting on that a match has been found.
+    """
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+    if queue_details.get("mode") == ASYNC_MODE:
+        await notify_user(
+            user_id,
+            MATCH_FOUND_EVENT,
+            message_conn,
+            websocket_manager,
+            match_id=match_id,
+            partner_name=partner_name,
+            ticket=queue_details.get("ticket", ""),
+        )
+    else:
+        message_key = format_match_found_key(user_id)
+        await send_match_found_message(message_key, f"{match_id}_{partner_name}", message_conn)
+    log.info(f"Notified {user_id} that a match has been found.")
+
+
+def get_next_widening_delay(queue_details: dict, waited: float) -> float | None:
+    """
+    Returns how long until the criteria of a user who has waited for the given number of seconds widen next,
+    either by accepting more queues or by growing their rating window, or None if they cannot widen any further.
+    """
+    delays = []
+
+    level = get_widening_level(waited)
+    widest_criteria = get_widened_criteria(queue_details, len(WIDENING_STEPS))
+    if level < len(WIDENING_STEPS) and len(widest_criteria) > len(get_widened_criteria(queue_details, level)):
+        delays.append(WIDENING_STEPS[level] - waited)
+
+    rated = any(is_rated_queue(d, c) for d, c in get_widened_criteria(queue_details, level))
+    if rated and get_rating_window(waited) < RATING_WINDOW_MAX:
+        delays.append(RATING_WINDOW_STEP)
+
+    return min(delays) if delays else None
+
+
+async def widen_criteria(
+    user_id: str,
+    ticket: str,
+    tick: int,
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+):
+    """
+    Widens the criteria of a request that is still waiting based on how long it has waited,
+    and searches the queues it now accepts and its rated queues with the wider rating window for a partner.\n
+    The tick counts the searches made, so the next search is a different deadline from the one being handled.
+    """
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+    if queue_details.get("ticket") != ticket or queue_details.get("match_found") != "0":
+        return
+
+    waited = time.time() - float(queue_details["joined_at"])
+    criteria = get_widened_criteria(queue_details, get_widening_level(waited))
+
+    # First come first served queues the user is already waiting in do not need to be searched again
+    joined_queues = set(queue_details.get("queues", "").split("\n"))
+    search_criteria = [
+        (difficulty, category)
+        for difficulty, category in criteria
+        if format_queue_key(difficulty, category) not in joined_queues or is_rated_queue(difficulty, category)
+    ]
+
+    if search_criteria:
+        result = await widen_search(user_id, ticket, search_criteria, get_rating_window(waited), matchmaking_conn)
+
+        if result is not None:
+            partner, position = result
+            difficulty, category = search_criteria[position]
+            match_id, _, partner_name = await create_match(
+                user_id, partner, difficulty, category, matchmaking_conn, message_conn, confirmation_conn, websocket_manager
             )
+            await notify_match_found(user_id, match_id, partner_name, matchmaking_conn, message_conn, websocket_manager)
+            return
 
-            log.info(f"A match has been made between {user_id} and {partner}.")
-            return {"match_id": match_id, "partner_name": partner_name, "message": "match has been found"}
-    finally:
-        # Redis Lock class handles if the lock is expired it will not release another person's lock
-        await release_lock(lock)
-        log.info(f"User id, {user_id} has released the lock with key: {lock_key} .")
+        log.info(f"Widened the criteria of {user_id} to {len(criteria)} queues after waiting {waited:.0f} seconds")
 
-    # Then we will constantly poll until a match has been found
-    return await wait_for_match(user_id, match_request, matchmaking_conn, message_conn)
+    delay = get_next_widening_delay(queue_details, waited)
+    if delay is not None:
+        await deadline_scheduler.schedule(WIDEN_DEADLINE, delay, user_id, ticket, str(tick + 1))
+
+
+async def queue_timeout_lookout(
+    user_id: str,
+    ticket: str,
+    queue_key: str,
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    websocket_manager: WebSocketManager,
+):
+    """
+    Removes an async request from the queue if no match has been found for it in time.
+    """
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+
+    # The ticket ensures a newer request from the same user is left alone
+    if await remove_waiting_user(user_id, queue_key, matchmaking_conn, ticket) == USER_REMOVED:
+        log.info(f"Could not find a match for {user_id}, removing them from the queue")
+        await record_event(queue_details["difficulty"], queue_details["category"], TIMED_OUT, matchmaking_conn)
+        await notify_user(
+            user_id, MATCH_TIMEOUT_EVENT, message_conn, websocket_manager, ticket=ticket
+        )
 
 
 async def wait_for_match(
-    user_id: str, match_request: MatchRequest, matchmaking_conn: Redis, message_conn: Redis
+    user_id: str, ticket: str, match_request: MatchRequest, matchmaking_conn: Redis, message_conn: Redis
 ) -> dict:
     """
     Waits for a match found message from the message queue for a period of time before returning.\n
@@ -170,23 +410,22 @@ async def wait_for_match(
     category = match_request.category
 
     message_key = format_match_found_key(user_id)
-    message = await wait_for_message(message_key, message_conn)
+    message = await wait_for_message(message_key, timeout=MATCH_WAIT_TIMEOUT)
 
     if message is None:
         queue_key = format_queue_key(difficulty, category)
-        lock_key = format_lock_key(queue_key)
-        lock = await acquire_lock(lock_key, matchmaking_conn)
-        log.info(f"User id, {user_id} has acquired the lock with key: {lock_key}.")
+        result = await remove_waiting_user(user_id, queue_key, matchmaking_conn, ticket)
 
-        in_queue_key = format_in_queue_key(user_id)
-        await remove_user_queue_details(in_queue_key, matchmaking_conn)
-        await dequeue_user(user_id, queue_key, matchmaking_conn)
+        if result == USER_MATCH_FOUND:
+            # A partner was found just as the wait timed out, so the match found message is on its way
+            message = await wait_for_message(message_key, timeout=10)
 
-        await release_lock(lock)
-        log.info(f"User id, {user_id} has released the lock with key: {lock_key} .")
-        log.info(f"Could not find a match for {user_id}, removing them from the queue")
-        return {"message": "could not find a match after 3 minutes"}
-    elif message[1] == "terminate":
+        if message is None:
+            log.info(f"Could not find a match for {user_id}, removing them from the queue")
+            await record_event(difficulty, category, TIMED_OUT, matchmaking_conn)
+            return {"message": "could not find a match after 3 minutes"}
+
+    if message[1] == "terminate":
         return {"message": "matchmaking has been terminated"}
     elif message[1] == "new request made":
         raise HTTPException(status_code=400, detail="A new request has been made")
@@ -194,11 +433,56 @@ async def wait_for_match(
         message_body = message[1]  # Index 0 is the key where the value is popped from
         match_id, partner_name = message_body.split("_")
         log.info(f"Hello I got a message {message_body}")
-        return {"match_id": match_id, "partner_name": partner_name, "message": "match has been found"}
+        return {"match_id": match_id, "partner_name": partner_name, "ticket": ticket, "message": "match has been found"}
+
+
+async def wait_for_match_with_lease(
+    user_id: str,
+    ticket: str,
+    match_request: MatchRequest,
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    is_disconnected: Callable[[], Awaitable[bool]] | None,
+) -> dict:
+    """
+    Waits for a match for a sync request, renewing its lease while it waits.
+    """
+    lease = asyncio.create_task(keep_lease(user_id, ticket, matchmaking_conn, is_disconnected))
+    try:
+        return await wait_for_match(user_id, ticket, match_request, matchmaking_conn, message_conn)
+    finally:
+        lease.cancel()
+
+
+async def keep_lease(
+    user_id: str, ticket: str, matchmaking_conn: Redis, is_disconnected: Callable[[], Awaitable[bool]] | None
+) -> None:
+    """
+    Renews the lease of a waiting sync request until it is no longer waiting or its client disconnects,
+    after which the lease runs out and the user is skipped by anyone searching for a partner.
+    """
+    while True:
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+        if is_disconnected is not None and await is_disconnected():
+            log.info(f"{user_id} disconnected while waiting for a match")
+            return
+        if not await renew_lease(user_id, ticket, matchmaking_conn):
+            return
+
+
+async def keep_alive(user_id: str, matchmaking_conn: Redis) -> dict:
+    """
+    Renews the lease of the user's async request, which has to be done more often than the lease runs out.
+    """
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+    if not await renew_lease(user_id, queue_details.get("ticket", ""), matchmaking_conn):
+        raise HTTPException(status_code=400, detail="User is not waiting for a match")
+
+    return {"ticket": queue_details["ticket"], "lease_seconds": LEASE_TTL, "message": "searching for a match"}
 
 
 async def terminate_previous_match_request(
-    user_id: str, matchmaking_conn: Redis, message_conn: Redis
+    user_id: str, matchmaking_conn: Redis, message_conn: Redis, websocket_manager: WebSocketManager
 ) -> bool:
     """
     Terminates the previous match request sent by the user.
@@ -218,7 +502,7 @@ async def terminate_previous_match_request(
         difficulty=difficulty, category=category
     )
     await terminate_match(
-        user_id, old_match_request, matchmaking_conn, message_conn, is_new_request=True
+        user_id, old_match_request, matchmaking_conn, message_conn, websocket_manager, is_new_request=True
     )
 
     return True
@@ -228,6 +512,7 @@ async def terminate_match(
     match_request: MatchRequest,
     matchmaking_conn: Redis,
     message_conn: Redis,
+    websocket_manager: WebSocketManager,
     is_new_request: bool = False,
 ) -> None:
     """
@@ -236,47 +521,44 @@ async def terminate_match(
     difficulty = match_request.difficulty
     category = match_request.category
 
-    in_queue_key = format_in_queue_key(user_id)
+    queue_key = format_queue_key(difficulty, category)
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+    ticket = queue_details.get("ticket", "")
+
+    # The checks and the removal happen in a single script so the user cannot be paired in between
+    result = await remove_waiting_user(user_id, queue_key, matchmaking_conn, ticket)
 
     # Check if the user is in the queue in the first place
-    if not await check_user_in_any_queue(in_queue_key, matchmaking_conn):
+    if result == USER_NOT_QUEUED:
         raise HTTPException(status_code=400, detail="User is not currently matchmaking")
 
     # Check if the user has found a match, if yes we cannot terminate
-    if await check_user_found_match(in_queue_key, matchmaking_conn):
+    if result == USER_MATCH_FOUND:
         raise HTTPException(
             status_code=400,
             detail="User has been paired with someone, cannot cancel request",
         )
 
-    queue_key = format_queue_key(difficulty, category)
-
-    if await find_user_in_queue(user_id, queue_key, matchmaking_conn) is None:
+    if result == USER_NOT_IN_QUEUE:
         raise HTTPException(
             status_code=400,
             detail=f"User is not queuing for {difficulty} and {category}",
         )
 
-    lock_key = format_lock_key(queue_key)
-
-    lock = await acquire_lock(lock_key, matchmaking_conn)
-    log.info(f"User id, {user_id} has acquired the lock with key: {lock_key}.")
-
-    try:
-        await dequeue_user(user_id, queue_key, matchmaking_conn)
-        await remove_user_queue_details(in_queue_key, matchmaking_conn)
-
-        message_key = format_match_found_key(user_id)
+    message_key = format_match_found_key(user_id)
 
-        if is_new_request:
-            await send_new_request_message(message_key, message_conn)
-        else:
-            await send_match_terminated_message(message_key, message_conn)
+    if queue_details.get("mode") == ASYNC_MODE:
+        # No request is waiting on the message queue, the new request replaces the old one silently
+        if not is_new_request:
+            await notify_user(
+                user_id, MATCH_TERMINATED_EVENT, message_conn, websocket_manager, ticket=ticket
+            )
+    elif is_new_request:
+        await send_new_request_message(message_key, message_conn)
+    else:
+        await send_match_terminated_message(message_key, message_conn)
 
-        log.info(f"{user_id} has terminated his matching.")
-    finally:
-        await release_lock(lock)
-        log.info(f"User id, {user_id} has released the lock with key: {lock_key} .")
+    log.info(f"{user_id} has terminated his matching.")
 
 
 async def confirm_match(
@@ -285,45 +567,64 @@ async def confirm_match(
     matchmaking_conn: Redis,
     message_conn: Redis,
     confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+    mode: str = SYNC_MODE,
+    is_disconnected: Callable[[], Awaitable[bool]] | None = None,
 ) -> dict:
     """
     Acknowledges the user's comfirmation with the given match id.\n
-    If the user is the second person who is accepting the match, they will initate the room creating in the collaboration service.
+    If the user is the second person who is accepting the match, they will initate the room creating in the collaboration service.\n
+    In async mode the request returns immediately and the outcome is pushed to the user's websocket.
+    In sync mode a user whose partner does not accept keeps waiting in the same request for their next match.
     """
     match_key = format_match_key(match_id)
 
-    if not await check_match_exist(match_key, confirmation_conn):
+    # Validating the user, recording the acceptance and checking the partner happen in a single step
+    result, match_info = await confirm_user_match(match_key, user_id, mode, confirmation_conn)
+
+    if result == MATCH_NOT_FOUND:
         raise HTTPException(status_code=400, detail="invalid match id.")
 
-    if not await check_match_user(user_id, match_key, confirmation_conn):
+    if result == USER_NOT_IN_MATCH:
         raise HTTPException(
             status_code=400, detail="user does not have access to this match."
         )
 
-    lock_key = format_lock_key(match_key)
-    lock = await acquire_lock(lock_key, confirmation_conn)
-    log.info(f"User id, {user_id} has acquired the lock with key: {lock_key}.")
+    if result == MATCH_ALREADY_CONFIRMED:
+        return {"match_details": match_id, "message": "starting match"}
 
-    try:
-        await update_user_confirmation(match_key, user_id, confirmation_conn)
-        log.debug("Checking both parties")
+    if result == MATCH_CONFIRMED:
         # The other user has accepted
-        if (await is_match_confirmed(match_key, confirmation_conn)):
-            log.debug("Confirmed")
-            partner = await get_match_partner(user_id, match_key, confirmation_conn)
+        log.debug("Confirmed")
+        partner_field = "user_two" if match_info["user_one"] == user_id else "user_one"
+        partner = match_info[partner_field]
+
+        if match_info.get(f"{partner_field}_mode") == ASYNC_MODE:
+            await notify_user(
+                partner, MATCH_CONFIRMED_EVENT, message_conn, websocket_manager, match_id=match_id
+            )
+        else:
             message_key = format_match_accepted_key(partner)
             await send_match_finalised_message(message_key, match_id, message_conn)
-            log.info(f"Match comfirm message has been sent for user id, {partner}.")
+        log.info(f"Match comfirm message has been sent for user id, {partner}.")
 
-            match_info = await get_match_details(match_key, confirmation_conn)
-            await send_match_confirmed_event(match_id, match_info["user_one"], match_info["user_one_name"], match_info["user_two"], match_info["user_two_name"], match_info["difficulty"], match_info["category"])
+        question = await question_selector.get_question(match_key, match_info, confirmation_conn)
+        await send_match_confirmed_event(match_id, match_info["user_one"], match_info["user_one_name"], match_info["user_two"], match_info["user_two_name"], match_info["difficulty"], match_info["category"], question)
+        await record_event(match_info["difficulty"], match_info["category"], CONFIRMED, matchmaking_conn)
 
-            return {"match_details": match_id, "message": "starting match"}
-    finally:
-        await release_lock(lock)
+        # The partner may not have a request waiting, so the second user to confirm cleans up the match
+        await cleanup(match_key, matchmaking_conn, confirmation_conn)
+        await deadline_scheduler.cancel(CONFIRMATION_DEADLINE, match_key)
+        if mode == ASYNC_MODE:
+            status = {"status": MATCH_CONFIRMED_EVENT, "match_id": match_id}
+            await save_match_status(format_match_status_key(user_id), status, message_conn)
+        return {"match_details": match_id, "message": "starting match"}
+
+    if mode == ASYNC_MODE:
+        return {"match_details": match_id, "message": "waiting for partner to accept the match"}
 
     return await wait_for_confirmation(
-        match_id, user_id, matchmaking_conn, message_conn, confirmation_conn
+        match_id, user_id, matchmaking_conn, message_conn, confirmation_conn, is_disconnected
     )
 
 
@@ -333,24 +634,35 @@ async def wait_for_confirmation(
     matchmaking_conn: Redis,
     message_conn: Redis,
     confirmation_conn: Redis,
+    is_disconnected: Callable[[], Awaitable[bool]] | None = None,
 ) -> dict:
     """
-    Waits for the other user to confirm their match.
+    Waits for the other user to confirm their match.\n
+    If the partner does not accept and the user has been put back into the queue, waits for their next match instead.
     """
     message_key = format_match_accepted_key(user_id)
     # Set timeout to be 15 seconds in case the redis server goes down it will return a response
     log.debug("Waiting for message")
-    message = await wait_for_message(message_key, message_conn, timeout=15)
+    message = await wait_for_message(message_key, timeout=15)
     log.debug("Message received")
 
+    if message is not None and message[1].startswith(f"{REQUEUED_MESSAGE}_"):
+        ticket = message[1].removeprefix(f"{REQUEUED_MESSAGE}_")
+        queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+        if queue_details:
+            log.info(f"The partner for user id, {user_id} has failed to accept the match, looking for another match")
+            match_request = MatchRequest(difficulty=queue_details["difficulty"], category=queue_details["category"])
+            return await wait_for_match_with_lease(
+                user_id, ticket, match_request, matchmaking_conn, message_conn, is_disconnected
+            )
+        message = None
+
     if message is None or message[1] == "":
         log.debug("Got a empty or no message")
         log.info(f"The partner for user id, {user_id} has failed to accept the match")
         return {"message": "partner failed to accept the match"}
     else:
         match_id = message[1] # Index 0 is the key where the value is popped from
-        match_key = format_match_key(match_id)
-        await cleanup(match_key, matchmaking_conn, confirmation_conn)
         return {"match_details": match_id, "message": "starting match"}
 
 
@@ -359,49 +671,196 @@ async def confirmation_lookout(
     matchmaking_conn: Redis,
     message_conn: Redis,
     confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
 ):
     """
-    Checks the match to see if both users has accepted.
+    Checks the match to see if both users has accepted, once the time to accept it has run out.
     """
-    log.info(f"Observer spawned for {match_key}")
-    await asyncio.sleep(12)
+    log.info(f"Confirmation deadline reached for {match_key}")
+
+    # Returns the details only if the match is still pending, which means that one user did not accept or no user has accepted
+    match_details = await expire_match(match_key, confirmation_conn)
+    if match_details is not None:
+        await record_event(match_details["difficulty"], match_details["category"], DECLINED, matchmaking_conn)
 
-    # This means that one user did not accept or no user has accepted
-    if await check_match_exist(match_key, confirmation_conn):
-        match_details = await get_match_details(match_key, confirmation_conn)
+        match_id = parse_hash_tag(match_key)
+        requeued = []
 
         # Inform the other user that
-        if match_details["user_one_confirmation"] == "1":
-            message_key = format_match_accepted_key(match_details["user_one"])
-            await send_match_finalised_message(message_key, "", message_conn)
-        elif match_details["user_two_confirmation"] == "1":
-            message_key = format_match_accepted_key(match_details["user_two"])
-            await send_match_finalised_message(message_key, "", message_conn)
+        for user in ("user_one", "user_two"):
+            if match_details[f"{user}_confirmation"] != "1":
+                continue
+
+            # The user who accepted goes back to the front of the queue instead of starting over
+            mode = match_details.get(f"{user}_mode", SYNC_MODE)
+            if await requeue_after_decline(
+                match_details[user], match_id, mode, matchmaking_conn, message_conn, confirmation_conn, websocket_manager
+            ):
+                requeued.append(match_details[user])
+                continue
+
+            if mode == ASYNC_MODE:
+                await notify_user(
+                    match_details[user], MATCH_FAILED_EVENT, message_conn, websocket_manager, match_id=match_id
+                )
+            else:
+                message_key = format_match_accepted_key(match_details[user])
+                await send_match_finalised_message(message_key, "", message_conn)
+
+        await cleanup(match_key, matchmaking_conn, confirmation_conn, keep=requeued)
+        log.info(f"{match_key} was not accepted in time and has been removed")
 
-        await cleanup(match_key, matchmaking_conn, confirmation_conn)
 
-    log.info(f"Observer is killed for {match_key}")
+async def requeue_after_decline(
+    user_id: str,
+    match_id: str,
+    mode: str,
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+) -> bool:
+    """
+    Puts a user who accepted a match their partner did not accept back into the queues they were waiting in,
+    ahead of everyone who joined after them, and tells them that matching continues.\n
+    The mode is how the user is waiting on their confirmation, which is how they are notified from now on.\n
+    Returns False if the user could not be put back, in which case their match has simply failed.
+    """
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+    if queue_details.get("match_found") != "1":
+        return False
+
+    ticket = str(uuid4())
+    waited = time.time() - float(queue_details["joined_at"])
+    criteria = get_widened_criteria(queue_details, get_widening_level(waited))
+    requeued, pair = await requeue_user(
+        user_id,
+        queue_details["ticket"],
+        ticket,
+        criteria,
+        get_rating_window(waited),
+        MATCHING_ENGINE != BATCH_ENGINE,
+        mode,
+        matchmaking_conn,
+    )
+    if not requeued:
+        return False
+
+    difficulty = queue_details["difficulty"]
+    category = queue_details["category"]
+    await record_event(difficulty, category, REQUEUED, matchmaking_conn)
+
+    if mode == ASYNC_MODE:
+        await notify_user(
+            user_id, MATCH_REQUEUED_EVENT, message_conn, websocket_manager, match_id=match_id, ticket=ticket
+        )
+    else:
+        await send_match_requeued_message(format_match_accepted_key(user_id), ticket, message_conn)
+
+    if pair is not None:
+        partner, position = pair
+        new_match_id, _, partner_name = await create_match(
+            user_id, partner, *criteria[position], matchmaking_conn, message_conn, confirmation_conn, websocket_manager
+        )
+        await notify_match_found(user_id, new_match_id, partner_name, matchmaking_conn, message_conn, websocket_manager)
+        return True
+
+    delay = get_next_widening_delay(queue_details, waited)
+    if delay is not None and MATCHING_ENGINE != BATCH_ENGINE:
+        await deadline_scheduler.schedule(WIDEN_DEADLINE, delay, user_id, ticket, "1")
+
+    if mode == ASYNC_MODE:
+        await deadline_scheduler.schedule(
+            QUEUE_DEADLINE, MATCH_WAIT_TIMEOUT, user_id, ticket, format_queue_key(difficulty, category)
+        )
+
+    log.info(f"{user_id} has been put back into the queue after {match_id} was not confirmed")
+    return True
 
 
-async def cleanup(match_key: str, matchmaking_conn: Redis, confirmation_conn: Redis):
+def register_deadline_handlers(
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+) -> None:
     """
-    Cleans up redis services.
+    Registers what happens when the deadlines scheduled by the matching service are due.
     """
-    lock_key = format_lock_key(match_key)
-    lock = await acquire_lock(lock_key, confirmation_conn)
-    log.info(
-        f"Backend matching service has acquired the lock with key: {lock_key} for cleaning up"
+    deadline_scheduler.register(
+        CONFIRMATION_DEADLINE,
+        lambda match_key: confirmation_lookout(
+            match_key, matchmaking_conn, message_conn, confirmation_conn, websocket_manager
+        ),
+    )
+    deadline_scheduler.register(
+        QUEUE_DEADLINE,
+        lambda user_id, ticket, queue_key: queue_timeout_lookout(
+            user_id, ticket, queue_key, matchmaking_conn, message_conn, websocket_manager
+        ),
+    )
+    deadline_scheduler.register(
+        WIDEN_DEADLINE,
+        lambda user_id, ticket, tick: widen_criteria(
+            user_id, ticket, int(tick), matchmaking_conn, message_conn, confirmation_conn, websocket_manager
+        ),
     )
 
+
+def register_batch_match_handler(
+    matchmaking_conn: Redis,
+    message_conn: Redis,
+    confirmation_conn: Redis,
+    websocket_manager: WebSocketManager,
+) -> None:
+    """
+    Registers how the pairs committed by the batch matching engine are turned into matches.\n
+    Both users are waiting, so both are alerted through their websocket or match found message queue.
+    """
+    async def handle_batch_match(user_id: str, partner: str, difficulty: str, category: str) -> None:
+        match_id, _, partner_name = await create_match(
+            user_id, partner, difficulty, category, matchmaking_conn, message_conn, confirmation_conn, websocket_manager
+        )
+        await notify_match_found(user_id, match_id, partner_name, matchmaking_conn, message_conn, websocket_manager)
+
+    batch_matching_engine.register(handle_batch_match)
+
+
+async def cleanup(match_key: str, matchmaking_conn: Redis, confirmation_conn: Redis, keep: list[str] | None = None):
+    """
+    Cleans up redis services.\n
+    The queue details of the users to keep are left alone, as they have been put back into the queue.\n
+    Only called by whoever moved the match out of pending, so no lock is needed.
+    """
     match_details = await get_match_details(match_key, confirmation_conn)
 
-    user_one_in_queue_key = format_in_queue_key(match_details["user_one"])
-    user_two_in_queue_key = format_in_queue_key(match_details["user_two"])
+    # The match may already have been cleaned up
+    if not match_details:
+        return
 
-    await remove_user_queue_details(user_one_in_queue_key, matchmaking_conn)
-    await remove_user_queue_details(user_two_in_queue_key, matchmaking_conn)
+    for user in ("user_one", "user_two"):
+        if match_details[user] not in (keep or []):
+            await remove_user_queue_details(format_in_queue_key(match_details[user]), matchmaking_conn)
 
     await delete_match_record(match_key, confirmation_conn)
+    log.info(f"Backend matching service has cleaned up {match_key}")
+
 
-    await release_lock(lock)
-    log.info(f"Backend matching service has release the lock with key: {lock_key} ")
+async def check_match_status(user_id: str, matchmaking_conn: Redis, message_conn: Redis) -> dict:
+    """
+    Retrieves the latest matchmaking event of the user, for clients that reconnect and may have missed a pushed event.
+    """
+    status = await get_match_status(format_match_status_key(user_id), message_conn)
+    if status is not None:
+        return status
+
+    queue_details = await get_user_queue_details(format_in_queue_key(user_id), matchmaking_conn)
+    if not queue_details:
+        return {"status": "idle"}
+
+    return {
+        "status": "paired" if queue_details.get("match_found") == "1" else "queued",
+        "ticket": queue_details.get("ticket", ""),
+        "difficulty": queue_details["difficulty"],
+        "category": queue_details["category"],
+    }
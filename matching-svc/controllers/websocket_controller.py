@@ -0,0 +1,74 @@
+import json
+import ssl
+
+import websockets
+from websockets import ClientConnection
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_API_WEBSOCKET_URL = "GATEWAY_WEBSOCKET_URL"
+RUN_TYPE = get_envvar("RUN_TYPE")
+
+
+class WebSocketManager:
+    """
+    Pushes matchmaking events to users through the API gateway, which forwards them to the user's frontend socket.
+    """
+
+    def __init__(self, instance_id: str):
+        self.active_connection: ClientConnection | None = None
+        self.url = f"{get_envvar(ENV_API_WEBSOCKET_URL)}?instance_id={instance_id}"
+        self.ssl_context = None
+        if RUN_TYPE != "local":
+            # Create SSL context that verifies certificates properly
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            self.ssl_context = ssl_context
+
+    async def connect(self) -> None:
+        """
+        Establishes a WebSocket connection with the API gateway.\n
+        Failing to connect is not fatal, the connection is retried on the next message sent.
+        """
+        log.info(f"Connecting to API gateway WebSocket at {self.url}")
+        try:
+            self.active_connection = await websockets.connect(self.url, ssl=self.ssl_context)
+        except (OSError, TimeoutError, WebSocketException) as e:
+            self.active_connection = None
+            log.error(f"Unable to establish a WebSocket connection with API gateway {self.url}: {e}")
+
+    async def disconnect(self) -> None:
+        """
+        Disconnects the WebSocket connection.
+        """
+        if self.active_connection:
+            await self.active_connection.close()
+            self.active_connection = None
+
+    async def send_message(self, receiver: str, match_id: str, body: str, details: dict | None = None) -> bool:
+        """
+        Sends a message though the WebSocket to the API gateway.\n
+        Returns False if the message could not be delivered, the user can still retrieve it from the status endpoint.
+        """
+        message = {"user_id": receiver, "match_id": match_id, "message": body, **(details or {})}
+        log.info(f"Sending message to API gateway: {message}")
+
+        # Reconnect once if the gateway dropped the connection
+        for _ in range(2):
+            if self.active_connection is None:
+                await self.connect()
+            if self.active_connection is None:
+                break
+
+            try:
+                await self.active_connection.send(json.dumps(message))
+                return True
+            except ConnectionClosed:
+                log.warning("WebSocket connection to API gateway is closed, reconnecting.")
+                self.active_connection = None
+
+        log.warning(f"Could not push {body} to user id, {receiver}.")
+        return False
@@ -1,6 +1,32 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import Annotated
 
+# Each difficulty and category pair the user accepts is a queue searched in a single redis call,
+# so the accepted criteria are kept small
+MAX_ACCEPTED_CRITERIA = 5
+
+# Difficulties and categories are part of the queue keys and of the newline separated "queues" field,
+# so they cannot contain newlines, colons or braces
+CriteriaName = Annotated[str, Field(min_length=1, max_length=100, pattern=r"^[^\r\n:{}]+$")]
+
 class MatchRequest(BaseModel):
-    difficulty: Annotated[str, Field(min_length=1)]
-    category: Annotated[str, Field(min_length=1)]
+    difficulty: CriteriaName
+    category: CriteriaName
+    # Other difficulties and categories the user is willing to be matched on once they have waited for a while
+    accepted_difficulties: Annotated[list[CriteriaName], Field(max_length=MAX_ACCEPTED_CRITERIA)] = []
+    accepted_categories: Annotated[list[CriteriaName], Field(max_length=MAX_ACCEPTED_CRITERIA)] = []
+
+    @model_validator(mode="after")
+    def check_accepted_criteria(self) -> "MatchRequest":
+        """
+        Rejects accepted difficulties and categories that are repeated or are the preferred ones.
+        """
+        for preferred, accepted in (
+            (self.difficulty, self.accepted_difficulties),
+            (self.category, self.accepted_categories),
+        ):
+            if len(set(accepted)) != len(accepted):
+                raise ValueError("Accepted difficulties and categories must not be repeated")
+            if preferred in accepted:
+                raise ValueError(f"{preferred} is already preferred and cannot also be accepted")
+        return self
@@ -1,21 +1,40 @@
 from contextlib import asynccontextmanager
 from controllers.matching_controller import (
     find_match,
+    keep_alive,
     check_redis_connection,
+    check_match_status,
     confirm_match,
+    register_batch_match_handler,
+    register_deadline_handlers,
     terminate_match,
 )
-from fastapi import FastAPI, Header
+from controllers.websocket_controller import WebSocketManager
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from models.api_models import MatchRequest
+from service.redis_batcher import AutoBatchingRedis
+from service.batch_matching_engine import BATCH_ENGINE, MATCHING_ENGINE, batch_matching_engine
+from service.deadline_scheduler import deadline_scheduler
+from service.key_sweeper import key_sweeper
+from service.message_dispatcher import message_dispatcher
 from service.redis_confirmation_service import connect_to_redis_confirmation_service
-from service.redis_message_service import connect_to_redis_message_service
-from service.redis_matchmaking_service import connect_to_redis_matchmaking_service
+from service.profile_resolver import profile_resolver
+from service.question_selector import question_selector
+from service.redis_event_queue import room_event_producer
+from service.redis_message_service import connect_to_redis_message_service, connect_to_redis_message_subscriber
+from service.redis_telemetry_service import format_metrics, get_all_queue_stats, get_queue_stats
+from service.redis_matchmaking_service import (
+    ASYNC_MODE,
+    connect_to_redis_matchmaking_service,
+)
 from typing import Annotated
 from utils.logger import log
 from utils.utils import sever_connection, get_envvar
 
 from controllers.heartbeat_controller import (
+    INSTANCE_ID,
     register_heartbeat,
     register_self_as_service,
 )
@@ -32,18 +51,66 @@ async def lifespan(app: FastAPI):
     """
     Set up variables for the matching service.
     """
-    app.state.redis_matchmaking_service = connect_to_redis_matchmaking_service()
+    # Small reads from concurrent requests are coalesced into shared round trips
+    app.state.redis_matchmaking_service = AutoBatchingRedis(
+        connect_to_redis_matchmaking_service()
+    )
     app.state.redis_message_service = connect_to_redis_message_service()
-    app.state.redis_confirmation_service = connect_to_redis_confirmation_service()
+    # Waiting requests are woken by a single subscription instead of a blocked connection each
+    message_dispatcher.start(app.state.redis_message_service, connect_to_redis_message_subscriber)
+    app.state.redis_confirmation_service = AutoBatchingRedis(
+        connect_to_redis_confirmation_service()
+    )
+    # Confirmed matches are handed to the collaboration service over one long lived client
+    room_event_producer.start()
+    # User names are looked up over one pooled client and cached
+    profile_resolver.start()
+    # Questions are picked from the question service while the users confirm their match
+    question_selector.start()
+    # Pushes events to users matchmaking asynchronously
+    app.state.websocket_manager = WebSocketManager(INSTANCE_ID)
+    await app.state.websocket_manager.connect()
+    # Confirmation and queue timeouts are kept in redis so they survive restarts
+    register_deadline_handlers(
+        app.state.redis_matchmaking_service,
+        app.state.redis_message_service,
+        app.state.redis_confirmation_service,
+        app.state.websocket_manager,
+    )
+    deadline_scheduler.start(app.state.redis_confirmation_service)
+    # Waiting users are paired once per tick instead of on arrival
+    if MATCHING_ENGINE == BATCH_ENGINE:
+        register_batch_match_handler(
+            app.state.redis_matchmaking_service,
+            app.state.redis_message_service,
+            app.state.redis_confirmation_service,
+            app.state.websocket_manager,
+        )
+        batch_matching_engine.start(app.state.redis_matchmaking_service, INSTANCE_ID)
+    # Keys left behind by clients that disappeared are reclaimed in the background
+    key_sweeper.start(
+        app.state.redis_matchmaking_service,
+        app.state.redis_message_service,
+        app.state.redis_confirmation_service,
+        INSTANCE_ID,
+    )
     log.info("Matching service is Up.")
     register_self_as_service(app)
     hc_task = register_heartbeat()
     yield
     # This is the shut down procedure when the matching service stops.
     log.info("Matching service shutting down.")
+    await key_sweeper.stop()
+    await batch_matching_engine.stop()
+    await deadline_scheduler.stop()
+    await message_dispatcher.stop()
+    await room_event_producer.stop()
+    await profile_resolver.stop()
+    await question_selector.stop()
     await sever_connection(app.state.redis_matchmaking_service)
     await sever_connection(app.state.redis_message_service)
     await sever_connection(app.state.redis_confirmation_service)
+    await app.state.websocket_manager.disconnect()
     hc_task.cancel()
 
 
@@ -75,14 +142,101 @@ async def check_message_connection():
     return check_redis_connection(app.state.redis_message_queue)
 
 
+@app.get("/stats/redis_batching", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def redis_batching_stats():
+    return {
+        "matchmaking": app.state.redis_matchmaking_service.metrics.snapshot(),
+        "confirmation": app.state.redis_confirmation_service.metrics.snapshot(),
+    }
+
+
+@app.get("/stats/message_dispatcher", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def message_dispatcher_stats():
+    return message_dispatcher.snapshot()
+
+
+@app.get("/stats/deadlines", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def deadline_stats():
+    return await deadline_scheduler.snapshot()
+
+
+@app.get("/stats/batch_matching", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def batch_matching_stats():
+    return batch_matching_engine.snapshot()
+
+
+@app.get("/stats/profiles", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def profile_stats():
+    return profile_resolver.snapshot()
+
+
+@app.get("/stats/questions", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def question_stats():
+    return question_selector.snapshot()
+
+
+@app.get("/stats/room_events", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def room_event_stats():
+    return await room_event_producer.snapshot()
+
+
+@app.get("/stats/sweeper", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def sweeper_stats():
+    return await key_sweeper.snapshot()
+
+
+@app.get("/stats/queues", openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def queue_stats():
+    return await get_all_queue_stats(app.state.redis_matchmaking_service)
+
+
+@app.get("/stats/queues/{difficulty}/{category}", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]})
+async def single_queue_stats(difficulty: str, category: str):
+    return await get_queue_stats(difficulty, category, app.state.redis_matchmaking_service)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, openapi_extra={"x-roles": [ADMIN_ROLE]})
+async def metrics():
+    return format_metrics(await get_all_queue_stats(app.state.redis_matchmaking_service))
+
+
 @app.post("/find_match", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]})
-async def match(match_request: MatchRequest, x_user_id: Annotated[str, Header()]):
+async def match(match_request: MatchRequest, x_user_id: Annotated[str, Header()], request: Request):
     return await find_match(
         x_user_id,
         match_request,
         app.state.redis_matchmaking_service,
         app.state.redis_message_service,
         app.state.redis_confirmation_service,
+        app.state.websocket_manager,
+        is_disconnected=request.is_disconnected,
+    )
+
+
+@app.post("/find_match/async", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]})
+async def match_async(match_request: MatchRequest, x_user_id: Annotated[str, Header()]):
+    return await find_match(
+        x_user_id,
+        match_request,
+        app.state.redis_matchmaking_service,
+        app.state.redis_message_service,
+        app.state.redis_confirmation_service,
+        app.state.websocket_manager,
+        mode=ASYNC_MODE,
+    )
+
+
+@app.post("/keep_alive", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]})
+async def keep_match_request_alive(x_user_id: Annotated[str, Header()]):
+    return await keep_alive(x_user_id, app.state.redis_matchmaking_service)
+
+
+@app.get("/match_status", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]})
+async def match_status(x_user_id: Annotated[str, Header()]):
+    return await check_match_status(
+        x_user_id,
+        app.state.redis_matchmaking_service,
+        app.state.redis_message_service,
     )
 
 
@@ -93,13 +247,14 @@ async def terminate(cancel_request: MatchRequest, x_user_id: Annotated[str, Head
         cancel_request,
         app.state.redis_matchmaking_service,
         app.state.redis_message_service,
+        app.state.websocket_manager,
     )
 
 
 @app.post(
     "/confirm_match/{match_id}", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]}
 )
-async def confirm_user_match(match_id: str, x_user_id: Annotated[str, Header()]):
+async def confirm_user_match(match_id: str, x_user_id: Annotated[str, Header()], request: Request):
     log.debug("Confirm match endpoint called")
     return await confirm_match(
         match_id,
@@ -107,6 +262,23 @@ async def confirm_user_match(match_id: str, x_user_id: Annotated[str, Header()])
         app.state.redis_matchmaking_service,
         app.state.redis_message_service,
         app.state.redis_confirmation_service,
+        app.state.websocket_manager,
+        is_disconnected=request.is_disconnected,
+    )
+
+
+@app.post(
+    "/confirm_match/{match_id}/async", openapi_extra={"x-roles": [ADMIN_ROLE, USER_ROLE]}
+)
+async def confirm_user_match_async(match_id: str, x_user_id: Annotated[str, Header()]):
+    return await confirm_match(
+        match_id,
+        x_user_id,
+        app.state.redis_matchmaking_service,
+        app.state.redis_message_service,
+        app.state.redis_confirmation_service,
+        app.state.websocket_manager,
+        mode=ASYNC_MODE,
     )
 
 if get_envvar("ENVIRONMENT") =="DEV":
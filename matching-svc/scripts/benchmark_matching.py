@@ -0,0 +1,464 @@
+"""
+Load tests the matching service by driving find_match, terminate_match and confirm_match with simulated users
+against the redis servers in the service's environment, with the user and question services and the API gateway stubbed out.
+
+Each simulated user arrives, asks for a match, may cancel or silently vanish before one is found, and accepts or
+lets the match expire once paired. Users whose partner lets the match expire are put back into the queue and
+carry on from there. The report covers throughput, latency percentiles, time spent waiting on locks and redis
+commands per confirmed match, so changes to the matching engine can be compared before they are rolled out.
+
+Use a redis server that nothing else is using, as the users join the same queues as real ones would.
+Run from the matching-svc directory:
+    python -m scripts.benchmark_matching --users 2000 --rate 50 --arrivals poisson --mode async
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from uuid import uuid4
+
+from fastapi import HTTPException
+from redis.asyncio import Redis
+
+from controllers import matching_controller
+from controllers.matching_controller import (
+    LEASE_RENEW_INTERVAL,
+    MATCH_CONFIRMED_EVENT,
+    MATCH_FAILED_EVENT,
+    MATCH_FOUND_EVENT,
+    MATCH_REQUEUED_EVENT,
+    MATCH_TERMINATED_EVENT,
+    MATCH_TIMEOUT_EVENT,
+    confirm_match,
+    find_match,
+    keep_alive,
+    register_batch_match_handler,
+    register_deadline_handlers,
+    terminate_match,
+)
+from models.api_models import MatchRequest
+from scripts.simulate_matching import generate_arrivals
+from service.batch_matching_engine import (
+    BATCH_ENGINE,
+    MATCHING_ENGINE,
+    batch_matching_engine,
+)
+from service.deadline_scheduler import deadline_scheduler
+from service.message_dispatcher import message_dispatcher
+from service.profile_resolver import profile_resolver
+from service.question_selector import question_selector
+from service.redis_batcher import AutoBatchingRedis
+from service.redis_confirmation_service import connect_to_redis_confirmation_service
+from service.redis_event_queue import room_event_producer
+from service.redis_matchmaking_service import (
+    ASYNC_MODE,
+    SYNC_MODE,
+    connect_to_redis_matchmaking_service,
+)
+from service.redis_message_service import (
+    connect_to_redis_message_service,
+    connect_to_redis_message_subscriber,
+)
+from utils.utils import sever_connection
+
+POISSON = "poisson"
+UNIFORM = "uniform"
+BURST = "burst"
+
+
+class TimedLock(asyncio.Lock):
+    """
+    Lock that adds up how long its callers waited to acquire it.
+    """
+
+    waited = 0.0
+    acquisitions = 0
+    longest = 0.0
+
+    async def acquire(self) -> bool:
+        started = time.perf_counter()
+        result = await super().acquire()
+        waited = time.perf_counter() - started
+        TimedLock.waited += waited
+        TimedLock.acquisitions += 1
+        TimedLock.longest = max(TimedLock.longest, waited)
+        return result
+
+
+class SimulatedGateway:
+    """
+    Stands in for the API gateway websocket, handing the pushed events to the simulated users.
+    """
+
+    def __init__(self):
+        self.inboxes: dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
+
+    async def send_message(self, receiver: str, match_id: str, body: str, details: dict | None = None) -> bool:
+        await self.inboxes[receiver].put({"message": body, "match_id": match_id, **(details or {})})
+        return True
+
+    async def next_event(self, user_id: str, *events: str, timeout: float) -> dict | None:
+        """
+        Waits for the next of the given events pushed to the user, ignoring the others.
+        """
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = await asyncio.wait_for(self.inboxes[user_id].get(), remaining)
+            except TimeoutError:
+                return None
+            if event["message"] in events:
+                return event
+        return None
+
+
+class Benchmark:
+    """
+    Runs the simulated users through the matching controller and records what happened to them.
+    """
+
+    def __init__(self, args: argparse.Namespace, matchmaking_conn: Redis, message_conn: Redis, confirmation_conn: Redis):
+        self.args = args
+        self.mode = args.mode
+        self.rng = random.Random(args.seed)
+        self.matchmaking_conn = matchmaking_conn
+        self.message_conn = message_conn
+        self.confirmation_conn = confirmation_conn
+        self.gateway = SimulatedGateway()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def timed(self, name: str):
+        started = time.perf_counter()
+        yield
+        self.latencies[name].append(time.perf_counter() - started)
+
+    async def run_user(self, user: dict, started: float) -> None:
+        await asyncio.sleep(max(started + user["arrived_at"] - time.monotonic(), 0))
+        try:
+            await self._run_user(user)
+        except Exception as e:  # noqa: BLE001
+            self.outcomes["errors"] += 1
+            self.outcomes[f"error: {e}"] += 1
+
+    async def _run_user(self, user: dict) -> None:
+        user_id = user["user_id"]
+        request = MatchRequest(
+            difficulty=user["difficulty"],
+            category=user["category"],
+            accepted_difficulties=json.loads(user["difficulties"]),
+            accepted_categories=json.loads(user["categories"]),
+        )
+        arrived = time.perf_counter()
+        patience = self.rng.uniform(0, self.args.wait_timeout) if self.rng.random() < self.args.disconnect else None
+        # A user who vanishes closes the page without cancelling, so their client stops renewing the lease
+        vanish_after = self.rng.uniform(0, self.args.wait_timeout) if self.rng.random() < self.args.vanish else None
+
+        async def is_disconnected() -> bool:
+            return vanish_after is not None and time.perf_counter() - arrived >= vanish_after
+
+        disconnect = None
+        if patience is not None:
+            disconnect = asyncio.create_task(self.disconnect(user_id, request, patience))
+
+        with self.timed("find_match"):
+            result = await self.call(find_match, user_id, request, is_disconnected=is_disconnected)
+        match_id = result.get("match_id") if result else None
+
+        lease = None
+        if match_id is None and self.mode == ASYNC_MODE and result is not None:
+            lease = asyncio.create_task(self.keep_alive(user_id, is_disconnected))
+
+        if match_id is None and self.mode == ASYNC_MODE and result is not None:
+            event = await self.gateway.next_event(
+                user_id, MATCH_FOUND_EVENT, MATCH_TIMEOUT_EVENT, MATCH_TERMINATED_EVENT,
+                timeout=self.args.wait_timeout + 15,
+            )
+            if event is not None and event["message"] == MATCH_FOUND_EVENT:
+                match_id = event["match_id"]
+
+        for task in (disconnect, lease):
+            if task is not None:
+                task.cancel()
+
+        if vanish_after is not None and await is_disconnected():
+            # Nobody is left to accept the match, which wastes the partner's confirmation
+            self.outcomes["vanished_then_matched" if match_id else "vanished"] += 1
+            return
+
+        if match_id is None:
+            self.outcomes["disconnected" if patience is not None else "timed_out"] += 1
+            return
+
+        self.latencies["time_to_match"].append(time.perf_counter() - arrived)
+        self.outcomes["matched"] += 1
+
+        # A user whose partner does not accept is put back into the queue and may be matched again
+        while match_id is not None:
+            match_id = await self.confirm(user_id, match_id, arrived, is_disconnected)
+
+    async def confirm(self, user_id: str, match_id: str, arrived: float, is_disconnected) -> str | None:
+        """
+        Accepts or ignores the match, and returns the next match if the partner did not accept and the user
+        was matched again after being put back into the queue.
+        """
+        if self.rng.random() >= self.args.accept:
+            self.outcomes["declined"] += 1
+            return None
+
+        await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+        with self.timed("confirm_match"):
+            result = await self.call(confirm_match, match_id, user_id, is_disconnected=is_disconnected)
+        if result is None:
+            return None
+
+        requeued_at = None
+        if self.mode == ASYNC_MODE and result["message"] != "starting match":
+            event = await self.gateway.next_event(
+                user_id,
+                MATCH_CONFIRMED_EVENT,
+                MATCH_FAILED_EVENT,
+                MATCH_REQUEUED_EVENT,
+                timeout=matching_controller.CONFIRMATION_TIMEOUT + 5,
+            )
+            result = {"message": "starting match" if event and event["message"] == MATCH_CONFIRMED_EVENT else "failed"}
+            if event is not None and event["message"] == MATCH_REQUEUED_EVENT:
+                requeued_at = time.perf_counter()
+                lease = asyncio.create_task(self.keep_alive(user_id, is_disconnected))
+                event = await self.gateway.next_event(
+                    user_id, MATCH_FOUND_EVENT, MATCH_TIMEOUT_EVENT, timeout=self.args.wait_timeout + 15
+                )
+                lease.cancel()
+                found = event is not None and event["message"] == MATCH_FOUND_EVENT
+                result = {"message": "requeued", "match_id": event["match_id"] if found else None}
+        elif result["message"] not in ("starting match", "partner failed to accept the match"):
+            # A sync confirmation whose partner did not accept waits for the next match and returns it
+            result["message"] = "requeued"
+
+        if result["message"] == "starting match":
+            self.outcomes["confirmed"] += 1
+            self.latencies["time_to_confirm"].append(time.perf_counter() - arrived)
+            return None
+
+        if result["message"] != "requeued":
+            self.outcomes["partner_failed_to_accept"] += 1
+            return None
+
+        self.outcomes["requeued"] += 1
+        if result.get("match_id") is None:
+            self.outcomes["requeued_then_timed_out"] += 1
+            return None
+
+        # The wait of a sync request cannot be told apart from its confirmation, the service's telemetry measures both
+        if requeued_at is not None:
+            self.latencies["time_to_rematch"].append(time.perf_counter() - requeued_at)
+        self.outcomes["rematched"] += 1
+        return result["match_id"]
+
+    async def disconnect(self, user_id: str, request: MatchRequest, patience: float) -> None:
+        # Leaving after a match was found fails, just like a real client that closed the page too late
+        await asyncio.sleep(patience)
+        with self.timed("terminate_match"):
+            await self.call(terminate_match, user_id, request)
+
+    async def keep_alive(self, user_id: str, is_disconnected) -> None:
+        # Renews the lease of an async request like the client does, until the user vanishes
+        while not await is_disconnected():
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+            try:
+                await keep_alive(user_id, self.matchmaking_conn)
+            except HTTPException:
+                return
+
+    async def call(self, endpoint, *args, **kwargs) -> dict | None:
+        """
+        Calls the controller like the routes do, counting the HTTP errors it raises.
+        """
+        connections = [self.matchmaking_conn, self.message_conn]
+        if endpoint is not terminate_match:
+            connections.append(self.confirmation_conn)
+            kwargs["mode"] = self.mode
+        if self.mode == ASYNC_MODE:
+            kwargs.pop("is_disconnected", None)
+        try:
+            return await endpoint(*args, *connections, self.gateway, **kwargs)
+        except HTTPException as e:
+            self.outcomes[f"{endpoint.__name__} {e.status_code}"] += 1
+            return None
+
+
+def spread_arrivals(arrivals: list[dict], distribution: str, rate: float, burst_size: int) -> list[dict]:
+    """
+    Retimes the arrivals, which arrive as a poisson process, to follow the given distribution with the same rate.
+    """
+    for i, user in enumerate(arrivals):
+        if distribution == UNIFORM:
+            user["arrived_at"] = i / rate
+        elif distribution == BURST:
+            user["arrived_at"] = (i // burst_size) * burst_size / rate
+    return arrivals
+
+
+async def count_commands(*connections: Redis) -> int:
+    """
+    Returns the number of commands processed by the distinct redis servers behind the connections.
+    """
+    servers = {}
+    for connection in connections:
+        kwargs = connection.connection_pool.connection_kwargs
+        servers[(kwargs.get("host"), kwargs.get("port"))] = connection
+    stats = await asyncio.gather(*(connection.info("stats") for connection in servers.values()))
+    return sum(int(stat["total_commands_processed"]) for stat in stats)
+
+
+def percentiles(values: list[float]) -> dict:
+    ordered = sorted(values)
+
+    def at(p: float) -> float:
+        return round(ordered[min(int(p * len(ordered)), len(ordered) - 1)] * 1000, 2) if ordered else 0.0
+
+    return {"count": len(ordered), "p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99), "max_ms": at(1.0)}
+
+
+async def run(args: argparse.Namespace) -> dict:
+    matching_controller.MATCH_WAIT_TIMEOUT = args.wait_timeout
+
+    # The user and question services are stubbed, a lookup takes the given time like the real HTTP call does
+    ratings = {}
+
+    async def fetch_name(user_id: str) -> str:
+        await asyncio.sleep(args.user_svc_ms / 1000)
+        return f"Simulated {user_id}"
+
+    async def get_user_rating(user_id: str, matchmaking_conn: Redis) -> float:
+        return ratings[user_id]
+
+    room_events = 0
+
+    async def fetch_question(difficulty: str, category: str) -> dict:
+        await asyncio.sleep(args.user_svc_ms / 1000)
+        return {"id": 0, "title": f"Simulated {difficulty} {category}", "difficulty": difficulty, "categories": [category]}
+
+    async def send_match_confirmed_event(*details) -> None:
+        nonlocal room_events
+        room_events += 1
+
+    profile_resolver._fetch_name = fetch_name
+    question_selector._fetch = fetch_question
+    matching_controller.get_user_rating = get_user_rating
+    if args.room_events:
+        room_event_producer.start()
+    else:
+        matching_controller.send_match_confirmed_event = send_match_confirmed_event
+
+    raw_connections = [
+        connect_to_redis_matchmaking_service(),
+        connect_to_redis_message_service(),
+        connect_to_redis_confirmation_service(),
+    ]
+    matchmaking_conn = AutoBatchingRedis(raw_connections[0])
+    message_conn = raw_connections[1]
+    confirmation_conn = AutoBatchingRedis(raw_connections[2])
+
+    message_dispatcher.locks = [TimedLock() for _ in message_dispatcher.locks]
+    benchmark = Benchmark(args, matchmaking_conn, message_conn, confirmation_conn)
+    message_dispatcher.start(message_conn, connect_to_redis_message_subscriber)
+    register_deadline_handlers(matchmaking_conn, message_conn, confirmation_conn, benchmark.gateway)
+    deadline_scheduler.start(confirmation_conn)
+    if MATCHING_ENGINE == BATCH_ENGINE:
+        register_batch_match_handler(matchmaking_conn, message_conn, confirmation_conn, benchmark.gateway)
+        batch_matching_engine.start(matchmaking_conn, f"benchmark-{uuid4()}")
+
+    run_id = uuid4().hex[:8]
+    arrivals = generate_arrivals(args.users, args.rate, args.flexibility, args.seed)
+    arrivals = spread_arrivals(arrivals, args.arrivals, args.rate, args.burst_size)
+    for user in arrivals:
+        user["user_id"] = f"bench-{run_id}-{user['user_id']}"
+        ratings[user["user_id"]] = round(user["rating"], 1)
+
+    commands_before = await count_commands(*raw_connections)
+    started = time.monotonic()
+    await asyncio.gather(*(benchmark.run_user(user, started) for user in arrivals))
+    elapsed = time.monotonic() - started
+    commands = await count_commands(*raw_connections) - commands_before
+
+    await batch_matching_engine.stop()
+    await deadline_scheduler.stop()
+    await message_dispatcher.stop()
+    await room_event_producer.stop()
+    await question_selector.stop()
+    for connection in raw_connections:
+        await sever_connection(connection)
+
+    confirmed_matches = benchmark.outcomes["confirmed"] / 2
+    return {
+        "engine": MATCHING_ENGINE,
+        "mode": args.mode,
+        "arrivals": args.arrivals,
+        "users": args.users,
+        "elapsed_seconds": round(elapsed, 2),
+        "outcomes": dict(sorted(benchmark.outcomes.items())),
+        "room_events": room_events + room_event_producer.published,
+        "profiles": profile_resolver.snapshot(),
+        "throughput": {
+            "requests_per_second": round(args.users / elapsed, 2),
+            "confirmed_matches_per_second": round(confirmed_matches / elapsed, 2),
+        },
+        "lock_wait": {
+            "acquisitions": TimedLock.acquisitions,
+            "total_ms": round(TimedLock.waited * 1000, 2),
+            "longest_ms": round(TimedLock.longest * 1000, 2),
+        },
+        "redis": {
+            "commands": commands,
+            "commands_per_user": round(commands / args.users, 1),
+            "commands_per_confirmed_match": round(commands / confirmed_matches, 1) if confirmed_matches else None,
+        },
+        "latency": {name: percentiles(values) for name, values in sorted(benchmark.latencies.items())},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="number of simulated users")
+    parser.add_argument("--rate", type=float, default=20.0, help="users arriving per second")
+    parser.add_argument("--arrivals", choices=[POISSON, UNIFORM, BURST], default=POISSON, help="arrival distribution")
+    parser.add_argument("--burst-size", type=int, default=100, help="users arriving together in burst arrivals")
+    parser.add_argument("--mode", choices=[SYNC_MODE, ASYNC_MODE], default=ASYNC_MODE, help="request mode")
+    parser.add_argument("--flexibility", type=float, default=0.3, help="chance of accepting each other option")
+    parser.add_argument("--accept", type=float, default=0.9, help="chance of accepting a match")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds before accepting a match")
+    parser.add_argument("--disconnect", type=float, default=0.05, help="chance of cancelling before being matched")
+    parser.add_argument("--vanish", type=float, default=0.05, help="chance of leaving without cancelling")
+    parser.add_argument("--wait-timeout", type=float, default=20, help="seconds a request waits for a partner")
+    parser.add_argument("--user-svc-ms", type=float, default=0, help="latency of the stubbed user and question service lookups")
+    parser.add_argument("--room-events", action="store_true", help="send the room events to the event queue")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['engine']} engine, {report['mode']} mode, {report['users']} users with {report['arrivals']} arrivals "
+          f"in {report['elapsed_seconds']}s")
+    print("outcomes:   " + ", ".join(f"{name} {count}" for name, count in report["outcomes"].items()))
+    print(f"throughput: {report['throughput']['requests_per_second']} requests/s, "
+          f"{report['throughput']['confirmed_matches_per_second']} confirmed matches/s")
+    print(f"lock wait:  {report['lock_wait']['total_ms']}ms over {report['lock_wait']['acquisitions']} acquisitions, "
+          f"longest {report['lock_wait']['longest_ms']}ms")
+    print(f"redis:      {report['redis']['commands']} commands, {report['redis']['commands_per_user']} per user, "
+          f"{report['redis']['commands_per_confirmed_match']} per confirmed match")
+    print(f"{'latency':<16}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in report["latency"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p90_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Compares the match rate and wait times of the first come first served matching path against the batch
+matching engine on the same simulated arrivals.
+
+Run from the matching-svc directory:
+    python -m scripts.simulate_matching --users 2000 --rate 5 --tick-ms 500
+"""
+import argparse
+import json
+import random
+import statistics
+
+from service.batch_matching_engine import compute_pairings
+from service.rating_service import (
+    RATING_WINDOW_MAX,
+    RATING_WINDOW_STEP,
+    get_rating_window,
+    is_rated_queue,
+)
+from service.redis_matchmaking_service import (
+    WIDENING_STEPS,
+    get_widened_criteria,
+    get_widening_level,
+)
+
+DIFFICULTIES = ["Easy", "Medium", "Hard"]
+CATEGORIES = ["Arrays", "Strings", "Graphs", "Dynamic Programming", "Trees", "Greedy"]
+
+# Seconds between the steps of the simulation clock
+STEP = 0.1
+
+
+def generate_arrivals(users: int, rate: float, flexibility: float, seed: int) -> list[dict]:
+    """
+    Generates users arriving as a poisson process, with popular difficulties and categories asked for more often.
+    Each user accepts every other difficulty and category with the given probability.
+    """
+    rng = random.Random(seed)
+    arrivals = []
+    now = 0.0
+    for i in range(users):
+        now += rng.expovariate(rate)
+        difficulty = rng.choices(DIFFICULTIES, weights=[5, 3, 2])[0]
+        category = rng.choices(CATEGORIES, weights=[6, 5, 3, 3, 2, 1])[0]
+        arrivals.append({
+            "user_id": f"user-{i}",
+            "arrived_at": now,
+            "difficulty": difficulty,
+            "category": category,
+            "difficulties": json.dumps([d for d in DIFFICULTIES if d != difficulty and rng.random() < flexibility]),
+            "categories": json.dumps([c for c in CATEGORIES if c != category and rng.random() < flexibility]),
+            "rating": rng.gauss(1200, 250),
+        })
+    return arrivals
+
+
+def summarise(name: str, arrivals: list[dict], waits: dict[str, float]) -> dict:
+    ordered = sorted(waits.values())
+
+    def percentile(p: float) -> float:
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+    return {
+        "engine": name,
+        "users": len(arrivals),
+        "matched": len(waits),
+        "match_rate": len(waits) / len(arrivals) if arrivals else 0.0,
+        "mean_wait": statistics.fmean(ordered) if ordered else 0.0,
+        "p50_wait": percentile(0.5),
+        "p90_wait": percentile(0.9),
+        "p99_wait": percentile(0.99),
+    }
+
+
+def simulate_fifo(arrivals: list[dict], timeout: float) -> dict[str, float]:
+    """
+    Replays the arrivals through the same steps as the pairing scripts: a request searches the queues it accepts
+    in order of preference and takes the longest waiting user, or the nearest rated user in rated queues, and
+    otherwise joins them. Waiting users search again whenever their criteria widen.
+    """
+    waiting: dict[str, dict] = {}
+    joined: dict[str, set] = {}
+    next_search: dict[str, float] = {}
+    waits: dict[str, float] = {}
+
+    def search(user: dict, criteria: list[tuple[str, str]], now: float) -> bool:
+        window = get_rating_window(now - user["arrived_at"])
+        for queue in criteria:
+            members = [other for other in waiting.values() if queue in joined[other["user_id"]] and other is not user]
+            if is_rated_queue(*queue):
+                members = [other for other in members if abs(other["rating"] - user["rating"]) <= window]
+                partner = min(members, key=lambda other: abs(other["rating"] - user["rating"]), default=None)
+            else:
+                partner = min(members, key=lambda other: other["arrived_at"], default=None)
+
+            if partner is not None:
+                for matched in (user, partner):
+                    waits[matched["user_id"]] = now - matched["arrived_at"]
+                    waiting.pop(matched["user_id"], None)
+                    next_search.pop(matched["user_id"], None)
+                return True
+
+        joined[user["user_id"]].update(criteria)
+        return False
+
+    def schedule(user: dict, now: float) -> None:
+        waited = now - user["arrived_at"]
+        level = get_widening_level(waited)
+        delays = []
+        if level < len(WIDENING_STEPS):
+            delays.append(WIDENING_STEPS[level] - waited)
+        if any(is_rated_queue(*queue) for queue in get_widened_criteria(user, level)) and get_rating_window(waited) < RATING_WINDOW_MAX:
+            delays.append(RATING_WINDOW_STEP)
+        if delays:
+            next_search[user["user_id"]] = now + min(delays)
+
+    pending = list(arrivals)
+    now = 0.0
+    while pending or waiting:
+        now += STEP
+        while pending and pending[0]["arrived_at"] <= now:
+            user = pending.pop(0)
+            waiting[user["user_id"]] = user
+            joined[user["user_id"]] = set()
+            if not search(user, [(user["difficulty"], user["category"])], user["arrived_at"]):
+                schedule(user, user["arrived_at"])
+
+        for user_id, due in list(next_search.items()):
+            user = waiting.get(user_id)
+            if user is None or due > now:
+                continue
+            criteria = get_widened_criteria(user, get_widening_level(now - user["arrived_at"]))
+            criteria = [queue for queue in criteria if queue not in joined[user_id] or is_rated_queue(*queue)]
+            if not search(user, criteria, now):
+                schedule(user, now)
+
+        for user_id, user in list(waiting.items()):
+            if now - user["arrived_at"] >= timeout:
+                del waiting[user_id]
+                next_search.pop(user_id, None)
+
+    return waits
+
+
+def simulate_batch(arrivals: list[dict], timeout: float, tick: float) -> dict[str, float]:
+    """
+    Replays the arrivals through the batch matching engine, which pairs every waiting user once per tick.
+    """
+    waiting: dict[str, dict] = {}
+    waits: dict[str, float] = {}
+
+    pending = list(arrivals)
+    now = 0.0
+    while pending or waiting:
+        now += tick
+        while pending and pending[0]["arrived_at"] <= now:
+            user = pending.pop(0)
+            waiting[user["user_id"]] = {**user, "joined_at": user["arrived_at"]}
+
+        for user_id, partner, _, _ in compute_pairings(waiting, now):
+            for matched in (user_id, partner):
+                waits[matched] = now - waiting.pop(matched)["arrived_at"]
+
+        for user_id, user in list(waiting.items()):
+            if now - user["arrived_at"] >= timeout:
+                del waiting[user_id]
+
+    return waits
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="number of users arriving")
+    parser.add_argument("--rate", type=float, default=2.0, help="users arriving per second")
+    parser.add_argument("--flexibility", type=float, default=0.3, help="chance of accepting each other option")
+    parser.add_argument("--tick-ms", type=int, default=500, help="milliseconds between batch engine ticks")
+    parser.add_argument("--timeout", type=float, default=40, help="seconds a user waits before giving up")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    arrivals = generate_arrivals(args.users, args.rate, args.flexibility, args.seed)
+    results = [
+        summarise("fifo", arrivals, simulate_fifo(arrivals, args.timeout)),
+        summarise(f"batch ({args.tick_ms}ms)", arrivals, simulate_batch(arrivals, args.timeout, args.tick_ms / 1000)),
+    ]
+
+    print(f"{'engine':<16}{'matched':>10}{'rate':>8}{'mean':>8}{'p50':>8}{'p90':>8}{'p99':>8}")
+    for result in results:
+        print(
+            f"{result['engine']:<16}{result['matched']:>10}{result['match_rate']:>8.1%}"
+            f"{result['mean_wait']:>8.1f}{result['p50_wait']:>8.1f}{result['p90_wait']:>8.1f}{result['p99_wait']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
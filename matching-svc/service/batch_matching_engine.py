@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import time
+from collections.abc import Awaitable, Callable
+
+from redis.asyncio import Redis
+
+from service.rating_service import get_rating_window, is_rated_queue
+from service.redis_matchmaking_service import (
+    commit_pairs,
+    get_waiting_users,
+    get_widened_criteria,
+    get_widening_level,
+)
+from utils.logger import log
+from utils.utils import format_key, format_queue_key, get_envvar
+
+# Engines that can decide the matches, chosen with the MATCHING_ENGINE environment variable.
+# The fifo engine pairs each request as it arrives, the batch engine pairs every waiting user once per tick.
+FIFO_ENGINE = "fifo"
+BATCH_ENGINE = "batch"
+MATCHING_ENGINE = get_envvar("MATCHING_ENGINE", FIFO_ENGINE)
+
+# Milliseconds between the ticks of the batch engine
+BATCH_TICK_MS = int(get_envvar("BATCH_TICK_MS", "500"))
+
+# Sorted set of the matching instances running the batch engine, scored by the time of their last tick.
+# No pairing script reads it, so it is kept out of the matchmaking slot
+INSTANCES_KEY = format_key("batch_instances")
+# Seconds without a tick after which an instance's shards are taken over by the others
+INSTANCE_TIMEOUT = 5
+
+MatchHandler = Callable[[str, str, str, str], Awaitable[None]]
+
+
+def owns_queue(instance_id: str, instances: list[str], queue_key: str) -> bool:
+    """
+    Checks if the instance is the one pairing the users who asked for the queue.\n
+    Each queue is owned by the live instance with the highest hash of its id and the queue key,
+    so only the queues of an instance that joins or leaves change owner.
+    """
+    owner = max(
+        instances,
+        key=lambda instance: hashlib.md5(f"{instance}:{queue_key}".encode()).digest(),
+        default=instance_id,
+    )
+    return owner == instance_id
+
+
+def compute_pairings(
+    waiting: dict[str, dict], now: float, is_owned: Callable[[str], bool] = lambda queue_key: True
+) -> list[tuple[str, str, str, str]]:
+    """
+    Pairs the waiting users whose criteria, widened by how long they have waited, accept a common queue,
+    leaving out the users each was recently matched with.\n
+    Users who accept the fewest partners are paired first, each with the partner who has the fewest alternatives
+    left, which pairs more users than taking them in arrival order. Only users whose preferred queue is owned are
+    paired, although their partner may come from any queue.\n
+    Returns the pairs as (user, partner, difficulty, category).
+    """
+    accepted = {}
+    windows = {}
+    acceptors: dict[tuple[str, str], set[str]] = {}
+    for user_id, details in waiting.items():
+        waited = now - float(details["joined_at"])
+        accepted[user_id] = get_widened_criteria(details, get_widening_level(waited))
+        windows[user_id] = get_rating_window(waited)
+        for criteria in accepted[user_id]:
+            acceptors.setdefault(criteria, set()).add(user_id)
+
+    def shared_criteria(user_id: str, partner: str) -> tuple[str, str] | None:
+        # The queue most preferred by the user that the partner also accepts
+        for difficulty, category in accepted[user_id]:
+            if partner not in acceptors[(difficulty, category)]:
+                continue
+            if is_rated_queue(difficulty, category):
+                difference = abs(float(waiting[user_id]["rating"]) - float(waiting[partner]["rating"]))
+                if difference > max(windows[user_id], windows[partner]):
+                    continue
+            return difficulty, category
+        return None
+
+    candidates = {
+        user_id: {
+            partner
+            for criteria in accepted[user_id]
+            for partner in acceptors[criteria]
+            if partner != user_id
+            and partner not in waiting[user_id].get("recent_partners", ())
+            and shared_criteria(user_id, partner) is not None
+        }
+        for user_id in waiting
+    }
+
+    def urgency(user_id: str) -> tuple[int, float]:
+        return len(candidates[user_id]), float(waiting[user_id]["joined_at"])
+
+    paired = set()
+    pairings = []
+    for user_id in sorted(waiting, key=urgency):
+        if user_id in paired:
+            continue
+        details = waiting[user_id]
+        if not is_owned(format_queue_key(details["difficulty"], details["category"])):
+            continue
+
+        options = [partner for partner in candidates[user_id] if partner not in paired]
+        if not options:
+            continue
+
+        partner = min(options, key=lambda option: (len(candidates[option] - paired), float(waiting[option]["joined_at"])))
+        difficulty, category = shared_criteria(user_id, partner)
+        paired.update((user_id, partner))
+        pairings.append((user_id, partner, difficulty, category))
+
+    return pairings
+
+
+class BatchMatchingEngine:
+    """
+    Pairs the users waiting in the queues in batches instead of one request at a time.\n
+    On every tick an instance reads all waiting users, pairs the ones whose preferred queue it owns across
+    all the queues their widened criteria accept, and commits the pairs in one script. A pair is dropped if
+    either user stopped waiting in the meantime, so instances never need a lock between them.
+    """
+
+    def __init__(self, tick_interval: float = BATCH_TICK_MS / 1000):
+        self.matchmaking_conn: Redis | None = None
+        self.instance_id = ""
+        self.tick_interval = tick_interval
+        self.handler: MatchHandler | None = None
+        self.worker: asyncio.Task | None = None
+        self.ticks = 0
+        self.proposed = 0
+        self.committed = 0
+        self.last_waiting = 0
+        self.last_tick_ms = 0.0
+
+    def register(self, handler: MatchHandler) -> None:
+        """
+        Registers the coroutine called with the user, partner, difficulty and category of each committed pair.
+        """
+        self.handler = handler
+
+    def start(self, matchmaking_conn: Redis, instance_id: str) -> None:
+        """
+        Starts pairing waiting users on the given connection.
+        """
+        self.matchmaking_conn = matchmaking_conn
+        self.instance_id = instance_id
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops pairing users and hands this instance's queues over to the other instances.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+            await self.matchmaking_conn.zrem(INSTANCES_KEY, self.instance_id)
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                log.error(f"Batch matching tick failed: {e}")
+
+            self.last_tick_ms = (time.monotonic() - started) * 1000
+            await asyncio.sleep(max(self.tick_interval - (time.monotonic() - started), 0))
+
+    async def tick(self) -> None:
+        """
+        Pairs the users currently waiting in the queues owned by this instance.
+        """
+        now = time.time()
+        await self.matchmaking_conn.zadd(INSTANCES_KEY, {self.instance_id: now})
+        await self.matchmaking_conn.zremrangebyscore(INSTANCES_KEY, "-inf", now - INSTANCE_TIMEOUT)
+        instances = await self.matchmaking_conn.zrange(INSTANCES_KEY, 0, -1)
+
+        waiting = await get_waiting_users(self.matchmaking_conn)
+        pairings = compute_pairings(
+            waiting, now, lambda queue_key: owns_queue(self.instance_id, instances, queue_key)
+        )
+        self.ticks += 1
+        self.last_waiting = len(waiting)
+        if not pairings:
+            return
+
+        pairs = [
+            (user_id, waiting[user_id]["ticket"], partner, waiting[partner]["ticket"])
+            for user_id, partner, _, _ in pairings
+        ]
+        committed = [pairings[index] for index in await commit_pairs(pairs, self.matchmaking_conn)]
+        self.proposed += len(pairings)
+        self.committed += len(committed)
+        log.info(f"Batch matching paired {len(committed)} of {len(pairings)} proposed pairs from {len(waiting)} waiting users")
+
+        results = await asyncio.gather(*(self.handler(*pairing) for pairing in committed), return_exceptions=True)
+        for pairing, result in zip(committed, results):
+            if isinstance(result, Exception):
+                log.error(f"Failed to set up the match between {pairing[0]} and {pairing[1]}: {result}")
+
+    def snapshot(self) -> dict:
+        return {
+            "engine": MATCHING_ENGINE,
+            "tick_interval_ms": self.tick_interval * 1000,
+            "ticks": self.ticks,
+            "waiting": self.last_waiting,
+            "proposed": self.proposed,
+            "committed": self.committed,
+            "conflicts": self.proposed - self.committed,
+            "last_tick_ms": round(self.last_tick_ms, 2),
+        }
+
+
+# One engine per process, only started when MATCHING_ENGINE is batch
+batch_matching_engine = BatchMatchingEngine()
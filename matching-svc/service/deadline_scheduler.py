@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+from collections.abc import Awaitable, Callable
+
+from redis.asyncio import Redis
+
+from utils.logger import log
+from utils.utils import format_key, load_script
+
+DEADLINES_KEY = format_key("deadlines")
+
+# Claims the deadlines that are due by pushing them back by the lease instead of removing them,
+# so a deadline claimed by an instance that dies before handling it is claimed again once the lease runs out.
+# KEYS[1]: deadlines key
+# ARGV[1]: current time, ARGV[2]: maximum number of deadlines to claim, ARGV[3]: lease in seconds
+CLAIM_DEADLINES_SCRIPT = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+local lease_until = tonumber(ARGV[1]) + tonumber(ARGV[3])
+for _, deadline in ipairs(due) do
+    redis.call("ZADD", KEYS[1], lease_until, deadline)
+end
+return due
+"""
+
+DeadlineHandler = Callable[..., Awaitable[None]]
+
+
+class DeadlineScheduler:
+    """
+    Runs deadlines stored in a redis sorted set shared by every matching instance.\n
+    Each deadline is scored by the time it is due. Instances poll for due deadlines and claim them in batches,
+    so deadlines survive restarts and a pending deadline costs a sorted set entry instead of a sleeping task.
+    """
+
+    def __init__(self, batch_size: int = 100, poll_interval: float = 0.5, lease: int = 30):
+        self.redis_conn: Redis | None = None
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.handlers: dict[str, DeadlineHandler] = {}
+        self.worker: asyncio.Task | None = None
+        self.handled = 0
+        self.failed = 0
+
+    def register(self, kind: str, handler: DeadlineHandler) -> None:
+        """
+        Registers the coroutine called with the arguments of each deadline of this kind once it is due.
+        """
+        self.handlers[kind] = handler
+
+    def start(self, redis_conn: Redis) -> None:
+        """
+        Starts claiming and handling due deadlines on the given connection.
+        """
+        self.redis_conn = redis_conn
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops handling deadlines, the ones not handled yet are picked up by another instance.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def schedule(self, kind: str, delay: float, *args: str) -> None:
+        """
+        Schedules a deadline of this kind to be handled after the delay in seconds.
+        """
+        await self.redis_conn.zadd(DEADLINES_KEY, {json.dumps([kind, *args]): time.time() + delay})
+
+    async def cancel(self, kind: str, *args: str) -> None:
+        """
+        Cancels a deadline that is no longer needed.
+        """
+        await self.redis_conn.zrem(DEADLINES_KEY, json.dumps([kind, *args]))
+
+    async def _run(self) -> None:
+        script = load_script(CLAIM_DEADLINES_SCRIPT, self.redis_conn)
+
+        while True:
+            try:
+                deadlines = await script(
+                    keys=[DEADLINES_KEY],
+                    args=[time.time(), self.batch_size, self.lease],
+                    client=self.redis_conn,
+                )
+                if deadlines:
+                    await asyncio.gather(*(self._handle(deadline) for deadline in deadlines))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                log.error(f"Failed to claim deadlines: {e}")
+                deadlines = []
+
+            # A full batch means more deadlines may already be due
+            if len(deadlines) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _handle(self, deadline: str) -> None:
+        kind, *args = json.loads(deadline)
+        handler = self.handlers.get(kind)
+        if handler is None:
+            log.error(f"No handler registered for deadline {deadline}")
+            return
+
+        try:
+            await handler(*args)
+        except Exception as e:  # noqa: BLE001
+            # Left in the set, so the deadline is retried once its lease runs out
+            self.failed += 1
+            log.error(f"Failed to handle deadline {deadline}: {e}")
+            return
+
+        await self.redis_conn.zrem(DEADLINES_KEY, deadline)
+        self.handled += 1
+
+    async def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            "pending": await self.redis_conn.zcard(DEADLINES_KEY),
+            "overdue": await self.redis_conn.zcount(DEADLINES_KEY, "-inf", now),
+            "handled": self.handled,
+            "failed": self.failed,
+        }
+
+
+# One scheduler per process, handlers are registered when the service starts
+deadline_scheduler = DeadlineScheduler()
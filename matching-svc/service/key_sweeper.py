@@ -0,0 +1,155 @@
+import asyncio
+import json
+import time
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from service.redis_confirmation_service import MATCH_TTL
+from service.redis_matchmaking_service import (
+    IN_QUEUE_TTL,
+    WAITING_KEY,
+    get_purged_count,
+    remove_orphaned_members,
+)
+from service.redis_message_service import MESSAGE_TTL
+from utils.logger import log
+from utils.utils import (
+    format_in_queue_key,
+    format_key,
+    format_match_accepted_key,
+    format_match_found_key,
+    format_match_key,
+    format_queue_key,
+)
+
+# Seconds between the sweeps
+SWEEP_INTERVAL = 60
+
+# Only one instance sweeps at a time, holding the lease for at most one interval
+LEASE_KEY = format_key("sweeper", "lease")
+# Report of the last sweep, read by every instance
+REPORT_KEY = format_key("sweeper", "report")
+
+SCAN_COUNT = 500
+
+
+async def _memory_usage(key: str, redis_conn: Redis) -> int:
+    # Not every deployment allows MEMORY USAGE, in which case the reclaimed memory is reported as 0
+    try:
+        return await redis_conn.memory_usage(key) or 0
+    except RedisError:
+        return 0
+
+
+class KeySweeper:
+    """
+    Reclaims the matchmaking keys left behind by clients and instances that disappeared midway.\n
+    Every key the service writes carries a time to live, so the sweeper mostly reconciles what redis cannot expire
+    on its own: queue members whose request is gone, and keys written before they carried a time to live.
+    """
+
+    def __init__(self, interval: float = SWEEP_INTERVAL):
+        self.matchmaking_conn: Redis | None = None
+        self.message_conn: Redis | None = None
+        self.confirmation_conn: Redis | None = None
+        self.instance_id = ""
+        self.interval = interval
+        self.worker: asyncio.Task | None = None
+        self.sweeps = 0
+
+    def start(self, matchmaking_conn: Redis, message_conn: Redis, confirmation_conn: Redis, instance_id: str) -> None:
+        """
+        Starts sweeping the keys on the given connections.
+        """
+        self.matchmaking_conn = matchmaking_conn
+        self.message_conn = message_conn
+        self.confirmation_conn = confirmation_conn
+        self.instance_id = instance_id
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops sweeping, another instance takes over once the lease runs out.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await self.matchmaking_conn.set(LEASE_KEY, self.instance_id, nx=True, ex=int(self.interval)):
+                    await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                log.error(f"Failed to sweep matchmaking keys: {e}")
+
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> dict:
+        """
+        Sweeps the keys once and stores the report of what was reclaimed.
+        """
+        started = time.monotonic()
+        report = {"expiring": 0, "deleted": 0, "orphaned_members": 0, "bytes_reclaimed": 0}
+
+        await self._sweep_in_queue_keys(report)
+
+        queue_keys = [key async for key in self.matchmaking_conn.scan_iter(format_queue_key("*", "*"), count=SCAN_COUNT)]
+        for key in [*queue_keys, WAITING_KEY]:
+            size = await _memory_usage(key, self.matchmaking_conn)
+            removed = await remove_orphaned_members(key, self.matchmaking_conn)
+            if removed:
+                report["orphaned_members"] += removed
+                report["bytes_reclaimed"] += max(size - await _memory_usage(key, self.matchmaking_conn), 0)
+
+        for pattern in (format_match_found_key("*"), format_match_accepted_key("*")):
+            await self._expire_keys(pattern, MESSAGE_TTL, self.message_conn, report)
+        await self._expire_keys(format_match_key("*"), MATCH_TTL, self.confirmation_conn, report)
+
+        self.sweeps += 1
+        report["ran_at"] = time.time()
+        report["duration_ms"] = round((time.monotonic() - started) * 1000, 2)
+        report["instance"] = self.instance_id
+        await self.matchmaking_conn.set(REPORT_KEY, json.dumps(report))
+        log.info(f"Swept matchmaking keys: {report}")
+        return report
+
+    async def _sweep_in_queue_keys(self, report: dict) -> None:
+        # Requests without a time to live are deleted once they are older than one, otherwise they are given one
+        now = time.time()
+        async for key in self.matchmaking_conn.scan_iter(format_in_queue_key("*"), count=SCAN_COUNT):
+            if await self.matchmaking_conn.ttl(key) != -1:
+                continue
+
+            joined_at = await self.matchmaking_conn.hget(key, "joined_at")
+            if joined_at is None or now - float(joined_at) >= IN_QUEUE_TTL:
+                report["bytes_reclaimed"] += await _memory_usage(key, self.matchmaking_conn)
+                report["deleted"] += await self.matchmaking_conn.delete(key)
+            else:
+                report["expiring"] += await self.matchmaking_conn.expire(key, IN_QUEUE_TTL)
+
+    async def _expire_keys(self, pattern: str, ttl: int, redis_conn: Redis, report: dict) -> None:
+        # Gives the keys that never expire the time to live the service now writes them with
+        async for key in redis_conn.scan_iter(pattern, count=SCAN_COUNT):
+            if await redis_conn.ttl(key) == -1:
+                report["expiring"] += await redis_conn.expire(key, ttl)
+
+    async def snapshot(self) -> dict:
+        report = await self.matchmaking_conn.get(REPORT_KEY)
+        return {
+            "interval_seconds": self.interval,
+            "sweeps": self.sweeps,
+            "lease_expired_users_removed": await get_purged_count(self.matchmaking_conn),
+            "last_sweep": json.loads(report) if report else None,
+        }
+
+
+# One sweeper per process, the lease keeps sweeps from overlapping across instances
+key_sweeper = KeySweeper()
@@ -0,0 +1,154 @@
+import asyncio
+from collections import deque
+from collections.abc import Callable
+
+from redis.asyncio import Redis
+
+from utils.logger import log
+from utils.utils import format_key
+
+# Channel on which the key of every message list is published after a message is pushed onto it
+MESSAGE_CHANNEL = format_key("messages")
+
+# Deliveries for the same key are serialised by one of these locks
+LOCK_STRIPES = 64
+
+
+class MessageDispatcher:
+    """
+    Delivers messages from the message queue to the requests waiting on them.\n
+    Senders push a message onto the receiver's list and publish the list key on MESSAGE_CHANNEL.
+    One subscription per process wakes the local waiters of that key, which then pop their message,
+    so a waiting request holds a future instead of a blocked redis connection.\n
+    The subscription is made over a connection to a single node, as a cluster client cannot subscribe.
+    """
+
+    def __init__(self):
+        self.message_conn: Redis | None = None
+        self.connect_subscriber: Callable[[], Redis] | None = None
+        self.waiters: dict[str, deque[asyncio.Future]] = {}
+        self.locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+        self.listener: asyncio.Task | None = None
+        self.delivered = 0
+        self.resubscriptions = 0
+
+    def start(self, message_conn: Redis, connect_subscriber: Callable[[], Redis] | None = None) -> None:
+        """
+        Starts delivering messages from the given connection.\n
+        Each subscription is made over a new connection from connect_subscriber, or over message_conn if it is not given.
+        """
+        self.message_conn = message_conn
+        self.connect_subscriber = connect_subscriber
+        self.listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        """
+        Stops the listener and releases every request still waiting.
+        """
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+
+        for waiters in self.waiters.values():
+            for future in waiters:
+                future.cancel()
+        self.waiters.clear()
+
+    async def wait(self, message_key: str, timeout: int) -> tuple[str, str] | None:
+        """
+        Waits for a message on the key and returns it as a (key, message) pair like BLPOP does.\n
+        If no message is sent before the timeout, then return None.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(message_key, deque()).append(future)
+
+        try:
+            # The message may have been sent before the waiter was registered
+            await self._deliver(message_key)
+            return await asyncio.wait_for(future, timeout=timeout)
+        except TimeoutError:
+            return None
+        finally:
+            waiters = self.waiters.get(message_key)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self.waiters[message_key]
+
+    async def _deliver(self, message_key: str) -> None:
+        """
+        Pops messages off the list for as long as there are local waiters for it.
+        """
+        async with self.locks[hash(message_key) % LOCK_STRIPES]:
+            while self.waiters.get(message_key):
+                message = await self.message_conn.lpop(message_key)
+                if message is None:
+                    return
+
+                future = self._next_waiter(message_key)
+                if future is None:
+                    # Every waiter gave up while the message was being popped, so put it back for the next one
+                    await self.message_conn.lpush(message_key, message)
+                    return
+
+                future.set_result((message_key, message))
+                self.delivered += 1
+
+    def _next_waiter(self, message_key: str) -> asyncio.Future | None:
+        """
+        Removes and returns the longest waiting request for the key that has not given up yet.
+        """
+        waiters = self.waiters.get(message_key)
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                if not waiters:
+                    del self.waiters[message_key]
+                return future
+
+        self.waiters.pop(message_key, None)
+        return None
+
+    async def _listen(self) -> None:
+        """
+        Subscribes to MESSAGE_CHANNEL and delivers each published key to its local waiters.
+        """
+        while True:
+            subscriber_conn = self.connect_subscriber() if self.connect_subscriber else self.message_conn
+            try:
+                async with subscriber_conn.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(MESSAGE_CHANNEL)
+                    log.info(f"Message dispatcher subscribed to {MESSAGE_CHANNEL}.")
+
+                    # Messages published while unsubscribed are still waiting in their lists
+                    for message_key in list(self.waiters):
+                        await self._deliver(message_key)
+
+                    async for message in pubsub.listen():
+                        if message["type"] == "message" and message["data"] in self.waiters:
+                            await self._deliver(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                self.resubscriptions += 1
+                log.error(f"Message dispatcher lost its subscription, resubscribing: {e}")
+                await asyncio.sleep(1)
+            finally:
+                if subscriber_conn is not self.message_conn:
+                    await subscriber_conn.aclose()
+
+    def snapshot(self) -> dict:
+        return {
+            "waiting_keys": len(self.waiters),
+            "waiters": sum(len(waiters) for waiters in self.waiters.values()),
+            "delivered": self.delivered,
+            "resubscriptions": self.resubscriptions,
+        }
+
+
+# One dispatcher per process, shared by every waiting request
+message_dispatcher = MessageDispatcher()
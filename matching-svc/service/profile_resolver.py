@@ -0,0 +1,151 @@
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+
+import httpx
+
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_USER_SVC_USER_DETAILS_ENDPOINT = "USER_SERVICE_GET_USER_DETAILS_URL"
+ENV_QN_SVC_HISTORY_ENDPOINT = "QUESTION_SERVICE_HISTORY_URL"
+
+# Names rarely change, so they are cached for a while in a cache bounded to the most recently used users
+PROFILE_TTL = 300
+PROFILE_CACHE_SIZE = 10000
+
+# Seconds a lookup may take before the request fails
+REQUEST_TIMEOUT = 5
+
+
+class ProfileResolver:
+    """
+    Looks up the details of users from the other services without blocking the event loop.\n
+    Every lookup goes through one pooled HTTP client, concurrent lookups of the same user share a single request,
+    and names are cached so a user who matches again does not wait on the user service.
+    """
+
+    def __init__(self, ttl: float = PROFILE_TTL, max_size: int = PROFILE_CACHE_SIZE):
+        self.client: httpx.AsyncClient | None = None
+        self.ttl = ttl
+        self.max_size = max_size
+        self.names: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.in_flight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def start(self) -> None:
+        """
+        Opens the HTTP client shared by every lookup.
+        """
+        self.client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+
+    async def stop(self) -> None:
+        """
+        Closes the HTTP client.
+        """
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get_name(self, user_id: str) -> str:
+        """
+        Retrieves the full name of the user from the user service.
+        """
+        cached = self.names.get(user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            self.names.move_to_end(user_id)
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        name = await self._coalesce(f"name:{user_id}", lambda: self._fetch_name(user_id))
+
+        self.names[user_id] = (time.monotonic() + self.ttl, name)
+        self.names.move_to_end(user_id)
+        while len(self.names) > self.max_size:
+            self.names.popitem(last=False)
+        return name
+
+    async def get_names(self, *user_ids: str) -> list[str]:
+        """
+        Retrieves the full names of the users concurrently.\n
+        A name that cannot be looked up falls back to the id of the user, so a failing user service
+        never leaves users who were already paired without a match.
+        """
+        names = await asyncio.gather(*(self.get_name(user_id) for user_id in user_ids), return_exceptions=True)
+        resolved = []
+        for user_id, name in zip(user_ids, names, strict=True):
+            if isinstance(name, BaseException):
+                log.warning(f"Could not look up the name of {user_id}, using their id instead: {name!r}")
+                name = user_id
+            resolved.append(name)
+        return resolved
+
+    async def get_question_history(self, user_id: str) -> list[dict]:
+        """
+        Retrieves the question attempts of the user from the question history service.
+        """
+        return await self._coalesce(
+            f"history:{user_id}", lambda: self._get_json(get_envvar(ENV_QN_SVC_HISTORY_ENDPOINT), user_id)
+        )
+
+    async def _fetch_name(self, user_id: str) -> str:
+        user_data = await self._get_json(get_envvar(ENV_USER_SVC_USER_DETAILS_ENDPOINT), user_id)
+        return f"{user_data["first_name"]} {user_data["last_name"]}"
+
+    async def _get_json(self, url: str, user_id: str):
+        if self.client is None:
+            self.start()
+        response = await self.client.get(url, headers={"X-User-ID": user_id})
+        response.raise_for_status()
+        return response.json()
+
+    async def _coalesce(self, key: str, lookup: Callable[[], Awaitable]):
+        # Callers asking for a lookup already in flight wait for its result instead of sending their own
+        while (future := self.in_flight.get(key)) is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The caller that owned the lookup was cancelled, so it is looked up again unless this caller was too
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await lookup()
+        except Exception as e:
+            self.failures += 1
+            log.warning(f"Lookup of {key} failed: {e}")
+            future.set_exception(e)
+            # Marks the exception as retrieved, as there may be no other caller waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # The owner was cancelled before the lookup finished, the callers waiting on it must not wait forever
+            if not future.done():
+                future.cancel()
+            del self.in_flight[key]
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self.names),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+        }
+
+
+# One resolver per process, its client is opened when the service starts
+profile_resolver = ProfileResolver()
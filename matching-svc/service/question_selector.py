@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+import httpx
+from redis.asyncio import Redis
+
+from service.redis_confirmation_service import save_match_question
+from utils.logger import log
+from utils.utils import get_envvar
+
+ENV_QN_SVC_POOL_ENDPOINT = "QUESTION_SERVICE_POOL_URL"
+
+# Seconds a lookup may take before it is given up on
+REQUEST_TIMEOUT = 5
+
+
+class QuestionSelector:
+    """
+    Picks the question of a match from the question service while the users are still confirming it.\n
+    The question is fetched in the background as soon as the users are paired and stored with the match,
+    so it is sent along with the confirmed match and the room is created with its question in place.
+    """
+
+    def __init__(self):
+        self.client: httpx.AsyncClient | None = None
+        self.pending: dict[str, asyncio.Task] = {}
+        self.selected = 0
+        self.ready = 0
+        self.waited = 0
+        self.late = 0
+        self.failures = 0
+
+    def start(self) -> None:
+        """
+        Opens the HTTP client shared by every lookup.
+        """
+        self.client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+
+    async def stop(self) -> None:
+        """
+        Cancels the lookups still running and closes the HTTP client.
+        """
+        for task in list(self.pending.values()):
+            task.cancel()
+        await asyncio.gather(*self.pending.values(), return_exceptions=True)
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def prefetch(self, match_key: str, difficulty: str, category: str, confirmation_conn: Redis) -> None:
+        """
+        Starts selecting the question of the match in the background.
+        """
+        task = asyncio.create_task(self._select(match_key, difficulty, category, confirmation_conn))
+        self.pending[match_key] = task
+        task.add_done_callback(lambda _: self.pending.pop(match_key, None))
+
+    async def get_question(self, match_key: str, match_details: dict, confirmation_conn: Redis) -> dict | None:
+        """
+        Returns the question selected for the match, waiting for it if this instance is still selecting it
+        and selecting it now if no instance is.\n
+        Returns None if the question service could not be reached, in which case the collaboration service
+        picks the question once the users reach the room.
+        """
+        question = match_details.get("question") or await confirmation_conn.hget(match_key, "question")
+        if question:
+            self.ready += 1
+            return json.loads(question)
+
+        task = self.pending.get(match_key)
+        if task is not None:
+            self.waited += 1
+            return await asyncio.shield(task)
+
+        self.late += 1
+        try:
+            return await self._fetch(match_details["difficulty"], match_details["category"])
+        except Exception as e:  # noqa: BLE001
+            self.failures += 1
+            log.warning(f"Could not select the question of {match_key}: {e}")
+            return None
+
+    async def _select(self, match_key: str, difficulty: str, category: str, confirmation_conn: Redis) -> dict | None:
+        try:
+            question = await self._fetch(difficulty, category)
+            await save_match_question(match_key, json.dumps(question), confirmation_conn)
+        except Exception as e:  # noqa: BLE001
+            self.failures += 1
+            log.warning(f"Could not select the question of {match_key}: {e}")
+            return None
+
+        self.selected += 1
+        return question
+
+    async def _fetch(self, difficulty: str, category: str) -> dict:
+        if self.client is None:
+            self.start()
+        response = await self.client.get(f"{get_envvar(ENV_QN_SVC_POOL_ENDPOINT)}/{category}/{difficulty}/")
+        response.raise_for_status()
+        return response.json()
+
+    def snapshot(self) -> dict:
+        confirmed = self.ready + self.waited + self.late
+        return {
+            "selecting": len(self.pending),
+            "selected": self.selected,
+            "ready_on_confirmation": self.ready,
+            "waited_on_confirmation": self.waited,
+            "selected_on_confirmation": self.late,
+            "ready_rate": self.ready / confirmed if confirmed else None,
+            "failures": self.failures,
+        }
+
+
+# One selector per process, its client is opened when the service starts
+question_selector = QuestionSelector()
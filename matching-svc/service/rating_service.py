@@ -0,0 +1,94 @@
+from httpx import HTTPError
+from redis.asyncio import Redis
+
+from service.profile_resolver import profile_resolver
+from utils.logger import log
+from utils.utils import format_rating_key, get_envvar
+
+# Queues matched by skill rating instead of wait time, as comma separated "difficulty:category" patterns where
+# either part may be "*", e.g. "Hard:*,*:Dynamic Programming". Every other queue stays first come first served.
+RATED_QUEUES = [
+    tuple(pattern.strip().split(":", 1))
+    for pattern in get_envvar("RATED_QUEUES", "").split(",")
+    if ":" in pattern
+]
+
+INITIAL_RATING = 1000.0
+
+# Points for each attempt in the user's question history, scaled by how fast it was solved
+DIFFICULTY_POINTS = {"easy": 10.0, "medium": 25.0, "hard": 50.0}
+# Seconds an attempt of each difficulty is expected to take
+DIFFICULTY_TARGET_TIME = {"easy": 900, "medium": 1800, "hard": 2700}
+MIN_SPEED_FACTOR = 0.5
+MAX_SPEED_FACTOR = 1.5
+
+# Only the most recent attempts count, so the rating follows the user's current level
+MAX_RATED_ATTEMPTS = 50
+
+# Ratings are cached so a request does not wait on the history service every time
+RATING_TTL = 3600
+
+# The rating difference a user accepts, which grows by RATING_WINDOW_GROWTH for each second they have waited
+RATING_WINDOW_BASE = 100.0
+RATING_WINDOW_GROWTH = 10.0
+RATING_WINDOW_MAX = 600.0
+# Seconds between searches with a wider rating window
+RATING_WINDOW_STEP = 5
+
+
+def is_rated_queue(difficulty: str, category: str) -> bool:
+    """
+    Checks if the queue for the difficulty and category matches users by skill rating.
+    """
+    return any(
+        pattern_difficulty in ("*", difficulty) and pattern_category in ("*", category)
+        for pattern_difficulty, pattern_category in RATED_QUEUES
+    )
+
+
+def get_rating_window(waited: float) -> float:
+    """
+    Returns the rating difference accepted by a user who has waited for the given number of seconds.
+    """
+    return min(RATING_WINDOW_BASE + RATING_WINDOW_GROWTH * waited, RATING_WINDOW_MAX)
+
+
+def compute_rating(attempts: list[dict]) -> float:
+    """
+    Derives a skill rating from the user's question attempts.\n
+    Each attempt adds the points of its difficulty, scaled up when solved faster than expected and down when slower.
+    """
+    attempts = sorted(attempts, key=lambda attempt: attempt.get("attempted_at", ""), reverse=True)
+
+    rating = INITIAL_RATING
+    for attempt in attempts[:MAX_RATED_ATTEMPTS]:
+        difficulty = str(attempt.get("difficulty", "")).lower()
+        points = DIFFICULTY_POINTS.get(difficulty, DIFFICULTY_POINTS["easy"])
+        target_time = DIFFICULTY_TARGET_TIME.get(difficulty, DIFFICULTY_TARGET_TIME["easy"])
+        time_elapsed = max(int(attempt.get("time_elapsed") or target_time), 1)
+
+        speed_factor = min(max(target_time / time_elapsed, MIN_SPEED_FACTOR), MAX_SPEED_FACTOR)
+        rating += points * speed_factor
+
+    return round(rating, 1)
+
+
+async def get_user_rating(user_id: str, matchmaking_conn: Redis) -> float:
+    """
+    Retrieves the skill rating of the user, computing it from their question history if it is not cached.\n
+    Users whose history cannot be retrieved get the initial rating.
+    """
+    rating_key = format_rating_key(user_id)
+    cached_rating = await matchmaking_conn.get(rating_key)
+    if cached_rating is not None:
+        return float(cached_rating)
+
+    try:
+        rating = compute_rating(await profile_resolver.get_question_history(user_id))
+    except (HTTPError, ValueError) as e:
+        log.warning(f"Could not retrieve the question history of {user_id}, using the initial rating: {e}")
+        return INITIAL_RATING
+
+    await matchmaking_conn.set(rating_key, rating, ex=RATING_TTL)
+    log.info(f"User id, {user_id} has a rating of {rating}.")
+    return rating
@@ -1,19 +1,90 @@
+import time
 from redis.asyncio import Redis
 from utils.logger import log
-from utils.utils import get_envvar
+from utils.utils import ENV_REDIS_CLUSTER_NODES_KEY, connect_to_redis, get_envvar, load_script
 
 ENV_REDIS_HOST_KEY = "REDIS_HOST"
 ENV_REDIS_PORT_KEY = "REDIS_PORT"
 
+# Seconds a match record lives for, so the records of matches whose lookout never ran are reclaimed by redis
+MATCH_TTL = 120
+
+# A match stays pending until both users accept it (confirmed) or the time to accept it runs out (expired)
+MATCH_PENDING = "pending"
+
+# Results of CONFIRM_MATCH_SCRIPT
+MATCH_NOT_FOUND = 0
+USER_NOT_IN_MATCH = 1
+PARTNER_PENDING = 2
+MATCH_CONFIRMED = 3
+MATCH_ALREADY_CONFIRMED = 4
+
+# Records the user's acceptance and moves the match to confirmed once both users have accepted.
+# KEYS[1]: match key
+# ARGV[1]: user id, ARGV[2]: notification mode of the user
+# Returns one of the results above, followed by the match details if the user belongs to the match.
+CONFIRM_MATCH_SCRIPT = """
+local state = redis.call("HGET", KEYS[1], "state") or "pending"
+if redis.call("EXISTS", KEYS[1]) == 0 or state == "expired" then
+    return {0}
+end
+
+local user
+if redis.call("HGET", KEYS[1], "user_one") == ARGV[1] then
+    user = "user_one"
+elseif redis.call("HGET", KEYS[1], "user_two") == ARGV[1] then
+    user = "user_two"
+else
+    return {1}
+end
+
+if state == "confirmed" then
+    return {4, redis.call("HGETALL", KEYS[1])}
+end
+
+redis.call("HSET", KEYS[1], user .. "_confirmation", 1, user .. "_mode", ARGV[2])
+local details = redis.call("HGETALL", KEYS[1])
+if redis.call("HGET", KEYS[1], "user_one_confirmation") == "1" and redis.call("HGET", KEYS[1], "user_two_confirmation") == "1" then
+    redis.call("HSET", KEYS[1], "state", "confirmed")
+    return {3, details}
+end
+return {2, details}
+"""
+
+# Moves a match that is still pending to expired.
+# KEYS[1]: match key
+# Returns the match details, or nil if the match has already been confirmed or removed.
+EXPIRE_MATCH_SCRIPT = """
+local state = redis.call("HGET", KEYS[1], "state") or "pending"
+if redis.call("EXISTS", KEYS[1]) == 0 or state ~= "pending" then
+    return false
+end
+redis.call("HSET", KEYS[1], "state", "expired")
+return redis.call("HGETALL", KEYS[1])
+"""
+
+# Stores the question selected for a match, unless the match has already been removed.
+# KEYS[1]: match key
+# ARGV[1]: question as JSON
+SAVE_MATCH_QUESTION_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[1], "question", ARGV[1])
+return 1
+"""
+
+def _to_dict(fields: list) -> dict:
+    return dict(zip(fields[::2], fields[1::2]))
+
 def connect_to_redis_confirmation_service() -> Redis:
     """
     Establishes a connection with redis message queue.
     """
     redis_port = get_envvar(ENV_REDIS_PORT_KEY)
     host = get_envvar(ENV_REDIS_HOST_KEY)
-    # decode_responses = True is to allow redis to automatically decode responses
     log.info("Connected to redis messaging server.")
-    return Redis(host=host, port=redis_port, decode_responses=True, db=2)
+    return connect_to_redis(host, redis_port, 2, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
 
 async def setup_match_confirmation(match_key: str, user_one: str, user_one_name: str, user_two: str, user_two_name: str, difficulty: str, category: str, confirmation_conn: Redis) -> None:
     """
@@ -28,70 +99,54 @@ async def setup_match_confirmation(match_key: str, user_one: str, user_one_name:
         "user_two_name": user_two_name,
         "difficulty": difficulty,
         "category": category,
+        "state": MATCH_PENDING,
+        "created_at": time.time(),
     }
 
-    await confirmation_conn.hset(match_key, mapping = mapping)
+    async with confirmation_conn.pipeline(transaction=False) as pipe:
+        pipe.hset(match_key, mapping = mapping)
+        pipe.expire(match_key, MATCH_TTL)
+        await pipe.execute()
 
-async def check_match_exist(match_key: str, confirmation_conn: Redis) -> bool:
+async def get_match_details(match_key: str, confirmation_conn: Redis) -> dict:
     """
-    Checks if a match with the corrosponding match id exists.
+    Retrieves the information of the match.
     """
-    return await confirmation_conn.exists(match_key)
+    return await confirmation_conn.hgetall(match_key)
 
-async def check_match_user(user_id: str, match_key: str, confirmation_conn: Redis) -> bool:
+async def confirm_user_match(match_key: str, user_id: str, mode: str, confirmation_conn: Redis) -> tuple[int, dict]:
     """
-    Checks if the user belongs to this corrosponding match.
+    Records the user's acceptance of the match in a single step and returns the result along with the match details.\n
+    The mode records how the user wants to be notified once the match is finalised.\n
+    Only the acceptance that completes the match gets MATCH_CONFIRMED, later ones get MATCH_ALREADY_CONFIRMED.
     """
-    is_user_one = await confirmation_conn.hget(match_key, "user_one") == user_id
-    is_user_two = await confirmation_conn.hget(match_key, "user_two") == user_id
-    if (is_user_one or is_user_two ):
-        return True
-    else:
-        return False
+    script = load_script(CONFIRM_MATCH_SCRIPT, confirmation_conn)
+    response = await script(keys=[match_key], args=[user_id, mode], client=confirmation_conn)
 
-async def get_match_details(match_key: str, confirmation_conn: Redis) -> dict:
-    """
-    Retrieves the information of the match.
-    """
-    return await confirmation_conn.hgetall(match_key)
+    result = response[0]
+    match_details = _to_dict(response[1]) if len(response) > 1 else {}
+    if result in (PARTNER_PENDING, MATCH_CONFIRMED):
+        log.info(f"User id, {user_id} has comfirm {match_key}.")
+    return result, match_details
 
-async def get_match_partner(user_id: str, match_key: str, confirmation_conn: Redis) -> str:
+async def expire_match(match_key: str, confirmation_conn: Redis) -> dict | None:
     """
-    Retrieves the user's partner user id for that match.
+    Marks a match that has not been accepted by both users as expired and returns its details.\n
+    Returns None if the match has already been confirmed or removed.
     """
-    if (await confirmation_conn.hget(match_key, "user_one") == user_id):
-        return await confirmation_conn.hget(match_key, "user_two")
-    else:
-        return await confirmation_conn.hget(match_key, "user_one")
+    script = load_script(EXPIRE_MATCH_SCRIPT, confirmation_conn)
+    match_details = await script(keys=[match_key], client=confirmation_conn)
+    return _to_dict(match_details) if match_details else None
 
-async def update_user_confirmation(match_key: str, user_id: str, confirmation_conn: Redis) -> None:
+async def save_match_question(match_key: str, question: str, confirmation_conn: Redis) -> bool:
     """
-    Updates the comfirmation status of the user based on the given match id.
+    Stores the question selected for the match, and returns False if the match no longer exists.
     """
-    
-    if (await confirmation_conn.hget(match_key, "user_one") == user_id):
-        await confirmation_conn.hset(match_key,  mapping={"user_one_confirmation": 1})
-    else:
-        await confirmation_conn.hset(match_key,  mapping={"user_two_confirmation": 1})
-
-    log.info(f"User id, {user_id} has comfirm {match_key}.")
-    
+    script = load_script(SAVE_MATCH_QUESTION_SCRIPT, confirmation_conn)
+    return await script(keys=[match_key], args=[question], client=confirmation_conn) == 1
+
 async def delete_match_record(match_key: str, confirmation_conn: Redis) -> None:
     """
     Removes the match record from the redis server.
     """    
     await confirmation_conn.delete(match_key)
-
-async def is_match_confirmed(match_key: str, confirmation_conn: Redis) -> bool:
-    """
-    Checks if both users have accepted the match.
-    """
-    has_user_one_comfirm = await confirmation_conn.hget(match_key, "user_one_confirmation") == "1"
-    log.debug(f"User 1 status: {has_user_one_comfirm}")
-    has_user_two_comfirm = await confirmation_conn.hget(match_key, "user_two_confirmation") == "1"
-    log.debug(f"User 2 status: {has_user_two_comfirm}")
-
-    if ( has_user_one_comfirm and has_user_two_comfirm):
-        return True
-    else:
-        return False
@@ -1,9 +1,44 @@
+import json
+import time
 from redis.asyncio import Redis
 from utils.logger import log
-from utils.utils import get_envvar, sever_connection
+from utils.utils import (
+    connect_to_redis,
+    get_envvar,
+    sever_connection,
+    format_room_event_key,
+    format_room_event_stream_key,
+    load_script,
+)
 
 ENV_REDIS_HOST_KEY = "REDIS_EVENT_QUEUE_HOST"
 ENV_REDIS_PORT_KEY = "REDIS_EVENT_QUEUE_PORT"
+ENV_REDIS_CLUSTER_NODES_KEY = "REDIS_EVENT_QUEUE_CLUSTER_NODES"
+
+# Stream of the confirmed matches whose room the collaboration service has to create
+ROOM_EVENT_STREAM_KEY = format_room_event_stream_key()
+# Consumer group of the collaboration service, used to report how far behind it is
+ROOM_EVENT_GROUP = "room_creators"
+
+# The stream is trimmed to roughly this many entries, far more than can be waiting for a room at once
+ROOM_EVENT_STREAM_MAXLEN = int(get_envvar("ROOM_EVENT_STREAM_MAXLEN", "10000"))
+# Seconds a match is remembered as published, so a retried confirmation does not create a second room
+ROOM_EVENT_DEDUP_TTL = 3600
+
+# Adds the event to the stream unless the match was already published.
+# KEYS[1]: stream key, KEYS[2]: published key of the match
+# ARGV[1]: maximum length of the stream, ARGV[2]: seconds to remember the match, ARGV[3...]: fields and values
+# Returns 1 and the entry id if the event was added, otherwise 0 and the id of the earlier entry.
+PUBLISH_ROOM_EVENT_SCRIPT = """
+local published = redis.call("GET", KEYS[2])
+if published then
+    return {0, published}
+end
+
+local entry_id = redis.call("XADD", KEYS[1], "MAXLEN", "~", ARGV[1], "*", unpack(ARGV, 3))
+redis.call("SET", KEYS[2], entry_id, "EX", ARGV[2])
+return {1, entry_id}
+"""
 
 def connect_to_redis_event_queue() -> Redis:
     """
@@ -11,16 +46,93 @@ def connect_to_redis_event_queue() -> Redis:
     """
     redis_port = get_envvar(ENV_REDIS_PORT_KEY)
     host = get_envvar(ENV_REDIS_HOST_KEY)
-    # decode_responses = True is to allow redis to automatically decode responses
     log.info("Connected to event queue")
-    return Redis(host=host, port=redis_port, decode_responses=True, db=1)
+    return connect_to_redis(host, redis_port, 1, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
+
 
-async def send_match_confirmed_event(match_id : str, user1: str, user1_name: str, user2: str, user2_name: str, difficulty: str, category: str) -> None:
+class RoomEventProducer:
     """
-    Sends a event to the event queue to signal the collaboration service to create a room.
+    Publishes confirmed matches to the stream the collaboration service creates rooms from.\n
+    The producer keeps one client for the life of the process, whose pooled connections are reused by every
+    match, and publishes the whole match as a single stream entry keyed by the match id.
     """
-    redis_connection = connect_to_redis_event_queue()
 
+    def __init__(self):
+        self.event_queue_conn: Redis | None = None
+        self.published = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.publish_seconds = 0.0
+
+    def start(self) -> None:
+        """
+        Connects to the event queue.
+        """
+        self.event_queue_conn = connect_to_redis_event_queue()
+
+    async def stop(self) -> None:
+        """
+        Closes the connection to the event queue.
+        """
+        if self.event_queue_conn is not None:
+            await sever_connection(self.event_queue_conn)
+            self.event_queue_conn = None
+
+    async def publish(self, match_id: str, details: dict) -> str:
+        """
+        Publishes the details of the match, and returns the id of its stream entry.\n
+        A match that was already published is not published again.
+        """
+        if self.event_queue_conn is None:
+            self.start()
+
+        script = load_script(PUBLISH_ROOM_EVENT_SCRIPT, self.event_queue_conn)
+        fields = [item for field, value in details.items() for item in (field, value)]
+        started = time.monotonic()
+        try:
+            added, entry_id = await script(
+                keys=[ROOM_EVENT_STREAM_KEY, format_room_event_key(match_id)],
+                args=[ROOM_EVENT_STREAM_MAXLEN, ROOM_EVENT_DEDUP_TTL, *fields],
+                client=self.event_queue_conn,
+            )
+        except Exception:
+            self.failed += 1
+            raise
+
+        self.publish_seconds += time.monotonic() - started
+        if added:
+            self.published += 1
+        else:
+            self.duplicates += 1
+            log.info(f"Room event for {match_id} was already published as {entry_id}")
+        return entry_id
+
+    async def snapshot(self) -> dict:
+        groups = []
+        if self.event_queue_conn is not None and await self.event_queue_conn.exists(ROOM_EVENT_STREAM_KEY):
+            groups = await self.event_queue_conn.xinfo_groups(ROOM_EVENT_STREAM_KEY)
+        consumers = next((group for group in groups if group["name"] == ROOM_EVENT_GROUP), {})
+        attempts = self.published + self.duplicates
+        return {
+            "published": self.published,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "mean_publish_ms": round(self.publish_seconds / attempts * 1000, 2) if attempts else None,
+            "stream_length": await self.event_queue_conn.xlen(ROOM_EVENT_STREAM_KEY) if self.event_queue_conn else 0,
+            "pending": consumers.get("pending"),
+            "lag": consumers.get("lag"),
+        }
+
+
+# One producer per process, connected when the service starts
+room_event_producer = RoomEventProducer()
+
+
+async def send_match_confirmed_event(match_id : str, user1: str, user1_name: str, user2: str, user2_name: str, difficulty: str, category: str, question: dict | None = None) -> None:
+    """
+    Sends a event to the event queue to signal the collaboration service to create a room.\n
+    The question selected for the match is sent as JSON, without it the room picks its own question.
+    """
     data = {
         "match_id": match_id,
         "user_one": user1,
@@ -28,12 +140,12 @@ async def send_match_confirmed_event(match_id : str, user1: str, user1_name: str
         "user_two": user2,
         "user_two_name": user2_name,
         "difficulty": difficulty,
-        "category": category
+        "category": category,
+        "confirmed_at": time.time(),
     }
+    if question is not None:
+        data["question"] = json.dumps(question)
 
-    await redis_connection.hset(match_id, mapping = data)
-    await redis_connection.rpush("create_room", match_id)
-    await sever_connection(redis_connection)
-
-    log.info("Match confirmed event has been sent")
+    entry_id = await room_event_producer.publish(match_id, data)
 
+    log.info(f"Match confirmed event has been sent as {entry_id}")
@@ -1,31 +1,400 @@
+import asyncio
+import json
+import time
+from models.api_models import MatchRequest
 from redis.asyncio import Redis
+from service.rating_service import get_rating_window, is_rated_queue
 from utils.logger import log
-from utils.utils import get_envvar
+from utils.utils import (
+    ENV_REDIS_CLUSTER_NODES_KEY,
+    connect_to_redis,
+    get_envvar,
+    load_script,
+    format_in_queue_key,
+    format_lease_key,
+    format_matchmaking_key,
+    format_queue_key,
+    format_recent_partners_key,
+)
 
 ENV_REDIS_HOST_KEY = "REDIS_HOST"
 ENV_REDIS_PORT_KEY = "REDIS_PORT"
 
+# How a user is notified of matchmaking events
+SYNC_MODE = "sync"
+ASYNC_MODE = "async"
+
+# Results of REMOVE_WAITING_USER_SCRIPT
+USER_NOT_QUEUED = 0
+USER_MATCH_FOUND = 1
+USER_NOT_IN_QUEUE = 2
+USER_REMOVED = 3
+
+# Seconds a user waits before their criteria widen, first to all of their accepted categories at their
+# preferred difficulty and then to all of their accepted difficulties as well
+WIDENING_STEPS = [10, 20]
+
+# Sorted set of every user waiting for a match, scored by the time they joined matchmaking,
+# which the batch matching engine reads on each tick
+WAITING_KEY = format_matchmaking_key("waiting")
+
+# Seconds the queue details of a request live for, comfortably longer than a request waits for a partner and
+# then for the match to be confirmed, so the details of a client that disappears are reclaimed by redis.
+# The time to live restarts when the user is paired.
+IN_QUEUE_TTL = 120
+
+# A waiting request holds a lease that its client keeps renewing. Users whose lease ran out have left without
+# cancelling, so they are skipped and removed from the queues instead of being paired.
+LEASE_TTL = 10
+
+# Number of waiting users removed because their lease ran out
+PURGED_KEY = format_matchmaking_key("purged")
+
+# Users matched with each other within this many seconds are not paired again, so two users in a quiet queue do
+# not keep getting each other. Each user's recent partners are a sorted set scored by the time they were matched,
+# capped to the latest RECENT_PARTNERS_MAX partners and expiring once the window has passed.
+RECENT_PAIR_WINDOW = int(get_envvar("RECENT_PAIR_WINDOW", "300"))
+RECENT_PARTNERS_MAX = 20
+
+# Most queue members a search looks at, so a queue full of users who left cannot keep a script running
+MAX_SEARCHED_CANDIDATES = 1000
+
+# Each queue is a sorted set of the users willing to be matched on its difficulty and category.
+# A user waits in every queue their current criteria accept, and any two users in the same queue can be paired.
+# The queues a user is waiting in are kept in the "queues" field of their queue details, one per line.
+# First come first served queues are scored by the time users joined matchmaking, so the longest waiting user is
+# always at the front. Rated queues are scored by skill rating, and the nearest rated user within the searching
+# user's rating window is picked with two range queries.
+# KEYS[1]: in queue key of the user, KEYS[2..n]: queues to search, in order of preference
+# pair_or_join arguments: user id, in queue key prefix, time the user joined matchmaking, rating of the user,
+# rating window of the user, and one character per queue searched, "r" if it is rated and "f" otherwise.
+# Users found without a live lease are removed from the queues along with their queue details while searching,
+# and users matched with the searching user within the recent pair window are skipped.
+# Returns the partner's user id and the position of the queue they were found in, or nil if the user
+# has been added to the queues instead.
+PAIR_OR_JOIN_LUA = f"""
+local waiting_key = "{WAITING_KEY}"
+local in_queue_ttl = {IN_QUEUE_TTL}
+local in_queue_prefix = "{format_in_queue_key("")}"
+local lease_prefix = "{format_lease_key("")}"
+local lease_ttl = {LEASE_TTL}
+local purged_key = "{PURGED_KEY}"
+local recent_prefix = "{format_recent_partners_key("")}"
+local recent_window = {RECENT_PAIR_WINDOW}
+local recent_max = {RECENT_PARTNERS_MAX}
+local max_candidates = {MAX_SEARCHED_CANDIDATES}
+""" + """
+local now = tonumber(redis.call("TIME")[1])
+
+local function leave_queues(user, in_queue_key)
+    local queues = redis.call("HGET", in_queue_key, "queues") or ""
+    for queue in string.gmatch(queues, "[^\\n]+") do
+        redis.call("ZREM", queue, user)
+    end
+    redis.call("ZREM", waiting_key, user)
+    redis.call("HSET", in_queue_key, "queues", "")
+end
+
+-- Checks that the user is still there, removing them from matchmaking if their lease ran out.
+-- The user is removed from the queue they were found in directly, as their queue details may have expired
+-- or no longer list it.
+local function is_live(user, queue)
+    if redis.call("EXISTS", lease_prefix .. user) == 1 then
+        return true
+    end
+    leave_queues(user, in_queue_prefix .. user)
+    if queue then
+        redis.call("ZREM", queue, user)
+    end
+    redis.call("DEL", in_queue_prefix .. user)
+    redis.call("INCR", purged_key)
+    return false
+end
+
+local function paired_recently(user, candidate)
+    local matched_at = redis.call("ZSCORE", recent_prefix .. user, candidate)
+    return matched_at and tonumber(matched_at) > now - recent_window
+end
+
+-- Records the pair in both users' recent partners, dropping the partners that are too old or too many
+local function remember_pair(user, partner)
+    if recent_window <= 0 then
+        return
+    end
+    for _, pair in ipairs({{user, partner}, {partner, user}}) do
+        local key = recent_prefix .. pair[1]
+        redis.call("ZADD", key, now, pair[2])
+        redis.call("ZREMRANGEBYSCORE", key, "-inf", now - recent_window)
+        redis.call("ZREMRANGEBYRANK", key, 0, -recent_max - 1)
+        redis.call("EXPIRE", key, recent_window)
+    end
+end
+
+local function nearest_rated(queue, user, rating, window)
+    -- Enough users are read on each side to get past the user and all of their recent partners
+    local limit = recent_max + 2
+    for _ = 1, max_candidates do
+        local nearest, nearest_difference
+        local below = redis.call("ZREVRANGEBYSCORE", queue, rating, rating - window, "WITHSCORES", "LIMIT", 0, limit)
+        local above = redis.call("ZRANGEBYSCORE", queue, rating, rating + window, "WITHSCORES", "LIMIT", 0, limit)
+        for _, candidates in ipairs({below, above}) do
+            for i = 1, #candidates, 2 do
+                local difference = math.abs(tonumber(candidates[i + 1]) - rating)
+                if candidates[i] ~= user and (not nearest or difference < nearest_difference)
+                    and not paired_recently(user, candidates[i]) then
+                    nearest, nearest_difference = candidates[i], difference
+                end
+            end
+        end
+        if not nearest or is_live(nearest, queue) then
+            return nearest
+        end
+    end
+    return nil
+end
+
+local function longest_waiting(queue, user)
+    local skipped, searched = 0, 0
+    while searched < max_candidates do
+        local members = redis.call("ZRANGE", queue, skipped, skipped + recent_max)
+        if #members == 0 then
+            return nil
+        end
+        for _, member in ipairs(members) do
+            searched = searched + 1
+            if member == user or paired_recently(user, member) then
+                skipped = skipped + 1
+            elseif is_live(member, queue) then
+                return member
+            end
+            -- A member that was not live has been removed, so the members after it moved up by one
+        end
+    end
+    return nil
+end
+
+local function mark_matched(user, in_queue_key)
+    leave_queues(user, in_queue_key)
+    redis.call("HSET", in_queue_key, "match_found", 1)
+    redis.call("EXPIRE", in_queue_key, in_queue_ttl)
+end
+
+local function join_queues(user, joined_at, rating, rated)
+    local queues = redis.call("HGET", KEYS[1], "queues") or ""
+    for i = 2, #KEYS do
+        -- Searching a queue the user is already waiting in again must not add it twice
+        if not redis.call("ZSCORE", KEYS[i], user) then
+            queues = queues .. KEYS[i] .. "\\n"
+        end
+        if string.sub(rated, i - 1, i - 1) == "r" then
+            redis.call("ZADD", KEYS[i], rating, user)
+        else
+            redis.call("ZADD", KEYS[i], joined_at, user)
+        end
+    end
+    redis.call("HSET", KEYS[1], "queues", queues)
+end
+
+local function pair_or_join(user, prefix, joined_at, rating, window, rated)
+    rating, window = tonumber(rating), tonumber(window)
+    for i = 2, #KEYS do
+        local partner
+        if string.sub(rated, i - 1, i - 1) == "r" then
+            partner = nearest_rated(KEYS[i], user, rating, window)
+        else
+            partner = longest_waiting(KEYS[i], user)
+        end
+
+        if partner then
+            mark_matched(partner, prefix .. partner)
+            mark_matched(user, KEYS[1])
+            remember_pair(user, partner)
+            return {partner, i - 1}
+        end
+    end
+
+    join_queues(user, joined_at, rating, rated)
+    return false
+end
+"""
+
+# Atomically stores the details of a new request and pairs the user or adds them to the queue.
+# Both users are marked as having found a match in the same step, so no lock is needed around it.
+# KEYS are as in PAIR_OR_JOIN_LUA
+# ARGV[1..6]: the pair_or_join arguments, ARGV[7]: difficulty, ARGV[8]: category, ARGV[9]: notification mode,
+# ARGV[10]: ticket, ARGV[11]: accepted difficulties, ARGV[12]: accepted categories
+STORE_REQUEST_LUA = """
+redis.call(
+    "HSET", KEYS[1],
+    "difficulty", ARGV[7], "category", ARGV[8], "match_found", 0, "mode", ARGV[9], "ticket", ARGV[10],
+    "difficulties", ARGV[11], "categories", ARGV[12], "joined_at", ARGV[3], "rating", ARGV[4], "queues", ""
+)
+redis.call("EXPIRE", KEYS[1], in_queue_ttl)
+redis.call("SET", lease_prefix .. ARGV[1], ARGV[10], "EX", lease_ttl)
+"""
+FIND_PARTNER_OR_ENQUEUE_SCRIPT = PAIR_OR_JOIN_LUA + STORE_REQUEST_LUA + """
+return pair_or_join(ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6])
+"""
+
+# Stores the details of a new request and adds the user to the queue without searching it,
+# leaving the pairing to the batch matching engine. KEYS and ARGV are as in FIND_PARTNER_OR_ENQUEUE_SCRIPT.
+ENQUEUE_SCRIPT = PAIR_OR_JOIN_LUA + STORE_REQUEST_LUA + """
+join_queues(ARGV[1], ARGV[3], tonumber(ARGV[4]), ARGV[6])
+redis.call("ZADD", waiting_key, ARGV[3], ARGV[1])
+"""
+
+# Commits the pairs chosen by the batch matching engine. A pair is only committed if both requests are
+# still waiting, as a user may have left or been paired by another instance since the pairs were chosen,
+# and the users were not matched with each other within the recent pair window.
+# KEYS[1]: waiting key, which only routes the script to the matchmaking slot in a cluster
+# ARGV[1]: in queue key prefix, ARGV[2..n]: the user, their ticket, the partner and their ticket of each pair
+# Returns the positions of the pairs that were committed.
+COMMIT_PAIRS_SCRIPT = PAIR_OR_JOIN_LUA + """
+local function is_waiting(in_queue_key, ticket)
+    return redis.call("HGET", in_queue_key, "ticket") == ticket and redis.call("HGET", in_queue_key, "match_found") == "0"
+end
+
+local committed = {}
+for i = 2, #ARGV, 4 do
+    local user, partner = ARGV[i], ARGV[i + 2]
+    local user_key, partner_key = ARGV[1] .. user, ARGV[1] .. partner
+    if is_waiting(user_key, ARGV[i + 1]) and is_waiting(partner_key, ARGV[i + 3])
+        and not paired_recently(user, partner) and is_live(user) and is_live(partner) then
+        mark_matched(user, user_key)
+        mark_matched(partner, partner_key)
+        remember_pair(user, partner)
+        table.insert(committed, (i + 2) / 4)
+    end
+end
+return committed
+"""
+
+# Searches the queues that a waiting user's widened criteria now accept, and joins them if there is no one to pair with.
+# KEYS are as in PAIR_OR_JOIN_LUA
+# ARGV[1]: user id, ARGV[2]: in queue key prefix, ARGV[3]: ticket of the request being widened,
+# ARGV[4]: rating window of the user, ARGV[5]: whether each queue is rated, as in pair_or_join
+# Returns 0 if the request is no longer waiting or its lease ran out, otherwise the same as PAIR_OR_JOIN_LUA.
+WIDEN_SEARCH_SCRIPT = PAIR_OR_JOIN_LUA + """
+if redis.call("HGET", KEYS[1], "ticket") ~= ARGV[3] or redis.call("HGET", KEYS[1], "match_found") ~= "0" then
+    return 0
+end
+if not is_live(ARGV[1]) then
+    return 0
+end
+local joined_at = redis.call("HGET", KEYS[1], "joined_at")
+local rating = redis.call("HGET", KEYS[1], "rating")
+return pair_or_join(ARGV[1], ARGV[2], joined_at, rating, ARGV[4], ARGV[5])
+"""
+
+# Puts a user whose match was not confirmed back into matchmaking, keeping the time they first joined so they are
+# ahead of everyone who joined after them, and searches for a partner straight away unless the batch engine pairs them.
+# KEYS are as in PAIR_OR_JOIN_LUA
+# ARGV[1]: user id, ARGV[2]: in queue key prefix, ARGV[3]: ticket of the matched request, ARGV[4]: new ticket,
+# ARGV[5]: rating window of the user, ARGV[6]: whether each queue is rated, as in pair_or_join,
+# ARGV[7]: current time, ARGV[8]: 1 to search for a partner, 0 to only join the queues,
+# ARGV[9]: how the user is now notified of matchmaking events
+# Returns 0 if the request is not the one that was matched, 1 if the user is waiting in the queues again,
+# otherwise the same as PAIR_OR_JOIN_LUA.
+REQUEUE_SCRIPT = PAIR_OR_JOIN_LUA + """
+if redis.call("HGET", KEYS[1], "ticket") ~= ARGV[3] or redis.call("HGET", KEYS[1], "match_found") ~= "1" then
+    return 0
+end
+local joined_at = redis.call("HGET", KEYS[1], "joined_at")
+local rating = redis.call("HGET", KEYS[1], "rating")
+redis.call("HSET", KEYS[1], "match_found", 0, "ticket", ARGV[4], "requeued_at", ARGV[7], "mode", ARGV[9], "queues", "")
+redis.call("EXPIRE", KEYS[1], in_queue_ttl)
+redis.call("SET", lease_prefix .. ARGV[1], ARGV[4], "EX", lease_ttl)
+
+if ARGV[8] == "0" then
+    join_queues(ARGV[1], joined_at, tonumber(rating), ARGV[6])
+    redis.call("ZADD", waiting_key, joined_at, ARGV[1])
+    return 1
+end
+return pair_or_join(ARGV[1], ARGV[2], joined_at, rating, ARGV[5], ARGV[6]) or 1
+"""
+
+# Atomically removes a user who is still waiting from every queue they are in, along with their queue details.
+# KEYS[1]: queue key of the request, KEYS[2]: in queue key of the user
+# ARGV[1]: user id, ARGV[2]: ticket of the request to remove, or an empty string for any request
+# Returns one of USER_NOT_QUEUED, USER_MATCH_FOUND, USER_NOT_IN_QUEUE or USER_REMOVED.
+REMOVE_WAITING_USER_SCRIPT = f"""
+local waiting_key = "{WAITING_KEY}"
+local lease_prefix = "{format_lease_key("")}"
+""" + """
+if redis.call("EXISTS", KEYS[2]) == 0 then
+    return 0
+end
+if ARGV[2] ~= "" and redis.call("HGET", KEYS[2], "ticket") ~= ARGV[2] then
+    return 0
+end
+if redis.call("HGET", KEYS[2], "match_found") == "1" then
+    return 1
+end
+-- The first queue joined is the one the user asked for, the rest were joined by widening
+local queues = redis.call("HGET", KEYS[2], "queues") or ""
+if string.match(queues, "^[^\\n]+") ~= KEYS[1] then
+    return 2
+end
+for queue in string.gmatch(queues, "[^\\n]+") do
+    redis.call("ZREM", queue, ARGV[1])
+end
+redis.call("ZREM", waiting_key, ARGV[1])
+redis.call("DEL", KEYS[2], lease_prefix .. ARGV[1])
+return 3
+"""
+
+# Renews the lease of a request that is still waiting for a partner.
+# A lease that already ran out is not renewed, as the request may have been skipped by a search in the meantime.
+# KEYS[1]: in queue key of the user, KEYS[2]: lease key of the user
+# ARGV[1]: ticket of the request, ARGV[2]: lease in seconds
+# Returns 1 if the lease was renewed, or 0 if the request is no longer waiting.
+RENEW_LEASE_SCRIPT = """
+if redis.call("HGET", KEYS[1], "ticket") ~= ARGV[1] or redis.call("HGET", KEYS[1], "match_found") ~= "0" then
+    return 0
+end
+if not redis.call("SET", KEYS[2], ARGV[1], "EX", ARGV[2], "XX") then
+    return 0
+end
+return 1
+"""
+
+# Members of a queue or the waiting set checked by each call of REMOVE_ORPHANED_MEMBERS_SCRIPT, so sweeping a long
+# queue is spread over many short scripts instead of blocking the matchmaking slot for the whole queue
+ORPHAN_SWEEP_PAGE = 200
+
+# Removes the members of a page of a queue or the waiting set whose request is no longer waiting,
+# such as users whose queue details expired or whose lease ran out after their client disappeared.
+# KEYS[1]: queue or waiting key
+# ARGV[1]: in queue key prefix, ARGV[2]: rank of the first member of the page, ARGV[3]: members in a page
+# Returns the number of members removed and the rank the next page starts at, or -1 if this was the last page.
+REMOVE_ORPHANED_MEMBERS_SCRIPT = PAIR_OR_JOIN_LUA + """
+local start = tonumber(ARGV[2])
+local page = tonumber(ARGV[3])
+local members = redis.call("ZRANGE", KEYS[1], start, start + page - 1)
+local removed = 0
+for _, member in ipairs(members) do
+    if redis.call("HGET", ARGV[1] .. member, "match_found") ~= "0" then
+        redis.call("ZREM", KEYS[1], member)
+        removed = removed + 1
+    elseif not is_live(member, KEYS[1]) then
+        removed = removed + 1
+    end
+end
+if #members < page then
+    return {removed, -1}
+end
+-- The removed members no longer take up a rank, so the next page starts that much earlier
+return {removed, start + #members - removed}
+"""
+
 def connect_to_redis_matchmaking_service() -> Redis:
     """
     Establishes a connection with redis queue.
     """
     redis_port = get_envvar(ENV_REDIS_PORT_KEY)
     host = get_envvar(ENV_REDIS_HOST_KEY)
-    # decode_responses = True is to allow redis to automatically decode responses
     log.info("Connected to redis queue server.")
-    return Redis(host=host, port=redis_port, decode_responses=True, db=0)
-
-async def add_user_queue_details(key: str, difficulty: str, category: str, matchmaking_conn: Redis) -> None:
-    """
-    Adds the user into the set of queued users.\n
-    """
-    mapping = {
-        "difficulty": difficulty,
-        "category": category,
-        "match_found": 0
-    }
-
-    await matchmaking_conn.hset(key, mapping=mapping)
+    return connect_to_redis(host, redis_port, 0, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
 
 async def check_user_in_any_queue(key: str, matchmaking_conn: Redis) -> bool:
     """
@@ -49,62 +418,238 @@ async def check_user_found_match(key: str, matchmaking_conn: Redis) -> bool:
     else:
         return False
 
-async def update_user_match_found_status(key: str, matchmaking_conn: Redis) -> None:
-    """
-    Updates the users status to be that they have found a match.
-    """
-    await matchmaking_conn.hset(key, mapping={"match_found": 1})
-
 async def remove_user_queue_details(key: str, matchmaking_conn: Redis) -> None:
     """
     Removes the user from the set of queued users.\n
     """
     await matchmaking_conn.delete(key)
 
-async def find_user_in_queue(user_id: str, key:str,  matchmaking_conn: Redis) -> int:
-    """
-    Finds the user in the queue based on the key and return the index. If the user is no in the queue \n
-    return none.
-    """
-    index = await  matchmaking_conn.lpos(key, user_id)
-    return index
-
 async def get_user_queue_details(key: str, matchmaking_conn: Redis) -> dict:
     """
     Retrieves the queue details of the user.
     """
     return  await matchmaking_conn.hgetall(key)
 
-async def enqueue_user(user_id: str, key:str,  matchmaking_conn: Redis) -> None:
+def get_widened_criteria(queue_details: dict, level: int) -> list[tuple[str, str]]:
+    """
+    Returns the difficulty and category pairs the user accepts after widening their criteria level times,
+    starting with their preferred pair.
+    """
+    difficulty = queue_details["difficulty"]
+    category = queue_details["category"]
+    difficulties = [difficulty] + [d for d in json.loads(queue_details.get("difficulties") or "[]") if d != difficulty]
+    categories = [category] + [c for c in json.loads(queue_details.get("categories") or "[]") if c != category]
+
+    if level == 0:
+        return [(difficulty, category)]
+    if level == 1:
+        return [(difficulty, c) for c in categories]
+    return [(d, c) for d in difficulties for c in categories]
+
+def get_widening_level(waited: float) -> int:
     """
-    Adds the user into the queue based on the key.
+    Returns how many times the criteria of a user who has waited for the given number of seconds have widened.
     """
-    await matchmaking_conn.rpush(key, user_id)
+    return sum(1 for step in WIDENING_STEPS if waited >= step)
+
+def _format_rated(criteria: list[tuple[str, str]]) -> str:
+    return "".join("r" if is_rated_queue(difficulty, category) else "f" for difficulty, category in criteria)
+
+def _format_request_args(user_id: str, match_request: MatchRequest, mode: str, ticket: str, rating: float) -> list:
+    return [
+        user_id,
+        format_in_queue_key(""),
+        time.time(),
+        rating,
+        get_rating_window(0),
+        _format_rated([(match_request.difficulty, match_request.category)]),
+        match_request.difficulty,
+        match_request.category,
+        mode,
+        ticket,
+        json.dumps(match_request.accepted_difficulties),
+        json.dumps(match_request.accepted_categories),
+    ]
+
+async def find_partner_or_enqueue(user_id: str, key: str, match_request: MatchRequest, mode: str, ticket: str, rating: float, matchmaking_conn: Redis) -> str | None:
+    """
+    Based on the difficulty and category fetch the longest waiting person in the queue, or the nearest rated person
+    if the queue is rated, and mark both users as matched.\n
+    If there is no one to pair with, the user is added to the queue instead and None is returned.\n
+    The mode decides how the user is notified of the match, and the ticket identifies this request.
+    """
+    script = load_script(FIND_PARTNER_OR_ENQUEUE_SCRIPT, matchmaking_conn)
+    in_queue_key = format_in_queue_key(user_id)
+    result = await script(
+        keys=[in_queue_key, key],
+        args=_format_request_args(user_id, match_request, mode, ticket, rating),
+        client=matchmaking_conn,
+    )
+
+    if result is None:
+        log.info(f"User id, {user_id} has been added into the queue with the key: {key}.")
+        return None
+
+    partner = result[0]
+    log.info(f"User id, {partner} has been removed from the queue: {key}.")
+    return partner
+
+async def enqueue_user(user_id: str, key: str, match_request: MatchRequest, mode: str, ticket: str, rating: float, matchmaking_conn: Redis) -> None:
+    """
+    Adds the user to the queue without looking for a partner, the batch matching engine pairs them on its next tick.
+    """
+    script = load_script(ENQUEUE_SCRIPT, matchmaking_conn)
+    in_queue_key = format_in_queue_key(user_id)
+    await script(
+        keys=[in_queue_key, key],
+        args=_format_request_args(user_id, match_request, mode, ticket, rating),
+        client=matchmaking_conn,
+    )
     log.info(f"User id, {user_id} has been added into the queue with the key: {key}.")
 
-async def dequeue_user(user_id: str, key:str,  matchmaking_conn: Redis) -> None:
+async def get_recent_partners(user_id: str, matchmaking_conn: Redis) -> set[str]:
+    """
+    Retrieves the partners the user was matched with within the recent pair window.
+    """
+    key = format_recent_partners_key(user_id)
+    return set(await matchmaking_conn.zrangebyscore(key, f"({time.time() - RECENT_PAIR_WINDOW}", "+inf"))
+
+async def get_waiting_users(matchmaking_conn: Redis) -> dict[str, dict]:
     """
-    Removes the user from the queue based on the key.
+    Retrieves the queue details of every user who is still waiting for a match and whose lease is live,
+    along with their recent partners under "recent_partners".
     """
-    await matchmaking_conn.lrem(key, 1, user_id)
-    log.info(f"User id, {user_id} has been removed from the queue: {key}.")
+    user_ids = await matchmaking_conn.zrange(WAITING_KEY, 0, -1)
+    queue_details, leases, recent_partners = await asyncio.gather(
+        asyncio.gather(*(matchmaking_conn.hgetall(format_in_queue_key(user_id)) for user_id in user_ids)),
+        asyncio.gather(*(matchmaking_conn.exists(format_lease_key(user_id)) for user_id in user_ids)),
+        asyncio.gather(*(get_recent_partners(user_id, matchmaking_conn) for user_id in user_ids)),
+    )
+    return {
+        user_id: {**details, "recent_partners": recent}
+        for user_id, details, lease, recent in zip(user_ids, queue_details, leases, recent_partners)
+        if details.get("match_found") == "0" and lease
+    }
 
-async def get_next_user(key:str, matchmaking_conn: Redis) -> str:
+async def renew_lease(user_id: str, ticket: str, matchmaking_conn: Redis) -> bool:
     """
-    Retrieves the next person in the queue based on the key.
+    Renews the lease of the user's request, and returns False if the request is no longer waiting.
     """
-    user_id = await matchmaking_conn.lpop(key)
-    log.info(f"User id, {user_id} has been removed from the queue: {key}.")
-    return user_id
+    script = load_script(RENEW_LEASE_SCRIPT, matchmaking_conn)
+    renewed = await script(
+        keys=[format_in_queue_key(user_id), format_lease_key(user_id)],
+        args=[ticket, LEASE_TTL],
+        client=matchmaking_conn,
+    )
+    return renewed == 1
 
-async def find_partner(key:str, matchmaking_conn: Redis) -> str:
+async def get_purged_count(matchmaking_conn: Redis) -> int:
     """
-    Based on the difficulty and category fetch the next person in the queue.\n
+    Returns how many waiting users have been removed because their lease ran out.
     """
-    length = await matchmaking_conn.llen(key) 
-    if (length > 0):
-        user_id = await get_next_user(key, matchmaking_conn)
-        return user_id
-    else:
-        # Means there is no one in the queue
-        return ""
+    return int(await matchmaking_conn.get(PURGED_KEY) or 0)
+
+async def commit_pairs(pairs: list[tuple[str, str, str, str]], matchmaking_conn: Redis) -> list[int]:
+    """
+    Marks each pair of users given as (user, ticket, partner, partner's ticket) as matched and removes them from
+    their queues, skipping the pairs where either request is no longer waiting.\n
+    Returns the indexes of the pairs that were committed.
+    """
+    if not pairs:
+        return []
+
+    script = load_script(COMMIT_PAIRS_SCRIPT, matchmaking_conn)
+    committed = await script(
+        keys=[WAITING_KEY],
+        args=[format_in_queue_key(""), *(value for pair in pairs for value in pair)],
+        client=matchmaking_conn,
+    )
+    return [position - 1 for position in committed]
+
+async def remove_orphaned_members(key: str, matchmaking_conn: Redis) -> int:
+    """
+    Removes the users in the queue or waiting set whose request is no longer waiting, and returns how many there were.\n
+    The queue is checked a page at a time, one script call per page.
+    """
+    script = load_script(REMOVE_ORPHANED_MEMBERS_SCRIPT, matchmaking_conn)
+    total = 0
+    start = 0
+    while start >= 0:
+        removed, start = await script(
+            keys=[key], args=[format_in_queue_key(""), start, ORPHAN_SWEEP_PAGE], client=matchmaking_conn
+        )
+        total += removed
+    return total
+
+async def widen_search(user_id: str, ticket: str, criteria: list[tuple[str, str]], window: float, matchmaking_conn: Redis) -> tuple[str, int] | None:
+    """
+    Searches the queues of the given difficulty and category pairs for a partner for a user who is still waiting,
+    or adds the user to them. Rated queues are searched within the given rating window.\n
+    Returns the partner and the index of the pair they were found for, or None if the user is waiting in the queues
+    or is no longer waiting at all.
+    """
+    script = load_script(WIDEN_SEARCH_SCRIPT, matchmaking_conn)
+    in_queue_key = format_in_queue_key(user_id)
+    keys = [format_queue_key(difficulty, category) for difficulty, category in criteria]
+    result = await script(
+        keys=[in_queue_key, *keys],
+        args=[user_id, format_in_queue_key(""), ticket, window, _format_rated(criteria)],
+        client=matchmaking_conn,
+    )
+
+    if not result:
+        return None
+
+    partner, position = result
+    log.info(f"User id, {partner} has been paired with {user_id} after widening their criteria.")
+    return partner, position - 1
+
+async def requeue_user(
+    user_id: str,
+    old_ticket: str,
+    ticket: str,
+    criteria: list[tuple[str, str]],
+    window: float,
+    search: bool,
+    mode: str,
+    matchmaking_conn: Redis,
+) -> tuple[bool, tuple[str, int] | None]:
+    """
+    Puts a user whose match was not confirmed back into the queues of the given difficulty and category pairs
+    under a new ticket, ahead of everyone who joined matchmaking after them.\n
+    If search is set, the queues are searched first and the user is paired straight away if someone is waiting.
+    The mode replaces how the user is notified, as they may be waiting on their confirmation differently.\n
+    Returns whether the user was put back, along with the partner and the index of the pair they were found for.
+    """
+    script = load_script(REQUEUE_SCRIPT, matchmaking_conn)
+    in_queue_key = format_in_queue_key(user_id)
+    keys = [format_queue_key(difficulty, category) for difficulty, category in criteria]
+    result = await script(
+        keys=[in_queue_key, *keys],
+        args=[user_id, format_in_queue_key(""), old_ticket, ticket, window, _format_rated(criteria), time.time(), int(search), mode],
+        client=matchmaking_conn,
+    )
+
+    if result == 0:
+        return False, None
+    if result == 1:
+        log.info(f"User id, {user_id} has been put back into the queues: {keys}.")
+        return True, None
+
+    partner, position = result
+    log.info(f"User id, {partner} has been paired with {user_id} after their last match was not confirmed.")
+    return True, (partner, position - 1)
+
+async def remove_waiting_user(user_id: str, key: str, matchmaking_conn: Redis, ticket: str = "") -> int:
+    """
+    Removes the user from the queue based on the key if they have not been paired with anyone yet.\n
+    If a ticket is given, the user is only removed if they are still queuing with that request.\n
+    Returns USER_NOT_QUEUED, USER_MATCH_FOUND, USER_NOT_IN_QUEUE or USER_REMOVED.
+    """
+    script = load_script(REMOVE_WAITING_USER_SCRIPT, matchmaking_conn)
+    in_queue_key = format_in_queue_key(user_id)
+    result = await script(keys=[key, in_queue_key], args=[user_id, ticket], client=matchmaking_conn)
+
+    if result == USER_REMOVED:
+        log.info(f"User id, {user_id} has been removed from the queue: {key}.")
+    return result
@@ -1,48 +1,109 @@
+import json
 from redis.asyncio import Redis
+from service.message_dispatcher import MESSAGE_CHANNEL, message_dispatcher
 from utils.logger import log
-from utils.utils import get_envvar
+from utils.utils import CLUSTER_MODE, ENV_REDIS_CLUSTER_NODES_KEY, connect_to_redis, connect_to_redis_node, get_envvar
 
 ENV_REDIS_HOST_KEY = "REDIS_HOST"
 ENV_REDIS_PORT_KEY = "REDIS_PORT"
 
+# Long enough for a client to reconnect and catch up on the last event
+MATCH_STATUS_TTL = 300
+
+# Messages nobody pops within this many seconds are dropped along with their list
+MESSAGE_TTL = 60
+
+# Sent to a user waiting for their partner to accept, followed by their new ticket, when the match was not
+# confirmed and they have been put back into the queue
+REQUEUED_MESSAGE = "requeued"
+
 def connect_to_redis_message_service() -> Redis:
     """
     Establishes a connection with redis message queue.
     """
     redis_port = get_envvar(ENV_REDIS_PORT_KEY)
     host = get_envvar(ENV_REDIS_HOST_KEY)
-    # decode_responses = True is to allow redis to automatically decode responses
     log.info("Connected to redis messaging server.")
-    return Redis(host=host, port=redis_port, decode_responses=True, db=1)
+    return connect_to_redis(host, redis_port, 1, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
+
+def connect_to_redis_message_subscriber() -> Redis:
+    """
+    Establishes a connection with a single node of redis message queue to subscribe to the messages over.
+    """
+    redis_port = get_envvar(ENV_REDIS_PORT_KEY)
+    host = get_envvar(ENV_REDIS_HOST_KEY)
+    return connect_to_redis_node(host, redis_port, 1, get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, ""))
+
+async def send_message(message_key: str, body: str, message_conn: Redis) -> None:
+    """
+    Pushes the message onto the receiver's list and wakes the request waiting on it.
+    """
+    if CLUSTER_MODE:
+        # A cluster pipeline may reach the nodes out of order, and the key must be pushed before it is published
+        await message_conn.rpush(message_key, body)
+        await message_conn.expire(message_key, MESSAGE_TTL)
+        await message_conn.publish(MESSAGE_CHANNEL, message_key)
+        return
+
+    async with message_conn.pipeline(transaction=True) as pipe:
+        pipe.rpush(message_key, body)
+        pipe.expire(message_key, MESSAGE_TTL)
+        pipe.publish(MESSAGE_CHANNEL, message_key)
+        await pipe.execute()
 
 async def send_match_found_message(message_key: str, match_id: str, message_conn:Redis) -> None:
     """
     Sends a message to the user that a match as been found with the corrosponding match id.
     """
-    await message_conn.rpush(message_key, match_id)
+    await send_message(message_key, match_id, message_conn)
 
 async def send_match_finalised_message(message_key: str, collab_svc_data: str, message_conn:Redis) -> None:
     """
     Sends a message to the user that both parties have accepted the match and it has been finalised.
     """
-    await message_conn.rpush(message_key, collab_svc_data)
+    await send_message(message_key, collab_svc_data, message_conn)
+
+async def send_match_requeued_message(message_key: str, ticket: str, message_conn: Redis) -> None:
+    """
+    Sends a message to the user that their match was not confirmed and they are back in the queue with the ticket.
+    """
+    await send_message(message_key, f"{REQUEUED_MESSAGE}_{ticket}", message_conn)
 
 async def send_match_terminated_message(message_key: str, message_conn:Redis) -> None:
     """
     Sends a message to the user that his match has been successfully terminated.
     """
-    await message_conn.rpush(message_key, "terminate")
+    await send_message(message_key, "terminate", message_conn)
 
 async def send_new_request_message(message_key: str, message_conn:Redis) -> None:
     """
     Sends a message to the old request that a new request has been made.
     """
-    await message_conn.rpush(message_key, "new request made")
+    await send_message(message_key, "new request made", message_conn)
 
-async def wait_for_message(message_key: str, message_conn: Redis, timeout: int = 40) -> str:
+async def wait_for_message(message_key: str, timeout: int = 40) -> tuple[str, str] | None:
     """
     Waits for a message to be sent based on the key. If no message is sent after the timeout,
     then return None
     """
-    message =  await message_conn.blpop(message_key, timeout= timeout) # Timeout 40 seconds
-    return message
+    # Waiting requests share the dispatcher's subscription instead of blocking a connection each
+    return await message_dispatcher.wait(message_key, timeout)
+
+async def save_match_status(status_key: str, status: dict, message_conn: Redis) -> None:
+    """
+    Stores the latest matchmaking event of the user so clients that reconnect can catch up on it.
+    """
+    await message_conn.set(status_key, json.dumps(status), ex=MATCH_STATUS_TTL)
+
+async def get_match_status(status_key: str, message_conn: Redis) -> dict | None:
+    """
+    Retrieves the latest matchmaking event of the user, or None if there is no recent event.
+    """
+    status = await message_conn.get(status_key)
+    return json.loads(status) if status else None
+
+async def clear_match_status(status_key: str, message_conn: Redis) -> None:
+    """
+    Removes the latest matchmaking event of the user.
+    """
+    await message_conn.delete(status_key)
@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+from redis.asyncio import Redis
+
+from utils.logger import log
+from utils.utils import format_key, format_queue_key, format_telemetry_key
+
+# Events recorded for each queue, matched, timed out, requeued and rematched are counted per user and the rest per match.
+# Users who accepted a match that was not confirmed are requeued, and rematched once they are paired again.
+ENQUEUED = "enqueued"
+MATCHED = "matched"
+CONFIRMED = "confirmed"
+DECLINED = "declined"
+TIMED_OUT = "timed_out"
+REQUEUED = "requeued"
+REMATCHED = "rematched"
+EVENTS = [ENQUEUED, MATCHED, CONFIRMED, DECLINED, TIMED_OUT, REQUEUED, REMATCHED]
+
+# Histograms kept in each bucket, of the wait from joining matchmaking to the first match,
+# and of the wait from being requeued to the next match
+WAIT_HISTOGRAM = "wait"
+REMATCH_WAIT_HISTOGRAM = "rematch_wait"
+
+# Events are counted in one bucket per minute, and the stats cover the buckets of the last TELEMETRY_WINDOW minutes
+BUCKET_SECONDS = 60
+TELEMETRY_WINDOW = 15
+
+# Upper bounds in seconds of the wait time histogram kept in each bucket, waits above the last one fall in "inf"
+WAIT_BOUNDS = [1, 2, 5, 10, 15, 20, 30, 40, 60]
+
+# Set of the queues that have had a request, as "difficulty:category"
+QUEUES_KEY = format_key("telemetry", "queues")
+
+
+def _wait_field(wait: float, histogram: str = WAIT_HISTOGRAM) -> str:
+    for bound in WAIT_BOUNDS:
+        if wait <= bound:
+            return f"{histogram}_le_{bound}"
+    return f"{histogram}_le_inf"
+
+
+def _bucket(now: float) -> int:
+    return int(now // BUCKET_SECONDS)
+
+
+async def record_event(
+    difficulty: str,
+    category: str,
+    event: str,
+    matchmaking_conn: Redis,
+    waits: list[float] | None = None,
+    count: int = 1,
+    histogram: str = WAIT_HISTOGRAM,
+) -> None:
+    """
+    Counts the event in the current bucket of the queue, along with the wait times of the users it matched
+    in the given histogram.\n
+    Telemetry is best effort, so failing to record it never fails the request.
+    """
+    bucket_key = format_telemetry_key(difficulty, category, _bucket(time.time()))
+    try:
+        async with matchmaking_conn.pipeline(transaction=False) as pipe:
+            pipe.hincrby(bucket_key, event, count)
+            for wait in waits or []:
+                pipe.hincrby(bucket_key, _wait_field(wait, histogram), 1)
+                pipe.hincrbyfloat(bucket_key, f"{histogram}_sum", wait)
+            pipe.expire(bucket_key, (TELEMETRY_WINDOW + 1) * BUCKET_SECONDS)
+            if event == ENQUEUED:
+                pipe.sadd(QUEUES_KEY, f"{difficulty}:{category}")
+            await pipe.execute()
+    except Exception as e:  # noqa: BLE001
+        log.warning(f"Could not record {event} for {difficulty} {category}: {e}")
+
+
+def _percentile(
+    histogram: dict[str, int], total: int, percentile: float, name: str = WAIT_HISTOGRAM
+) -> float | None:
+    """
+    Returns the upper bound of the histogram bucket the percentile falls in.\n
+    Percentiles above the last bound are reported as the last bound, as JSON has no infinity.
+    """
+    if total == 0:
+        return None
+
+    seen = 0
+    for bound in WAIT_BOUNDS:
+        seen += histogram.get(f"{name}_le_{bound}", 0)
+        if seen >= percentile * total:
+            return float(bound)
+    return float(WAIT_BOUNDS[-1])
+
+
+def predict_wait(depth: int, enqueued: int, median_wait: float | None) -> float | None:
+    """
+    Predicts how long a new request in the queue will wait.\n
+    Someone already waiting is paired straight away, otherwise the request waits for the next arrival,
+    which takes the average time between the arrivals in the window. Without arrivals the recent median is used.
+    """
+    if depth > 0:
+        return 0.0
+    if enqueued > 0:
+        return round(TELEMETRY_WINDOW * BUCKET_SECONDS / enqueued, 1)
+    return median_wait
+
+
+async def get_queue_stats(difficulty: str, category: str, matchmaking_conn: Redis) -> dict:
+    """
+    Summarises the events of the queue over the window, with its current depth and predicted wait.
+    """
+    current = _bucket(time.time())
+    buckets = await asyncio.gather(
+        *(
+            matchmaking_conn.hgetall(format_telemetry_key(difficulty, category, bucket))
+            for bucket in range(current - TELEMETRY_WINDOW + 1, current + 1)
+        )
+    )
+    depth = await matchmaking_conn.zcard(format_queue_key(difficulty, category))
+
+    totals: dict[str, float] = {}
+    for bucket in buckets:
+        for field, value in bucket.items():
+            totals[field] = totals.get(field, 0) + float(value)
+
+    counts = {event: int(totals.get(event, 0)) for event in EVENTS}
+    histogram = {field: int(value) for field, value in totals.items() if field.startswith("wait_le_")}
+    waits = sum(histogram.values())
+    median_wait = _percentile(histogram, waits, 0.5)
+    rematch_histogram = {
+        field: int(value) for field, value in totals.items() if field.startswith(f"{REMATCH_WAIT_HISTOGRAM}_le_")
+    }
+    rematch_waits = sum(rematch_histogram.values())
+    decided = counts[CONFIRMED] + counts[DECLINED]
+
+    return {
+        "difficulty": difficulty,
+        "category": category,
+        "depth": depth,
+        "window_seconds": TELEMETRY_WINDOW * BUCKET_SECONDS,
+        **counts,
+        "match_rate": counts[MATCHED] / counts[ENQUEUED] if counts[ENQUEUED] else None,
+        "confirmation_rate": counts[CONFIRMED] / decided if decided else None,
+        "mean_wait": totals["wait_sum"] / waits if waits else None,
+        "p50_wait": median_wait,
+        "p90_wait": _percentile(histogram, waits, 0.9),
+        "p99_wait": _percentile(histogram, waits, 0.99),
+        "predicted_wait": predict_wait(depth, counts[ENQUEUED], median_wait),
+        "rematch_rate": counts[REMATCHED] / counts[REQUEUED] if counts[REQUEUED] else None,
+        "mean_rematch_wait": totals[f"{REMATCH_WAIT_HISTOGRAM}_sum"] / rematch_waits if rematch_waits else None,
+        "p50_rematch_wait": _percentile(rematch_histogram, rematch_waits, 0.5, REMATCH_WAIT_HISTOGRAM),
+        "p90_rematch_wait": _percentile(rematch_histogram, rematch_waits, 0.9, REMATCH_WAIT_HISTOGRAM),
+    }
+
+
+async def get_all_queue_stats(matchmaking_conn: Redis) -> list[dict]:
+    """
+    Summarises every queue that has had a request.
+    """
+    queues = sorted(await matchmaking_conn.smembers(QUEUES_KEY))
+    return await asyncio.gather(
+        *(get_queue_stats(*queue.split(":", 1), matchmaking_conn) for queue in queues)
+    )
+
+
+def format_metrics(stats: list[dict]) -> str:
+    """
+    Formats the queue stats in the Prometheus text exposition format.
+    """
+    lines = []
+    gauges = {
+        "depth": "Users waiting in the queue",
+        "match_rate": "Matched users per request over the window",
+        "confirmation_rate": "Confirmed matches per decided match over the window",
+        "p50_wait": "Median wait in seconds over the window",
+        "p90_wait": "90th percentile wait in seconds over the window",
+        "p99_wait": "99th percentile wait in seconds over the window",
+        "predicted_wait": "Predicted wait in seconds for a new request",
+        "rematch_rate": "Rematched users per requeued user over the window",
+        "p50_rematch_wait": "Median wait in seconds from being requeued to the next match over the window",
+        "p90_rematch_wait": "90th percentile wait in seconds from being requeued to the next match over the window",
+    }
+    for name, description in gauges.items():
+        lines.append(f"# HELP matchmaking_queue_{name} {description}")
+        lines.append(f"# TYPE matchmaking_queue_{name} gauge")
+        for queue in stats:
+            if queue[name] is not None:
+                labels = f'difficulty="{queue["difficulty"]}",category="{queue["category"]}"'
+                lines.append(f"matchmaking_queue_{name}{{{labels}}} {queue[name]}")
+
+    lines.append("# HELP matchmaking_queue_events Events in the queue over the window")
+    lines.append("# TYPE matchmaking_queue_events gauge")
+    for queue in stats:
+        for event in EVENTS:
+            labels = f'difficulty="{queue["difficulty"]}",category="{queue["category"]}",event="{event}"'
+            lines.append(f"matchmaking_queue_events{{{labels}}} {queue[event]}")
+
+    return "\n".join(lines) + "\n"
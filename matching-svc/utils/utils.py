@@ -1,15 +1,78 @@
 from dotenv import load_dotenv
 import os
+import random
 from redis.asyncio import Redis
-from redis.asyncio.lock import Lock
+from redis.asyncio.cluster import ClusterNode, RedisCluster
+from redis.commands.core import AsyncScript
 
-def get_envvar(var_name: str) -> str:
+_scripts: dict[str, AsyncScript] = {}
+
+def get_envvar(var_name: str, default: str | None = None) -> str:
     load_dotenv()
-    value = os.getenv(var_name)
+    value = os.getenv(var_name, default)
     if value is None:
         raise ValueError(f"Environment variable {var_name} is not set.")
     return value
 
+# Comma separated host:port pairs of the redis cluster nodes, left empty to use a single redis server
+ENV_REDIS_CLUSTER_NODES_KEY = "REDIS_CLUSTER_NODES"
+CLUSTER_MODE = get_envvar(ENV_REDIS_CLUSTER_NODES_KEY, "") != ""
+
+# Every key starts with the namespace so the services can share a redis cluster, where there are no logical
+# databases to keep them apart. The part of a key in braces is its hash tag, which decides the cluster slot
+# it is stored in. Keys used together in one script share a tag, the rest are spread out by their id.
+# The matchmaking state is the exception: every pairing script reads and writes the queues, leases and details of
+# any waiting user, so all of it shares one tag and is served by a single primary, while the per-user messages,
+# matches and telemetry are spread across the cluster. Matchmaking therefore does not scale past one primary.
+# The scripts also build the keys of the users they find from prefixes instead of declaring them in KEYS,
+# which a cluster only serves because those keys share the slot of the keys that are declared.
+KEY_NAMESPACE = get_envvar("REDIS_KEY_NAMESPACE", "peerprep")
+
+def connect_to_redis(host: str, port: str, db: int, cluster_nodes: str = "") -> Redis:
+    """
+    Connects to the redis cluster if its nodes are given, otherwise to the database of a single redis server.
+    """
+    if cluster_nodes:
+        nodes = [ClusterNode(node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1])) for node in cluster_nodes.split(",")]
+        # decode_responses = True is to allow redis to automatically decode responses
+        return RedisCluster(startup_nodes=nodes, decode_responses=True)
+    return Redis(host=host, port=port, decode_responses=True, db=db)
+
+def connect_to_redis_node(host: str, port: str, db: int, cluster_nodes: str = "") -> Redis:
+    """
+    Connects to one of the redis cluster nodes at random if they are given, otherwise to the single redis server.\n
+    Used for pub/sub, as a message published on any node of a cluster reaches the subscribers on every node.
+    """
+    if cluster_nodes:
+        host, port = random.choice(cluster_nodes.split(",")).rsplit(":", 1)
+        return Redis(host=host, port=int(port), decode_responses=True)
+    return Redis(host=host, port=port, decode_responses=True, db=db)
+
+def hash_tag(value: str) -> str:
+    """
+    Wraps the value in braces, so keys with the same tag are stored in the same cluster slot.
+    """
+    return f"{{{value}}}"
+
+def parse_hash_tag(key: str) -> str:
+    """
+    Returns the value in the hash tag of the key, such as the id a key was formatted with.
+    """
+    return key.partition("{")[2].partition("}")[0]
+
+def format_key(*parts: str) -> str:
+    """
+    Joins the parts into a key under the namespace of the service.
+    """
+    return ":".join((KEY_NAMESPACE, *parts))
+
+def format_matchmaking_key(*parts: str) -> str:
+    """
+    Formats a key holding matchmaking state. They are all in one slot, so the pairing scripts can touch any of them.\n
+    This limits matchmaking to the throughput of the primary serving that slot, however many nodes the cluster has.
+    """
+    return format_key(hash_tag("matchmaking"), *parts)
+
 async def sever_connection(redis_connection: Redis):
     """
     Closes the connection with redis.
@@ -22,61 +85,97 @@ async def ping_redis_server(redis_connection: Redis) -> bool:
     """
     return await redis_connection.ping()
 
-async def acquire_lock(key:str, redis_connection:Redis) -> Lock:
+def load_script(source: str, redis_connection: Redis) -> AsyncScript:
     """
-    Attempts to acquire the lock and will be blocked it is being used by someone else.
+    Returns the registered Lua script for the given source, registering it on first use.\n
+    The script is executed with EVALSHA and is only sent in full if redis does not have it cached.
     """
-    # This lock will be sync accross all match-svc instances as long as the key used is the same
-    # timeout = safety fallback, given 2 mins
-    lock = Lock(redis_connection, key, timeout=60)
-    await  lock.acquire()
-
-    return lock
+    script = _scripts.get(source)
+    if script is None:
+        script = redis_connection.register_script(source)
+        _scripts[source] = script
+    return script
 
-async def release_lock(lock:Lock) -> None:
+def format_in_queue_key(user_id:str) -> str:
     """
-    Releases the acquired lock.
+    Formats the user id into a key to be used to identify if the user is in any queue or not.
     """
-    await lock.release()
+    key = format_matchmaking_key("inqueue", user_id)
+    return key
 
-def format_in_queue_key(user_id:str) -> str:
+def format_lease_key(user_id: str) -> str:
     """
-    Formats the user id into a key to be used to identify if the user is in any queue or not.
+    Formats the key whose existence shows the user's client is still waiting for a match.
     """
-    key = f"inqueue:{user_id}"
+    key = format_matchmaking_key("lease", user_id)
     return key
 
-def format_queue_key(difficulty:str, category:str) -> str:
+def format_recent_partners_key(user_id: str) -> str:
     """
-    Formats the difficulty and category into a key to be used for matchmaking.
+    Formats the key of the partners the user was recently matched with.
     """
-    key = f"queue:{difficulty}:{category}"
+    key = format_matchmaking_key("recent", user_id)
     return key
 
-def format_lock_key(key: str) -> str:
+def format_queue_key(difficulty:str, category:str) -> str:
     """
-    Formats the given key into a key to be used as a lock.
+    Formats the difficulty and category into a key to be used for matchmaking.
     """
-    key = f"lock:{key}"
+    key = format_matchmaking_key("queue", difficulty, category)
     return key
 
 def format_match_found_key(user_id: str) -> str:
     """
     Formats the message key when a match is found.
     """
-    key = f"match_found:{user_id}"
+    key = format_key("match_found", hash_tag(user_id))
     return key
 
 def format_match_key(match_id: str) -> str:
     """
     Formats the match key for the match details.
     """
-    key = f"match:{match_id}"
+    key = format_key("match", hash_tag(match_id))
     return key
 
 def format_match_accepted_key(user_id: str) -> str:
     """
     Formats the message key when the matchmaking has been confirmed by both users.
     """
-    key = f"match_confirm:{user_id}"
+    key = format_key("match_confirm", hash_tag(user_id))
+    return key
+
+def format_match_status_key(user_id: str) -> str:
+    """
+    Formats the key storing the latest matchmaking event of the user.
+    """
+    key = format_key("match_status", hash_tag(user_id))
+    return key
+
+def format_rating_key(user_id: str) -> str:
+    """
+    Formats the key caching the skill rating of the user.
+    """
+    key = format_key("rating", hash_tag(user_id))
+    return key
+
+def format_room_event_stream_key() -> str:
+    """
+    Formats the key of the stream of confirmed matches the collaboration service creates rooms for.
+    """
+    key = format_key(hash_tag("room_events"))
+    return key
+
+def format_room_event_key(match_id: str) -> str:
+    """
+    Formats the key recording that the room event of the match was published, in the same slot as the stream.
+    """
+    key = format_key(hash_tag("room_events"), "published", match_id)
+    return key
+
+def format_telemetry_key(difficulty: str, category: str, bucket: int) -> str:
+    """
+    Formats the key counting the matchmaking events of the queue in the given minute.
+    """
+    key = format_key("telemetry", hash_tag(f"{difficulty}:{category}"), str(bucket))
     return key
@@ -28,6 +28,9 @@ def register_self_as_service(app: FastAPI):
         "instance_id": INSTANCE_ID,
         "address": get_envvar("HOST_URL"),
         "openapi": openapi_schema,
+        # Shadow instances only receive a share of mirrored traffic from the gateway
+        "shadow": get_envvar("SHADOW_INSTANCE", "false").lower() == "true",
+        "mirror_percent": float(get_envvar("SHADOW_MIRROR_PERCENT", "0")),
     }
 
     try:
@@ -21,3 +21,11 @@ class TestGetEnvVar:
     def test_get_envvar_not_exists(self):
         with pytest.raises(ValueError):
             get_envvar(self.not_exists)
+
+    def test_get_envvar_not_exists_default(self):
+        res = get_envvar(self.not_exists, "Default")
+        assert res == "Default"
+
+    def test_get_envvar_exists_ignores_default(self):
+        res = get_envvar(self.exists, "Default")
+        assert res == self.exists_return_val